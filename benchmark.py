@@ -0,0 +1,282 @@
+#!/usr/bin/env python
+r"""
+Time merge.py (grid, linear, spline and fit_poly modes), bias.py, sensitivity.py, shuffle.py and ntrials.py on synthetic files made by make_trials.py, and report the trials per second and peak memory of each stage.  The sensitivity and bias obtained from the files in test_data/ are then checked against test_data/reference.json, so that a faster version cannot silently change the physics results, and the subset table of get_sensitivity.py --all-subsets is checked to show a sensitivity the trials do not reach as such.
+"""
+
+r"""
+usage: benchmark.py [-h] [--trials TRIALS] [--fluxes FLUXES] [--edges EDGES]
+                    [--experiments EXPERIMENTS]
+                    [--stages STAGE [STAGE ...]] [--no-check]
+                    [--update-reference] [--json JSON] [--keep DIR]
+                    [--profile [PROFILE]]
+
+optional arguments:
+  -h, --help            show this help message and exit
+  --trials TRIALS       Number of synthetic trials per true flux.
+  --fluxes FLUXES       Number of synthetic true fluxes.
+  --edges EDGES         Number of flux values sampled by every synthetic
+                        curve.
+  --experiments EXPERIMENTS
+                        Number of synthetic files merged.
+  --stages STAGE [STAGE ...]
+                        Stages to time, among merge_grid, merge_linear,
+                        merge_spline, merge_fit_poly, bias, sensitivity,
+                        shuffle and ntrials. All by default.
+  --no-check            Set to skip the check against the test_data/
+                        reference results.
+  --update-reference    Set to write the current test_data/ results as the
+                        new reference instead of checking them.
+  --json JSON           Set to also write the measurements and checks to
+                        JSON.
+  --keep DIR            Set to write the synthetic files in DIR and keep
+                        them, instead of a temporary directory.
+  --profile [PROFILE]   Set to print the time, number of calls and peak memory
+                        of each stage, and to also write them as JSON to
+                        PROFILE if given.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+from multiprocessing import Process, Pipe
+import numpy as np
+import make_trials
+import merge
+import bias
+import sensitivity
+import shuffle
+import ntrials
+import get_sensitivity
+import profiling
+
+TEST_DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test_data')
+REFERENCE = os.path.join(TEST_DATA, 'reference.json')
+REFERENCE_FILES = ['results_7yrICmuons_KRAg5e7.txt.gz',
+                   'results_9yrANTmuons_KRAg5e7_2000trials_23may.txt.gz',
+                   'results_9yrANTshowers_KRAg5e7_2000trials_23may.txt.gz']
+MODES = [('merge_grid', False, 'linear'), ('merge_linear', True, 'linear'),
+         ('merge_spline', True, 'spline'), ('merge_fit_poly', True, 'fit_poly')]
+STAGES = [mode[0] for mode in MODES] + ['bias', 'sensitivity', 'shuffle', 'ntrials']
+TOLERANCE = 1e-6  # Relative difference allowed with the reference results
+
+
+def _run(function, args, connection):
+    """Child side of measure: run function(*args) with stdout muted and send back the time and peak memory."""
+    sys.stdout = open(os.devnull, 'w')
+    start = time.time()
+    result = function(*args)
+    elapsed = time.time() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.  # kB on Linux
+    connection.send((elapsed, peak, result))
+    connection.close()
+
+
+def measure(function, *args):
+    """
+    Run function(*args) in a fresh process, so that every stage gets its own peak memory.  Returns the wall time in seconds, the peak resident memory in MB and the result of the function.
+    """
+    parent, child = Pipe(duplex=False)
+    process = Process(target=_run, args=(function, args, child))
+    process.start()
+    elapsed, peak, result = parent.recv()
+    process.join()
+    return elapsed, peak, result
+
+
+def benchmark(workdir, trials_per_flux, nfluxes, n_edges, nexperiments, stages):
+    """
+    Generate synthetic files in workdir and time the requested stages on them.  Returns one dict per stage with its time, trials per second and peak memory.
+    """
+    total = trials_per_flux * nfluxes
+    with profiling.stage('synthetic files', total * nexperiments):
+        files = make_trials.main(os.path.join(workdir, 'results_synthetic'), trials_per_flux, nfluxes, 3., n_edges, nexperiments, unblinded=True, seed=1)
+    merged = os.path.join(workdir, 'merged_synthetic.txt')
+    calls = {}
+    for name, interpolate, interp_opt in MODES:
+        outfile = os.path.join(workdir, name + '.txt')
+        calls[name] = (merge.main, files + [outfile], '', interpolate, False, False, True, True, 1, False, interp_opt)
+    calls['bias'] = (bias.main, merged, None, '', True)
+    calls['sensitivity'] = (sensitivity.main, merged, True, True, '')
+    calls['shuffle'] = (shuffle.main, files[0], os.path.join(workdir, 'shuffled.txt'))
+    calls['ntrials'] = (ntrials.main, files[0])
+
+    # bias.py and sensitivity.py run on merged trials, made once here and not timed
+    with profiling.stage('merge reference'):
+        measure(merge.main, files + [merged], '', True, False, False, True, True)
+    results = []
+    for name in stages:
+        with profiling.stage(name, total):  # the stages of the child process are not seen, only its time
+            elapsed, peak, _ = measure(*calls[name])
+        results.append({'stage': name, 'seconds': elapsed, 'trials_per_second': total / elapsed, 'peak_mb': peak})
+        print '{:<16} {:>9.3f} s {:>12.0f} trials/s {:>9.1f} MB'.format(name, elapsed, total / elapsed, peak)
+    return results
+
+
+def reference_results():
+    """Sensitivity, bias and background median of the test_data/ files merged in every mode."""
+    files = [os.path.join(TEST_DATA, name) for name in REFERENCE_FILES]
+    results = {}
+    for name, interpolate, interp_opt in MODES:
+        data = merge.merge(files, '', interpolate, hide=True, interp_opt=interp_opt)
+        sens, _ = sensitivity.sensitivity(data, True, False, '')
+        results[name] = {'sensitivity': float(sens),
+                         'bias': float(bias.fit_bias(data, 'merged_all', None, '', True)),
+                         'median_ts': float(np.median(data[data[:, 0] == 0., 2]))}
+    return results
+
+
+def check(current, reference):
+    """Compare current results to the reference ones.  Returns the list of differences found."""
+    failures = []
+    for mode in sorted(reference):
+        for quantity in sorted(reference[mode]):
+            expected = reference[mode][quantity]
+            found = current.get(mode, {}).get(quantity)
+            if found is None or abs(found - expected) > TOLERANCE * max(abs(expected), 1.):
+                failures.append('{} {}: expected {}, found {}'.format(mode, quantity, expected, found))
+    return failures
+
+
+def check_subsets():
+    """
+    Compare the subsets of two small synthetic files, the second of which alone only reaches 90% above the largest true flux, and check that its sensitivity is shown as '>' that flux and the others as numbers.  Returns the list of differences found.
+    """
+    workdir = tempfile.mkdtemp(prefix='llh-combiner-subsets-')
+    try:
+        files = make_trials.main(os.path.join(workdir, 'results_subsets'), 300, 9, 3., 31, 2, seed=2)
+        rows = get_sensitivity.compare_subsets(files, None, None, '', False, False, True, False, False)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    expected = {'1': False, '2': True, '1+2': False}  # subset: sensitivity beyond the largest true flux
+    return ['subset {}: sensitivity shown as {}'.format(row[0], row[2])
+            for row in rows if row[2].startswith('>') != expected[row[0]] or row[2] == '-']
+
+
+def main(trials_per_flux=1000, nfluxes=9, n_edges=31, nexperiments=3, stages=None, run_check=True, update_reference=False, json_file='', keep=''):
+    """
+    Run the benchmark and the reference check.  Returns 1 if the check failed, 0 otherwise.
+    """
+    stages = stages or STAGES
+    for name in stages:
+        if name not in STAGES:
+            print "Error: Unknown stage {}, choose among {}.".format(name, ', '.join(STAGES))
+            return 1
+    workdir = keep or tempfile.mkdtemp(prefix='llh-combiner-benchmark-')
+    if not os.path.isdir(workdir):
+        os.makedirs(workdir)
+    print 'Timing {} trials ({} per flux) over {} files:'.format(trials_per_flux * nfluxes, trials_per_flux, nexperiments)
+    try:
+        results = benchmark(workdir, trials_per_flux, nfluxes, n_edges, nexperiments, stages)
+    finally:
+        if not keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+    report = {'trials': trials_per_flux * nfluxes, 'experiments': nexperiments, 'edges': n_edges, 'stages': results}
+
+    status = 0
+    if run_check or update_reference:
+        with profiling.stage('reference results'):
+            _, _, current = measure(reference_results)
+        report['reference'] = current
+        if update_reference:
+            with open(REFERENCE, 'w') as f:
+                json.dump(current, f, indent=2, sort_keys=True, separators=(',', ': '))
+            print 'Reference results written in', REFERENCE
+        else:
+            with open(REFERENCE) as f:
+                failures = check(current, json.load(f))
+            with profiling.stage('subsets check'):
+                failures += measure(check_subsets)[2]
+            report['failures'] = failures
+            if failures:
+                print 'Reference check FAILED:'
+                for failure in failures:
+                    print '  ' + failure
+                status = 1
+            else:
+                print 'Reference check passed: the test_data/ results are unchanged and unreached sensitivities are shown as such.'
+
+    if json_file:
+        with open(json_file, 'w') as f:
+            json.dump(report, f, indent=2, separators=(',', ': '))
+    return status
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__,)
+
+    parser.add_argument(
+        '--trials',
+        default=1000,
+        type=int,
+        help='Number of synthetic trials per true flux.')
+
+    parser.add_argument(
+        '--fluxes',
+        default=9,
+        type=int,
+        help='Number of synthetic true fluxes.')
+
+    parser.add_argument(
+        '--edges',
+        default=31,
+        type=int,
+        help='Number of flux values sampled by every synthetic curve.')
+
+    parser.add_argument(
+        '--experiments',
+        default=3,
+        type=int,
+        help='Number of synthetic files merged.')
+
+    parser.add_argument(
+        '--stages',
+        nargs='+',
+        default=None,
+        metavar='STAGE',
+        help='Stages to time, among {}. All by default.'.format(', '.join(STAGES)))
+
+    parser.add_argument(
+        '--no-check',
+        default=False,
+        action="store_true",
+        help='Set to skip the check against the test_data/ reference results.')
+
+    parser.add_argument(
+        '--update-reference',
+        default=False,
+        action="store_true",
+        help='Set to write the current test_data/ results as the new reference instead of checking them.')
+
+    parser.add_argument(
+        '--json',
+        default='',
+        type=str,
+        help='Set to also write the measurements and checks to JSON.')
+
+    parser.add_argument(
+        '--keep',
+        default='',
+        type=str,
+        metavar='DIR',
+        help='Set to write the synthetic files in DIR and keep them, instead of a temporary directory.')
+
+    # Profiling flag
+    parser.add_argument(
+        '--profile',
+        nargs="?",
+        default=None,
+        const='',
+        type=str,
+        help='Set to print the time, number of calls and peak memory of each stage, and to also write them as JSON to PROFILE if given.')
+
+    args = parser.parse_args()
+    if args.profile is not None:
+        profiling.enable()
+    status = main(args.trials, args.fluxes, args.edges, args.experiments, args.stages, not args.no_check, args.update_reference, args.json, args.keep)
+    profiling.report(args.profile)
+    sys.exit(status)
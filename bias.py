@@ -1,15 +1,16 @@
 #!/usr/bin/env python
 
 r"""
-A utility for examining any possible bias in the flux measurement.  Operates on 'merged' input files. Can write bias in files so that it can be corrected by merge.py.
+A utility for examining any possible bias in the flux measurement.  Operates on 'merged' input files. Can write the bias of a results file in its sidecar (FILE.bias.json, see results_io.py) so that it can be corrected by merge.py, without rewriting the file.
 """
 
 r"""
-usage: bias.py [-h] [--hide] [--save [SAVE]] [FILE] [FILE [FILE ...]]
+usage: bias.py [-h] [--hide] [--save [SAVE]] [--chunk CHUNK]
+               [--profile [PROFILE]] [FILE] [FILE [FILE ...]]
 
 positional arguments:
   FILE           Path to input file containing results of (pre-merged)
-                 scrambled trials.
+                 scrambled trials, as text or as a .npy array.
   FILE           Path to file to be merged.
 
 optional arguments:
@@ -17,6 +18,13 @@ optional arguments:
   --hide         Set to not show the plots.
   --save [SAVE]  Set to save the most usefull plots with SAVE as a filename
                  extension.
+  --chunk CHUNK  Number of trials read at a time, so that memory does not
+                 grow with the number of trials. The statistics take a few
+                 passes over the file. 0 reads the whole file.
+  --profile [PROFILE]
+                 Set to print the time, number of calls and peak memory of
+                 each stage, and to also write them as JSON to PROFILE if
+                 given.
 """
 
 # Flux are in units [1/GeV/cm^2/s] or scaling factors relative to a specified model
@@ -24,12 +32,13 @@ optional arguments:
 
 import sys
 import math
-import matplotlib.pyplot as plt
 from scipy.interpolate import UnivariateSpline
 import numpy as np
 from scipy.optimize import curve_fit
-from os import remove
-from shutil import move
+from trial_table import TrialTable, StreamingTable
+from results_io import write_bias, bias_file, iter_rows, read_merged
+from plotting import wanted, pyplot
+import profiling
 
 
 def func(x, a_):
@@ -37,77 +46,37 @@ def func(x, a_):
     return a_ * x
 
 
-def main(infile, datafile, save_name, hide=False):
-    try:
-        data = np.loadtxt(infile)
-    except IOError:
-        print "Error: Input file {} missing.".format(infile)
-        return 0
-
-    plt.figure()
-    plt.yscale('log')
-    plt.xlabel('Reco Flux - True Flux')
-    plt.ylabel('N Trials')
-    bins = np.arange(-2, 2, 0.25)
-    unique_fluxes = np.unique(data[:, 0])  # sorted
-    if -1 in unique_fluxes:
-        unique_fluxes = unique_fluxes[1:]
-    # unique_fluxes = unique_fluxes[:9]
-
-    print('Sorted list of unique fluxes: {})'.format(unique_fluxes))
-    n = len(unique_fluxes)
-    ylows = np.zeros(n)
-    medsv = np.zeros(n)
-    yhighs = np.zeros(n)
-    meds = np.zeros(n)
-    means = np.zeros(n)
-    stds = np.zeros(n)
-    i = 0
-    rfluxes = []
-    stats = []
-
-    for tflux in unique_fluxes:  # Loop over True Fluxes available
-        rfluxes.append(data[data[:, 0] == tflux][:, 1])  # Isolate the list of all Reco Flux values for this True Flux
-        dist = rfluxes[i] - tflux
-        stats = np.percentile(rfluxes[i], [16, 50, 84])
-        medsv[i] = stats[1]
-        ylows[i] = medsv[i] - stats[0]
-        yhighs[i] = stats[2] - medsv[i]
-        meds[i] = np.median(dist)
-        means[i] = np.mean(dist)
-        stds[i] = np.std(dist)
-        plt.hist(dist, bins=bins, histtype='step')
-        i = i + 1
-    print 'Fitted fluxes with error bars:', [str(fitted_flux) + ' (+' + str(yhighs[index]) + ' -' + str(ylows[index])+ ')' for index, fitted_flux in enumerate(medsv)]
+def plot_bias(plt, table, stats, fit_a, infile, save_name, hide):
+    """
+    Reco flux and TS distributions per true flux with the fitted bias. stats are the 16, 50 and 84% percentiles of the reco flux per true flux. Only the bias violin plot is saved, the other figures are only drawn if shown. With a StreamingTable, the distributions themselves are not drawn.
+    """
+    unique_fluxes = table.fluxes
+    in_memory = isinstance(table, TrialTable)
+    medsv = stats[1]
+    if in_memory:
+        rfluxes = table.groups(1)  # Reco Flux values of each True Flux
+    if in_memory and not hide:
+        plt.figure()
+        plt.yscale('log')
+        plt.xlabel('Reco Flux - True Flux')
+        plt.ylabel('N Trials')
+        bins = np.arange(-2, 2, 0.25)
+        for rflux, tflux in zip(rfluxes, unique_fluxes):  # Loop over True Fluxes available
+            plt.hist(rflux - tflux, bins=bins, histtype='step')
 
-    param, _ = curve_fit(func, unique_fluxes, medsv)
-    fit_a = param[0]
-    print 'Bias fitted by: ' + '{0:.3f}'.format(fit_a) + ' * x'
-
-    # Write the bias in the file if datafile is given
-    if datafile:
-        temp_file = 'temporary_file.txt'
-        with open(temp_file, 'w') as tempfile:
-            tempfile.write('Bias fitted by: ' + '{0:.3f}'.format(fit_a) + ' * x' + '\n')
-            print 'Writing in', datafile[0]
-            with open(datafile[0]) as oldfile:
-                for line in oldfile:
-                    if line.find('Bias') == -1:
-                        tempfile.write(line)
-        remove(datafile[0])
-        move(temp_file, datafile[0])
-
-    plt.figure()
-    plt.xlabel('True Flux')
-    plt.ylabel('Reco Flux - True Flux')
-    plt.errorbar(unique_fluxes, meds, xerr=0.0, yerr=0.0)
-    plt.errorbar(unique_fluxes, means, xerr=0.0, yerr=stds)
+    if not hide:
+        plt.figure()
+        plt.xlabel('True Flux')
+        plt.ylabel('Reco Flux - True Flux')
+        plt.errorbar(unique_fluxes, medsv - unique_fluxes, xerr=0.0, yerr=0.0)
+        plt.errorbar(unique_fluxes, table.means(1) - unique_fluxes, xerr=0.0, yerr=table.stds(1))
 
     plt.figure()
     # plt.xlim(-0.5,3.5)
     # plt.ylim(-0.5,3.5)
-    plt.violinplot(rfluxes, unique_fluxes, widths=0.25, showmeans=True, showmedians=False, showextrema=False)
-    plt.errorbar(unique_fluxes, medsv, xerr=0.0, yerr=[ylows, yhighs], linestyle='', marker='o', color='k')
+    if in_memory:
+        plt.violinplot(rfluxes, unique_fluxes, widths=0.25, showmeans=True, showmedians=False, showextrema=False)
+    plt.errorbar(unique_fluxes, medsv, xerr=0.0, yerr=[medsv - stats[0], stats[2] - medsv], linestyle='', marker='o', color='k')
     plt.xlabel('True Flux')
     plt.ylabel('Reco Flux')
     x = np.arange(0., np.max(unique_fluxes) + 0.5, 0.1)
@@ -122,27 +91,73 @@ def main(infile, datafile, save_name, hide=False):
             EXPtopo = infile.split('yr')[1].split('_')[0] # string of the type ICmuons or ANTshowers
         plt.savefig('plots/bias_'+EXPtopo+'_'+save_name+'.pdf')
 
-    plt.figure()
-    bins = np.arange(0, 10, 0.5)
-    tses = []
-    meds_ts = []
-    for tflux in unique_fluxes:  # Loop over True Fluxes available
-        ts = data[data[:, 0] == tflux][:, 2]  # Isolate the list of all TS values for this True Flux
-        tses.append(ts)
-        plt.hist(ts, bins, histtype='step')
-        meds_ts.append(np.median(ts))
-    plt.yscale('log')
-    plt.xlabel('TS')
-
-    plt.figure()
-    plt.violinplot(tses, unique_fluxes, widths=0.25, showmeans=True, showmedians=False, showextrema=False)
-    plt.errorbar(unique_fluxes, meds_ts, xerr=0.0, yerr=0.0, linestyle='', marker='o', color='k')
-    plt.xlabel('True Flux')
-    plt.ylabel('TS')
+    if in_memory and not hide:
+        plt.figure()
+        bins = np.arange(0, 10, 0.5)
+        tses = table.groups(2)  # TS values of each True Flux
+        for ts in tses:  # Loop over True Fluxes available
+            plt.hist(ts, bins, histtype='step')
+        plt.yscale('log')
+        plt.xlabel('TS')
+
+        plt.figure()
+        plt.violinplot(tses, unique_fluxes, widths=0.25, showmeans=True, showmedians=False, showextrema=False)
+        plt.errorbar(unique_fluxes, table.medians(2), xerr=0.0, yerr=0.0, linestyle='', marker='o', color='k')
+        plt.xlabel('True Flux')
+        plt.ylabel('TS')
 
     if not hide:
         plt.show()
 
+
+def fit_bias(data, infile, datafile, save_name, hide=False):
+    """
+    Fit the bias from merged trials, one row [true flux, best-fit flux, TS] per trial, or from a StreamingTable of them, and write it with the fitted points in the sidecar of datafile if given. infile only names the saved plots and the source of the fit. Returns the fitted bias factor.
+    """
+    streaming = isinstance(data, StreamingTable)
+    with profiling.stage('group', np.sum(data.counts) if streaming else len(data)):
+        table = data if streaming else TrialTable(data[data[:, 0] != -1])  # trials grouped by true flux, without the unblinded data
+        stats = table.percentiles([16, 50, 84], 1)
+    unique_fluxes = table.fluxes  # sorted
+    # unique_fluxes = unique_fluxes[:9]
+
+    print('Sorted list of unique fluxes: {})'.format(unique_fluxes))
+    medsv = stats[1]
+    ylows = medsv - stats[0]
+    yhighs = stats[2] - medsv
+    print 'Fitted fluxes with error bars:', [str(fitted_flux) + ' (+' + str(yhighs[index]) + ' -' + str(ylows[index])+ ')' for index, fitted_flux in enumerate(medsv)]
+
+    with profiling.stage('fit'):
+        param, _ = curve_fit(func, unique_fluxes, medsv)
+    fit_a = param[0]
+    print 'Bias fitted by: ' + '{0:.3f}'.format(fit_a) + ' * x'
+
+    # Write the bias in the sidecar of the file if datafile is given
+    if datafile:
+        print 'Writing in', bias_file(datafile[0])
+        fit = {'fitted_from': infile, 'true_fluxes': list(unique_fluxes), 'medians': list(medsv),
+               'percentiles_16': list(stats[0]), 'percentiles_84': list(stats[2]), 'fitted_bias': fit_a}
+        with profiling.stage('write bias'):
+            write_bias(datafile[0], fit_a, fit)
+
+    if wanted(hide, save_name):
+        with profiling.stage('plot'):
+            plot_bias(pyplot(not hide), table, stats, fit_a, infile, save_name, hide)
+    return fit_a
+
+
+def main(infile, datafile, save_name, hide=False, chunk_size=0):
+    try:
+        with profiling.stage('read'):
+            if chunk_size:
+                data = StreamingTable(lambda: iter_rows(infile, chunk_size))
+            else:
+                data = read_merged(infile)
+    except IOError:
+        print "Error: Input file {} missing.".format(infile)
+        return 0
+    fit_bias(data, infile, datafile, save_name, hide)
+
 if __name__ == "__main__":
     import argparse
     parser = argparse.ArgumentParser(description=__doc__,)
@@ -152,10 +167,10 @@ if __name__ == "__main__":
         nargs="?",
         default='',
         type=str,
-        help="Path to input file containing results of (pre-merged) scrambled trials.",
+        help="Path to input file containing results of (pre-merged) scrambled trials, as text or as a .npy array.",
         metavar="FILE")
 
-    # Initial data file where we will write the bias to correct it with merge.py.
+    # Initial data file whose sidecar will hold the bias to correct it with merge.py.
     parser.add_argument(
         "datafile",
         nargs="*",
@@ -179,8 +194,27 @@ if __name__ == "__main__":
         type=str,
         help='Set to save the most usefull plots with SAVE as a filename extension.')
 
+    # Streaming
+    parser.add_argument(
+        '--chunk',
+        default=0,
+        type=int,
+        help='Number of trials read at a time, so that memory does not grow with the number of trials. The statistics take a few passes over the file. 0 reads the whole file.')
+
+    # Profiling flag
+    parser.add_argument(
+        '--profile',
+        nargs="?",
+        default=None,
+        const='',
+        type=str,
+        help='Set to print the time, number of calls and peak memory of each stage, and to also write them as JSON to PROFILE if given.')
+
     args = parser.parse_args()
-    if len(sys.argv) >= 2 and len(sys.argv) <= 7:
-        main(args.inputfile, args.datafile, args.save, args.hide)
+    if args.profile is not None:
+        profiling.enable()
+    if len(sys.argv) >= 2 and len(sys.argv) <= 11:
+        main(args.inputfile, args.datafile, args.save, args.hide, args.chunk)
+        profiling.report(args.profile)
     else:
         parser.print_help()
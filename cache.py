@@ -0,0 +1,112 @@
+r"""
+On-disk cache of parsed results files and merged trials, used by merge.py with --cache.
+
+Entries are keyed by the SHA-1 of the input file contents together with the merge options, so a changed file or option simply misses.  Parsed text files are cached as binary stores (see convert.py) and read back through np.memmap; merged trials are cached as .npz files.  Entries unused for MAX_AGE seconds are removed, then the least recently used ones until the cache is below MAX_BYTES.  The cache lives in $LLH_COMBINER_CACHE, or ~/.cache/llh-combiner by default.
+"""
+
+import os
+import time
+import shutil
+import hashlib
+import numpy as np
+from results_io import is_store, read_results, sidecar_bias, write_store
+
+CACHE_DIR = os.environ.get('LLH_COMBINER_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'llh-combiner'))
+MAX_BYTES = 10 * 1024 ** 3
+MAX_AGE = 30 * 24 * 3600.
+VERSION = 3  # Bump whenever merge.py changes its results, to invalidate older entries
+BLOCK_SIZE = 1 << 20
+
+
+def file_digest(path):
+    """SHA-1 of the content of a results file, or of all files of a binary store."""
+    sha = hashlib.sha1()
+    paths = [path]
+    if is_store(path):
+        paths = [os.path.join(path, name) for name in sorted(os.listdir(path))]
+        for name in sorted(os.listdir(path)):
+            sha.update(name)
+    for path_ in paths:
+        with open(path_, 'rb') as f:
+            block = f.read(BLOCK_SIZE)
+            while block:
+                sha.update(block)
+                block = f.read(BLOCK_SIZE)
+    return sha.hexdigest()
+
+
+def key(*parts):
+    """Cache key made of the string form of all parts."""
+    return hashlib.sha1(' '.join(str(part) for part in (VERSION,) + parts)).hexdigest()
+
+
+def _entry(name):
+    entry = os.path.join(CACHE_DIR, name)
+    if os.path.exists(entry):
+        os.utime(entry, None)  # mark as recently used
+        return entry
+    return None
+
+
+def cached_results(path, digest):
+    """
+    read_results through the cache. Binary stores are already memory-mapped and are read directly.  The digest only covers the content of the file, so the cached entry keeps the bias written in the file and the sidecar of path is applied when reading it.
+    """
+    if is_store(path):
+        return read_results(path)
+    entry = _entry(digest + '.trials')
+    if entry:
+        header, bias, unblinded, flux, curves = read_results(entry, sidecar=False)
+        return header, sidecar_bias(path, bias), unblinded, flux, curves
+    results = read_results(path, sidecar=False)
+    temp_dir = os.path.join(CACHE_DIR, 'temporary_{}_{}.trials'.format(os.getpid(), digest))
+    write_store(temp_dir, *results)
+    try:
+        os.rename(temp_dir, os.path.join(CACHE_DIR, digest + '.trials'))
+    except OSError:  # already cached by a concurrent run
+        shutil.rmtree(temp_dir, ignore_errors=True)
+    evict()
+    header, bias, unblinded, flux, curves = results
+    return header, sidecar_bias(path, bias), unblinded, flux, curves
+
+
+def load(name):
+    """Arrays stored under name as a dict, or None if not cached."""
+    entry = _entry(name + '.npz')
+    if entry is None:
+        return None
+    with np.load(entry) as npz:
+        return dict(npz)
+
+
+def save(name, **arrays):
+    """Store arrays under name."""
+    if not os.path.isdir(CACHE_DIR):
+        os.makedirs(CACHE_DIR)
+    temp_file = os.path.join(CACHE_DIR, 'temporary_{}_{}.npz'.format(os.getpid(), name))
+    np.savez(temp_file, **arrays)
+    os.rename(temp_file, os.path.join(CACHE_DIR, name + '.npz'))  # atomic, concurrent runs never read half-written entries
+    evict()
+
+
+def _size(entry):
+    if os.path.isdir(entry):
+        return sum(os.path.getsize(os.path.join(entry, name)) for name in os.listdir(entry))
+    return os.path.getsize(entry)
+
+
+def evict(max_bytes=MAX_BYTES, max_age=MAX_AGE):
+    """Remove entries unused for max_age seconds, then the least recently used ones above max_bytes."""
+    if not os.path.isdir(CACHE_DIR):
+        return
+    entries = [os.path.join(CACHE_DIR, name) for name in os.listdir(CACHE_DIR) if not name.startswith('temporary_')]
+    entries.sort(key=os.path.getmtime, reverse=True)  # most recently used first
+    now = time.time()
+    total = 0
+    for entry in entries:
+        total += _size(entry)
+        if total > max_bytes or now - os.path.getmtime(entry) > max_age:
+            if os.path.isdir(entry):
+                shutil.rmtree(entry, ignore_errors=True)
+            else:
+                os.remove(entry)
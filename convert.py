@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+r"""
+Convert a text results file into a binary store once, so that merge.py, bias.py, shuffle.py and ntrials.py can memory-map it instead of parsing text on every run.  The store is a directory holding header.npy, flux.npy and curves.npy, plus bias.npy and unblinded.npy if present in the text file.
+"""
+
+r"""
+usage: convert.py [-h] [--profile [PROFILE]] [inputfile] [outputdir]
+
+positional arguments:
+  inputfile   Path to text results file to be converted.
+  outputdir   Path to the binary store to create. Defaults to the input file
+              name with .txt replaced by .trials
+
+optional arguments:
+  -h, --help  show this help message and exit
+  --profile [PROFILE]
+              Set to print the time, number of calls and peak memory of each
+              stage, and to also write them as JSON to PROFILE if given.
+"""
+
+import sys
+import argparse
+from results_io import read_results, write_store, store_name
+import profiling
+
+
+def main(infile, outdir):
+    """
+    Write the content of a text results file as a binary store.
+    """
+    if not outdir:
+        outdir = store_name(infile)
+    try:
+        with profiling.stage('read'):
+            header, bias, unblinded, flux, curves = read_results(infile)
+    except IOError:
+        print "Error: Input file {} missing.".format(infile)
+        return 0
+    except ValueError as error:
+        print error
+        return 0
+
+    try:
+        with profiling.stage('write', len(flux)):
+            write_store(outdir, header, bias, unblinded, flux, curves)
+    except (IOError, OSError):
+        print "Error: Unable to write binary store {}.".format(outdir)
+        return 0
+    print 'Converted {} trials of {} into {}'.format(len(flux), infile, outdir)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__,)
+
+    parser.add_argument(
+        "inputfile",
+        nargs="?",
+        default='',
+        type=str,
+        help="Path to text results file to be converted.")
+
+    parser.add_argument(
+        "outputdir",
+        nargs="?",
+        default='',
+        type=str,
+        help="Path to the binary store to create. Defaults to the input file name with .txt replaced by .trials")
+
+    # Profiling flag
+    parser.add_argument(
+        '--profile',
+        nargs="?",
+        default=None,
+        const='',
+        type=str,
+        help='Set to print the time, number of calls and peak memory of each stage, and to also write them as JSON to PROFILE if given.')
+
+    args = parser.parse_args()
+    if args.profile is not None:
+        profiling.enable()
+    if len(sys.argv) >= 2:
+        main(args.inputfile, args.outputdir)
+        profiling.report(args.profile)
+    else:
+        parser.print_help()
@@ -0,0 +1,89 @@
+r"""
+Batch rendering of the --diagnostic plots of merge.py and get_sensitivity.py.
+
+A selection picks the trials to look at once they are merged: all of them, the overflow trials (best fit within 5% of the top of the flux range), the trials whose true flux lies outside the 0.5 log-likelihood interval around the peak, or a random sample ('random:N').  The curves of the selected trials are sent to a worker process that draws them with the non-interactive Agg backend, one page per trial, into a single PDF, so that no window blocks the merge and the rest of the run goes on while the pages are drawn.  finish() waits for the worker; it also runs at exit.
+"""
+
+import os
+import atexit
+from multiprocessing import Process, Queue
+import numpy as np
+from plotting import pyplot
+
+SELECTIONS = ['all', 'overflow', 'outside', 'random']
+RANDOM_TRIALS = 100  # Size of the 'random' sample when no number is given
+_workers = []  # (process, queue, output file) of the renderings in progress
+
+
+def parse_selection(selection):
+    """
+    Name and size of a selection given as 'all', 'overflow', 'outside', 'random' or 'random:N'.  True selects all trials.  Raises ValueError for anything else.
+    """
+    if selection is True:
+        return 'all', 0
+    name, _, size = str(selection).partition(':')
+    if name not in SELECTIONS or (size and name != 'random'):
+        raise ValueError('Error: Unknown diagnostic selection {}, choose among {} or random:N.'.format(selection, ', '.join(SELECTIONS)))
+    try:
+        return name, int(size) if size else RANDOM_TRIALS
+    except ValueError:
+        raise ValueError('Error: Unknown diagnostic selection {}, the size of the random sample must be an integer.'.format(selection))
+
+
+def select_trials(selection, maxfluxes, contained, header, seed=0):
+    """
+    Indices of the trials picked by selection among merged trials, given their best-fit fluxes, whether their true flux lies within 0.5 log-likelihood of the peak and the header of the files.
+    """
+    name, size = parse_selection(selection)
+    flux_min, flux_max, _ = header
+    if name == 'overflow':
+        return np.flatnonzero(maxfluxes > 0.95 * (flux_max - flux_min))
+    if name == 'outside':
+        return np.flatnonzero(~contained)
+    if name == 'random':
+        return np.sort(np.random.RandomState(seed).choice(len(maxfluxes), min(size, len(maxfluxes)), replace=False))
+    return np.arange(len(maxfluxes))
+
+
+def _render(queue, outfile, draw):
+    """Worker side: draw every trial received on the queue as a page of outfile, until None is received."""
+    plt = pyplot(interactive=False)
+    plt.switch_backend('Agg')  # in case the parent process had already loaded an interactive backend
+    from matplotlib.backends.backend_pdf import PdfPages
+    pages = PdfPages(outfile)
+    try:
+        while True:
+            trial = queue.get()
+            if trial is None:
+                break
+            figure = draw(plt, *trial)
+            pages.savefig(figure)
+            plt.close(figure)
+    finally:
+        pages.close()
+
+
+def start(outfile, draw):
+    """
+    Start a worker drawing trials into the PDF outfile with draw(plt, *trial), which returns the figure of a trial.  Returns the function sending it the arguments of a trial.
+    """
+    directory = os.path.dirname(outfile)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    queue = Queue()
+    process = Process(target=_render, args=(queue, outfile, draw))
+    process.start()
+    _workers.append((process, queue, outfile))
+    return queue.put
+
+
+def finish():
+    """Wait for all workers to draw the trials sent to them."""
+    while _workers:
+        process, queue, outfile = _workers.pop(0)
+        queue.put(None)
+        process.join()
+        print 'Diagnostic plots written in', outfile
+
+
+atexit.register(finish)
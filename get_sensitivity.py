@@ -1,15 +1,21 @@
 #!/usr/bin/env python
 
 r"""
-Merge, compute and correct bias and get the sensitivity all at once. This script runs bias.py, merge.py and sensitivity.py so that you basically don't need to run them.
+Merge, compute and correct bias and get the sensitivity all at once. This script runs bias.py, merge.py and sensitivity.py in the same process, passing the merged trials in memory, so that you basically don't need to run them. The fitted biases are written in sidecar files next to the inputs (FILE.bias.json), the input files themselves are never modified.
 
-You need the files to have the same number of trials for each flux to merge them. ntrials.py can be used to determine that.
+The trials of the files are paired by true flux, whatever their order in each file, and only as many trials per flux as in the file with the fewest are used. ntrials.py can be used to check the numbers of trials beforehand.
+
+Every file is read once: the biases are fitted on its arrays and the merged trials are passed on as arrays, and the merged file is only written if --merged is given.  With --chunk, the trials are instead streamed through the --merged file, or a temporary .npy file, so that memory does not grow with the number of trials.  With --update, only the trials appended to the files since the last run are merged into the --merged file, and the biases fitted at the first run are kept.
  """
  
 r"""
-usage: get_sensitivity.py [-h] [--interp] [--diagnostic]
+usage: get_sensitivity.py [-h] [--interp] [--diagnostic [SELECTION]]
                           [--bias [BIAS [BIAS ...]]] [--hide] [--unblinded]
-                          [--save [SAVE]]
+                          [--save [SAVE]] [--merged [MERGED]] [--jobs JOBS]
+                          [--cache] [--bootstrap BOOTSTRAP] [--chunk CHUNK]
+                          [--all-subsets] [--belt [CL [CL ...]]] [--update]
+                          [--advise [PRECISION]] [--tail]
+                          [--profile [PROFILE]]
                           [files [files ...]]
 
 positional arguments:
@@ -19,71 +25,247 @@ optional arguments:
   -h, --help            show this help message and exit
   --interp              Set to interpolate between sample points using
                         splines. Leave unset for naive summing at grid points.
-  --diagnostic          Set to run special diagnostics to visualize results.
-                        You may have to force quit the process if you don't
-                        want to go through all trials.
+  --diagnostic [SELECTION]
+                        Set to draw diagnostic plots of the merged trials
+                        into plots/Diagnostic_SAVE.pdf, in the background
+                        without blocking the run. SELECTION picks the trials:
+                        all (default), overflow (best fit at the top of the
+                        flux range), outside (true flux outside the 0.5
+                        log-likelihood interval of the peak) or random:N (N
+                        random trials). Needs --interp.
   --bias [BIAS [BIAS ...]]
                         Set to correct bias of the following files.
   --hide                Set to not show the plots.
   --unblinded           Set to get the p-value of the unblinded data.
   --save [SAVE]         Set to save the most usefull plots with SAVE as a filename extension.
+  --merged [MERGED]     Set to also write the merged trials of all files to
+                        MERGED.
+  --jobs JOBS           Number of processes sharing the trials in
+                        interpolation mode.
+  --cache               Set to reuse parsed files and merged trials from
+                        previous runs with the same inputs and options.
+  --bootstrap BOOTSTRAP
+                        Number of bootstrap replicas used to give intervals
+                        on the sensitivity, upper limit and p-value.
+  --chunk CHUNK         Number of trials processed at a time, so that memory
+                        does not grow with the number of trials. The merged
+                        trials go through MERGED, or a temporary file. Not
+                        compatible with --diagnostic, --jobs, --cache and
+                        --bootstrap. 0 keeps everything in memory.
+  --all-subsets         Set to get the sensitivity of every combination of the
+                        files, each file being read and interpolated once,
+                        and print a table comparing them. Not compatible with
+                        --chunk.
+  --belt [CL [CL ...]]  Set to also get the sensitivity and upper limit at
+                        each confidence level CL (in percent, 68 90 95 99 by
+                        default) from the Neyman belt, all computed at once.
+  --update              Set to only merge the trials appended to the files
+                        since the last run with --update into MERGED, and get
+                        the sensitivity of all merged trials. The biases are
+                        fitted at the first run only. Needs --merged, not
+                        compatible with --chunk and --all-subsets.
+  --advise [PRECISION]  Set to print the statistical errors of the sensitivity
+                        and upper limit, and the number of trials needed at
+                        each flux to reach the relative precision PRECISION
+                        (0.02 by default).
+  --tail                Set to fit the upper tail of the background TS
+                        distribution (zero plus chi-square, and exponential
+                        models), to extrapolate the p-value below one over
+                        the number of background trials and get the 3 and 5
+                        sigma discovery potentials.
+  --profile [PROFILE]   Set to print the time, number of calls and peak
+                        memory of each stage, and to also write them as JSON
+                        to PROFILE if given.
  """
 
 
+import os
 import sys
 import argparse
-from os import system, remove
-from shutil import move
+import tempfile
+import numpy as np
+import merge
+import bias
+import sensitivity
+from results_io import read_results, read_bias, iter_rows, read_merged
+import cache
+import diagnostics
+from trial_table import TrialTable, StreamingTable
+from plotting import close_all
+import profiling
+
+
+def stream_trials(infiles, chunk_size, merged_file, save_name='', interpolate=False, correct_bias=False, hide=False, unblinded=False):
+    """
+    Merged trials of infiles streamed into merged_file chunk_size trials at a time, returned as a StreamingTable reading that file back. None on error.
+    """
+    chunks = merge.merge_chunks(infiles, chunk_size, save_name, interpolate, correct_bias, hide, unblinded)
+    if chunks is None:
+        return None
+    try:
+        merge.write_merged(merged_file, chunks)
+    except ValueError as error:
+        print error
+        return None
+    return StreamingTable(lambda: iter_rows(merged_file, chunk_size))
+
+
+def read_files(infiles, use_cache=False):
+    """
+    Content of each of infiles as returned by read_results, read once for both the bias fits and the merge, and their cache digests (None without use_cache). None on error.
+    """
+    results = []
+    digests = [] if use_cache else None
+    for infile in infiles:
+        try:
+            if use_cache:
+                digests.append(cache.file_digest(infile))
+                results.append(cache.cached_results(infile, digests[-1]))
+            else:
+                results.append(read_results(infile))
+        except IOError:
+            print "Error: Input file {} cannot be opened.".format(infile)
+            return None
+        except ValueError as error:
+            print error
+            return None
+    return results, digests
+
+
+def format_crossing(value, max_flux, digits=3):
+    """A sensitivity or upper limit in the table of compare_subsets: '-' if there is none, '>max_flux' if the erf fit only reaches 90% above the largest true flux."""
+    if np.isnan(value):
+        return '-'
+    if value > max_flux:
+        return '>{:0.{}f}'.format(max_flux, digits)
+    return '{:0.{}f}'.format(value, digits)
 
 
-def main(files, bias_files, save_name, options):
+def compare_subsets(infiles, results, digests, save_name, interpolate, correct_bias, hide, unblinded, use_cache):
+    """
+    Get the sensitivity, and the upper limit and p-value if unblinded, of every combination of the input files, merged in one pass by merge.merge_subsets, and print a table comparing them.  Returns the rows of the table, with the sensitivities and upper limits formatted by format_crossing, or 0 on error.
+    """
+    with profiling.stage('merge subsets'):
+        merged = merge.merge_subsets(infiles, interpolate, correct_bias, unblinded, use_cache=use_cache, results=results, digests=digests)
+    if merged is None:
+        return 0
+    rows = []
+    for subset, data in merged:
+        label = '+'.join(str(i + 1) for i in subset)
+        print '\nSubset {}: {}'.format(label, ', '.join(infiles[i] for i in subset))
+        with profiling.stage('sensitivity'):
+            limits = sensitivity.sensitivity(data, hide, unblinded, save_name and '{}_{}'.format(save_name, label.replace('+', '_')))
+        close_all()
+        if limits is None:
+            return 0
+        table = TrialTable(data[1:] if unblinded else data)
+        null = table.index(0.)
+        max_flux = table.fluxes[-1]
+        row = [label, table.medians(2)[null], format_crossing(limits[0], max_flux)]
+        if unblinded:
+            row += [data[0, 1], data[0, 2], table.fractions_above(data[0, 2], 2)[null] * 100, format_crossing(limits[1], max_flux, 2)]
+        rows.append(row)
+
+    print '\nComparison of the combinations of:'
+    for i, infile in enumerate(infiles):
+        print '[{}] {}'.format(i + 1, infile)
+    columns = ['Subset', 'Median TS', 'Sensitivity']
+    title = '{:<12} {:>10} {:>12}'
+    line = '{:<12} {:>10.3f} {:>12}'
+    if unblinded:
+        columns += ['Fitted flux', 'TS', 'p-value (%)', 'Upper limit']
+        title += ' {:>12} {:>10} {:>12} {:>12}'
+        line += ' {:>12.3f} {:>10.3f} {:>12.2f} {:>12}'
+    print title.format(*columns)
+    for row in rows:
+        print line.format(*row)
+    return rows
+
+
+def main(files, bias_files, save_name, interpolate=False, diagnostic=False, hide=False, unblinded=False, merged_file='', jobs=1, use_cache=False, nboot=0, chunk_size=0, all_subsets=False, levels=None, incremental=False, target=None, tail_fit=False):
     """Get the sensitivity corresponding to the given arguments."""
-    if bias_files:
+    if all_subsets and chunk_size:
+        print 'Error: --all-subsets needs the trials in memory, run without --chunk'
+        return 0
+    if incremental and (not merged_file or chunk_size or all_subsets):
+        print 'Error: --update needs --merged, and is not compatible with --chunk and --all-subsets'
+        return 0
+    if chunk_size and (diagnostic or jobs > 1 or use_cache):
+        print 'Warning: --diagnostic, --jobs and --cache are ignored with --chunk'
+    if diagnostic:
+        try:
+            diagnostics.parse_selection(diagnostic)
+        except ValueError as error:
+            print error
+            return 0
+    scratch = ''
+    if chunk_size and not merged_file:
+        handle, scratch = tempfile.mkstemp(prefix='merged_', suffix='.npy')  # full precision, as in memory
+        os.close(handle)
+    try:
+        return run(files, bias_files, save_name, interpolate, diagnostic, hide, unblinded, merged_file or scratch, jobs, use_cache, nboot, chunk_size, all_subsets, levels, incremental, target, tail_fit)
+    finally:
+        if scratch:
+            os.remove(scratch)
+
+
+def run(files, bias_files, save_name, interpolate, diagnostic, hide, unblinded, merged_file, jobs, use_cache, nboot, chunk_size, all_subsets=False, levels=None, incremental=False, target=None, tail_fit=False):
+    infiles = list(files) + list(bias_files)
+    updating = incremental and os.path.exists(merge.state_file(merged_file))  # the biases were set by a previous run
+    if updating:
+        print 'Updating {}, the biases of the previous runs are kept'.format(merged_file)
+    results = digests = None
+    if not chunk_size and not updating and (bias_files or not incremental):  # every file is read once, its bias is fitted from the arrays in memory
+        with profiling.stage('read'):
+            files_read = read_files(infiles, use_cache)
+        if files_read is None:
+            return 0
+        results, digests = files_read
+
+    if bias_files and not updating:
         print '\nFitting of biases to correct'
-        for bias_file in bias_files:
-            if 'results' in bias_file:
-                merged_file = bias_file.replace('results_', 'merged_')
-            else:
-                merged_file = '/merged_'.join(bias_file.rsplit('/', 1))
-            command = 'ipython merge.py -- ' + bias_file + ' ' + merged_file + options['interp']
-            # print command
-            error = system(command)
-            if error:
-                exit(0)
-            command = 'ipython bias.py -- ' + merged_file + ' ' + bias_file + options['hide'] + bool(save_name)*(" --save "+save_name)
-            # print command
-            error = system(command)
-            if error:
-                exit(0)
-            system('rm ' + merged_file)
-
-    if files: # Removing bias line from files we do not correct
-        for file_ in files:
-            temp_file = 'temporary_file.txt'
-            with open(temp_file, 'w') as tempfile:
-                print 'Removing bias from', file_
-                with open(file_) as oldfile:
-                    for line in oldfile:
-                        if line.find('Bias') == -1:
-                            tempfile.write(line)
-            remove(file_)
-            move(temp_file, file_)
+        for i, bias_file in enumerate(bias_files, len(files)):
+            with profiling.stage('bias correction'):
+                if chunk_size:
+                    data = stream_trials([bias_file], chunk_size, merged_file, interpolate=interpolate)
+                else:
+                    data = merge.merge([bias_file], interpolate=interpolate, jobs=jobs, use_cache=use_cache, results=[results[i]])
+                if data is None:
+                    return 0
+                bias.fit_bias(data, bias_file, [bias_file], save_name, hide)
+                if results is not None:
+                    header, _, unblinded_curve, flux, curves = results[i]
+                    results[i] = header, read_bias(bias_file)['bias'], unblinded_curve, flux, curves
+            close_all()
+
+    correct_bias = [False] * len(files) + [True] * len(bias_files) if bias_files else False  # only the --bias files are corrected
+    if all_subsets:
+        return compare_subsets(infiles, results, digests, save_name, interpolate, correct_bias, hide, unblinded, use_cache)
 
     print '\nMerging and sensitivity'
-    error = system('ipython merge.py -- ' + ' '.join(files) + ' ' + ' '.join(bias_files)
-                   + ' test_data/merged_all.txt' + options['interp'] + ' --bias' * bool(bias_files) + options['unblinded'] 
-                   + options['diagnostic'] + options['hide'] + bool(save_name)*(" --save "+save_name))
-    if error:
-        exit(0)
-    print 'ipython sensitivity.py -- test_data/merged_all.txt' + options['unblinded'] + options['hide'] + bool(save_name)*(" --save "+save_name)
-    error = system('ipython sensitivity.py -- test_data/merged_all.txt' + options['unblinded'] + options['hide'] + bool(save_name)*(" --save "+save_name))
-    if error:
-        exit(0)
-
-    command = 'ipython bias.py -- test_data/merged_all.txt ' + options['hide'] + bool(save_name)*(" --save "+save_name)
-    # print command
-    error = system(command)
-    system('rm test_data/merged_all.txt')
+    with profiling.stage('merge'):
+        if incremental:
+            data = None
+            if merge.update(infiles, merged_file, interpolate, correct_bias, unblinded, jobs) is not None:
+                data = read_merged(merged_file)
+        elif chunk_size:
+            data = stream_trials(infiles, chunk_size, merged_file, save_name, interpolate, correct_bias, hide, unblinded)
+        else:
+            data = merge.merge(infiles, save_name, interpolate, diagnostic, correct_bias, hide, unblinded, jobs, use_cache=use_cache, results=results, digests=digests)
+    if data is None:
+        return 0
+    if merged_file and not chunk_size and not incremental:
+        with profiling.stage('write merged', len(data)):
+            merge.write_merged(merged_file, data)
+    close_all()
+    with profiling.stage('sensitivity'):
+        if sensitivity.sensitivity(data, hide, unblinded, save_name, nboot, levels, target, tail_fit) is None:
+            return 0
+    close_all()
+
+    with profiling.stage('bias'):
+        bias.fit_bias(data, 'merged_all', None, save_name, hide)
+    close_all()
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description=__doc__,)
@@ -106,9 +288,12 @@ if __name__ == "__main__":
     # Diagnostic flag
     parser.add_argument(
         '--diagnostic',
-        default=False,
-        action="store_true",
-        help='Set to run special diagnostics to visualize results. You may have to force quit the process if you don\'t want to go through all trials.')
+        nargs="?",
+        default=None,
+        const='all',
+        metavar='SELECTION',
+        type=str,
+        help='Set to draw diagnostic plots of the merged trials into plots/Diagnostic_SAVE.pdf, in the background without blocking the run. SELECTION picks the trials: all (default), overflow (best fit at the top of the flux range), outside (true flux outside the 0.5 log-likelihood interval of the peak) or random:N (N random trials). Needs --interp.')
 
     # Bias correction flag
     parser.add_argument(
@@ -140,19 +325,100 @@ if __name__ == "__main__":
         type=str,
         help='Set to save the most usefull plots with SAVE as a filename extension.')
 
+    # Merged trials output
+    parser.add_argument(
+        '--merged',
+        nargs="?",
+        default='',
+        type=str,
+        help='Set to also write the merged trials of all files to MERGED.')
+
+    # Parallel interpolation
+    parser.add_argument(
+        '--jobs',
+        default=1,
+        type=int,
+        help='Number of processes sharing the trials in interpolation mode.')
+
+    # Cache flag
+    parser.add_argument(
+        '--cache',
+        default=False,
+        action="store_true",
+        help='Set to reuse parsed files and merged trials from previous runs with the same inputs and options.')
+
+    # Bootstrap replicas
+    parser.add_argument(
+        '--bootstrap',
+        default=0,
+        type=int,
+        help='Number of bootstrap replicas used to give intervals on the sensitivity, upper limit and p-value.')
+
+    # Streaming
+    parser.add_argument(
+        '--chunk',
+        default=0,
+        type=int,
+        help='Number of trials processed at a time, so that memory does not grow with the number of trials. The merged trials go through MERGED, or a temporary file. Not compatible with --diagnostic, --jobs, --cache and --bootstrap. 0 keeps everything in memory.')
+
+    # Combinations of the files
+    parser.add_argument(
+        '--all-subsets',
+        default=False,
+        action="store_true",
+        help='Set to get the sensitivity of every combination of the files, each file being read and interpolated once, and print a table comparing them. Not compatible with --chunk.')
+
+    # Confidence belt
+    parser.add_argument(
+        '--belt',
+        nargs="*",
+        default=None,
+        type=float,
+        metavar='CL',
+        help='Set to also get the sensitivity and upper limit at each confidence level CL (in percent, 68 90 95 99 by default) from the Neyman belt, all computed at once.')
+
+    # Incremental merge
+    parser.add_argument(
+        '--update',
+        default=False,
+        action="store_true",
+        help='Set to only merge the trials appended to the files since the last run with --update into MERGED, and get the sensitivity of all merged trials. The biases are fitted at the first run only. Needs --merged, not compatible with --chunk and --all-subsets.')
+
+    # Trial budget
+    parser.add_argument(
+        '--advise',
+        nargs="?",
+        default=None,
+        const=0.02,
+        type=float,
+        metavar='PRECISION',
+        help='Set to print the statistical errors of the sensitivity and upper limit, and the number of trials needed at each flux to reach the relative precision PRECISION (0.02 by default).')
+
+    # Tail fit
+    parser.add_argument(
+        '--tail',
+        default=False,
+        action="store_true",
+        help='Set to fit the upper tail of the background TS distribution (zero plus chi-square, and exponential models), to extrapolate the p-value below one over the number of background trials and get the 3 and 5 sigma discovery potentials.')
+
+    # Profiling flag
+    parser.add_argument(
+        '--profile',
+        nargs="?",
+        default=None,
+        const='',
+        type=str,
+        help='Set to print the time, number of calls and peak memory of each stage, and to also write them as JSON to PROFILE if given.')
+
     args = parser.parse_args()
     if args.bias:
         args.interp = True
 
-    options = {'interp': ' --interp' * args.interp,
-               'diagnostic': ' --diagnostic' * args.diagnostic,
-               'hide': ' --hide' * args.hide,
-               'unblinded': ' --unblinded' * args.unblinded}
-
-    if len(sys.argv) >= 2 and not (args.hide and args.diagnostic):
-        main(args.files, args.bias, args.save, options)
-    elif args.hide and args.diagnostic:
-        print 'You should not set hide and diagnostic at the same time'
-        print 'Exiting...'
+    if args.profile is not None:
+        profiling.enable()
+    if len(sys.argv) >= 2:
+        main(args.files, args.bias, args.save, args.interp, args.diagnostic, args.hide, args.unblinded, args.merged, args.jobs, args.cache, args.bootstrap, args.chunk, args.all_subsets, args.belt, args.update, args.advise, args.tail)
+        diagnostics.finish()
+        profiling.report(args.profile)
     else:
         parser.print_help()
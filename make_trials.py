@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+r"""
+Generate synthetic results files, one per experiment, in the text format read by merge.py.  Every trial is a parabolic log-likelihood ratio curve around a best-fit flux drawn with a Gaussian resolution around the true flux, so that the whole chain (merge.py, bias.py, sensitivity.py, shuffle.py, ntrials.py) can be run and timed on any number of trials.
+"""
+
+r"""
+usage: make_trials.py [-h] [--trials TRIALS] [--fluxes FLUXES]
+                      [--max-flux MAX_FLUX] [--edges EDGES]
+                      [--experiments EXPERIMENTS] [--bias [BIAS]]
+                      [--unblinded] [--seed SEED] [--profile [PROFILE]]
+                      [prefix]
+
+positional arguments:
+  prefix                Prefix of the output files, written as
+                        PREFIX_1.txt, PREFIX_2.txt...
+
+optional arguments:
+  -h, --help            show this help message and exit
+  --trials TRIALS       Number of trials per true flux.
+  --fluxes FLUXES       Number of true fluxes, evenly spaced from 0 to 2/3 of
+                        the maximum flux.
+  --max-flux MAX_FLUX   Upper edge of the flux range of the curves.
+  --edges EDGES         Number of flux values sampled by every curve.
+  --experiments EXPERIMENTS
+                        Number of files to generate.
+  --bias [BIAS]         Set to scale the fitted fluxes by BIAS and write the
+                        'Bias fitted by' line.
+  --unblinded           Set to write an 'Unblinded' line.
+  --seed SEED           Seed of the random generator.
+  --profile [PROFILE]   Set to print the time, number of calls and peak memory
+                        of each stage, and to also write them as JSON to
+                        PROFILE if given.
+"""
+
+import argparse
+import numpy as np
+from results_io import write_text
+import profiling
+
+RESOLUTION = 1.2  # Flux resolution of the first experiment, the others are worse by 25% each
+
+
+def make_curves(true_fluxes, flux_max, n_edges, resolution, bias, rng):
+    """
+    One log-likelihood ratio curve per true flux, sampled at n_edges fluxes from 0 to flux_max.  The best-fit flux is drawn with the given resolution and scaled by bias.
+    """
+    xs = np.linspace(0., flux_max, n_edges) / bias
+    fitted = rng.normal(true_fluxes, resolution)
+    return (np.outer(fitted, xs) - xs ** 2 / 2.) / resolution ** 2  # zero at null flux, maximum at bias * fitted
+
+
+def main(prefix, ntrials=1000, nfluxes=9, flux_max=3., n_edges=31, nexperiments=3, bias=None, unblinded=False, seed=None):
+    """
+    Write nexperiments synthetic results files and return their names.
+    """
+    rng = np.random.RandomState(seed)
+    true_fluxes = np.repeat(np.linspace(0., flux_max * 2. / 3., nfluxes), ntrials)
+    outfiles = []
+    for experiment in range(nexperiments):
+        resolution = RESOLUTION * (1. + 0.25 * experiment)
+        with profiling.stage('make curves', len(true_fluxes)):
+            curves = make_curves(true_fluxes, flux_max, n_edges, resolution, bias or 1., rng)
+            unblinded_curve = None
+            if unblinded:
+                unblinded_curve = make_curves(np.zeros(1), flux_max, n_edges, resolution, bias or 1., rng)[0]
+        outfile = '{}_{}.txt'.format(prefix, experiment + 1)
+        try:
+            with profiling.stage('write', len(true_fluxes)):
+                write_text(outfile, (0., flux_max, n_edges), bias, unblinded_curve, true_fluxes, curves)
+        except IOError:
+            print "Error: Unable to open output file {}.".format(outfile)
+            return None
+        outfiles.append(outfile)
+    return outfiles
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__,)
+
+    parser.add_argument(
+        "prefix",
+        nargs="?",
+        default='results_synthetic',
+        type=str,
+        help="Prefix of the output files, written as PREFIX_1.txt, PREFIX_2.txt...")
+
+    parser.add_argument(
+        '--trials',
+        default=1000,
+        type=int,
+        help='Number of trials per true flux.')
+
+    parser.add_argument(
+        '--fluxes',
+        default=9,
+        type=int,
+        help='Number of true fluxes, evenly spaced from 0 to 2/3 of the maximum flux.')
+
+    parser.add_argument(
+        '--max-flux',
+        default=3.,
+        type=float,
+        help='Upper edge of the flux range of the curves.')
+
+    parser.add_argument(
+        '--edges',
+        default=31,
+        type=int,
+        help='Number of flux values sampled by every curve.')
+
+    parser.add_argument(
+        '--experiments',
+        default=3,
+        type=int,
+        help='Number of files to generate.')
+
+    parser.add_argument(
+        '--bias',
+        nargs="?",
+        default=None,
+        const=1.15,
+        type=float,
+        help='Set to scale the fitted fluxes by BIAS and write the \'Bias fitted by\' line.')
+
+    parser.add_argument(
+        '--unblinded',
+        default=False,
+        action="store_true",
+        help='Set to write an \'Unblinded\' line.')
+
+    parser.add_argument(
+        '--seed',
+        default=None,
+        type=int,
+        help='Seed of the random generator.')
+
+    # Profiling flag
+    parser.add_argument(
+        '--profile',
+        nargs="?",
+        default=None,
+        const='',
+        type=str,
+        help='Set to print the time, number of calls and peak memory of each stage, and to also write them as JSON to PROFILE if given.')
+
+    args = parser.parse_args()
+    if args.profile is not None:
+        profiling.enable()
+    main(args.prefix, args.trials, args.fluxes, args.max_flux, args.edges, args.experiments, args.bias, args.unblinded, args.seed)
+    profiling.report(args.profile)
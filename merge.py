@@ -1,12 +1,18 @@
 #!/usr/bin/env python
 
 r"""
-Merge two or more sets of files representing log-likelihood vs flux. Each trial's original flux, joint best-fit flux, and max TS are written to std output with line break.  Assumes input files will have a header of 3 numbers: minimum flux, maximum flux, number of sample points. If the header is preceded by the bias, it will be corrected if the --bias option is used. The following lines are assumed to start with the flux and then nsamples of the log-likelihood function.  Option to interpolate between sampling points or use straight sum at sampling points, in which case the flux range and number of sample must match.
+Merge two or more sets of files representing log-likelihood vs flux. Each trial's original flux, joint best-fit flux, and max TS are written to std output with line break.  Assumes input files will have a header of 3 numbers: minimum flux, maximum flux, number of sample points. If the header is preceded by the bias, it will be corrected if the --bias option is used. The following lines are assumed to start with the flux and then nsamples of the log-likelihood function.  Trials are paired by true flux: the k-th trial at a given flux in one file is merged with the k-th trial at that flux in the others, whatever the order of the files, and only as many trials per flux as in the file with the fewest are used.  Option to interpolate between sampling points or use straight sum at sampling points, in which case the flux range and number of sample must match.
+
+With --jobs the interpolation is split across processes, and with --cache parsed files and merged trials are reused from the cache of cache.py.  get_sensitivity.py passes the files it already read to merge() and merge_subsets(), with their cache digests, and gives the bias flag per file, since only its --bias files are corrected.
+
+With --update, only the trials appended to the input files since the last update are merged and added at the end of the output file.  OUTPUT.state.npz keeps the position up to which each file was read, the trials read but not paired yet (their flux is missing from another file, or another file has fewer trials at that flux), the number of merged trials at each flux and the size and number of trials of the output, so that the output ends up with the same rows as a full merge, in the order of the updates.
 """
 
 r"""
-usage: merge.py [-h] [--interp] [--diagnostic] [--bias] [--unblinded] [--hide]
-                [--save [SAVE]]
+usage: merge.py [-h] [--interp] [--diagnostic [SELECTION]] [--bias]
+                [--unblinded] [--hide] [--save [SAVE]] [--jobs JOBS] [--cache]
+                [--chunk CHUNK] [--digits DIGITS] [--update]
+                [--profile [PROFILE]]
                 [files [files ...]]
 
 positional arguments:
@@ -18,228 +24,791 @@ optional arguments:
   --interp       Set to interpolate between sample points using linear
                  interpolation. Should be used for bias correction. Leave
                  unset for naive summing at grid points.
-  --diagnostic   Set to run special diagnostics to visualize results. You may
-                 have to force quit the process if you don't want to go
-                 through all trials.
+  --diagnostic [SELECTION]
+                 Set to draw diagnostic plots of the merged trials into
+                 plots/Diagnostic_SAVE.pdf, in the background without
+                 blocking the run. SELECTION picks the trials: all
+                 (default), overflow (best fit at the top of the flux
+                 range), outside (true flux outside the 0.5 log-likelihood
+                 interval of the peak) or random:N (N random trials). Needs
+                 --interp.
   --bias         Set to correct bias from a datafile output of bias.py.
   --unblinded    Set to get the p-value of the unblinded data.
   --hide         Set to not show the plots.
   --save [SAVE]  Set to save the most usefull plots with SAVE as a filename
                  extension.
+  --jobs JOBS    Number of processes sharing the trials in interpolation mode.
+  --cache        Set to reuse parsed files and merged trials from previous
+                 runs with the same inputs and options.
+  --chunk CHUNK  Number of trials read and merged at a time, so that memory
+                 does not grow with the number of trials. Not compatible
+                 with --diagnostic, --jobs and --cache. 0 reads whole files.
+  --digits DIGITS
+                 Number of significant digits of the merged trials written
+                 as text. An output file ending with .npy is written in
+                 binary with full precision instead.
+  --update       Set to only merge the trials appended to the input files
+                 since the last run with --update, and add them to the
+                 output file. How far each input was read is kept in
+                 OUTPUT.state.npz. Not compatible with --diagnostic, --cache
+                 and --chunk.
+  --profile [PROFILE]
+                 Set to print the time, number of calls and peak memory of
+                 each stage, and to also write them as JSON to PROFILE if
+                 given.
 """
 
+import os
 import sys
+import json
 import argparse
+from itertools import chain, combinations, izip
+from multiprocessing import Pool
 import numpy as np
-import matplotlib.pyplot as plt
-from scipy.interpolate import UnivariateSpline
+from scipy.interpolate import make_interp_spline
+from results_io import MERGED_DIGITS, read_results, read_header, read_appended, read_fluxes, iter_results, writable
+import results_io
+import cache
+import diagnostics
+import profiling
+from plotting import wanted, pyplot
 
 # Flux are in units [1/GeV/cm^2/s] or scaling factors relative to a specified model
 # And the joint TS should be log( likelihood ) [unitless]
 
 
-def main(files, save_name, interpolate=False, diagnostic=False, bias=False, hide=False, unblinded=False):
-    infiles = files[:-1]  # All but the last argument are input files
-    outfile = files[-1]  # Last argument is the output file
-    fs = []  # input file handles
+_shared = {}  # arrays of the merge in progress, inherited by the processes of the --jobs pool
+_operators = {}  # interpolation matrices by method, sample points and evaluation points
+POLY_DEGREE = 5  # degree of the polynomial fitted in fit_poly mode
+SPLINE_ORDER = 2  # degree of the spline polynomials in spline mode
+DIAGNOSTIC_BLOCK = 1024  # trials interpolated at a time for the diagnostic plots
+STATE_SUFFIX = '.state.npz'  # state of the --update merges, next to the merged file
+
+
+def interpolate_trial(lines, xps, xs, interp_opt):
+    """
+    Interpolate the llh curves of one trial, sampled at the points xps of each file, onto the points xs. Returns the summed curve and the interpolation of each file.
+    """
+    sum_array = np.zeros(len(xs))
+    interps = []
+    for xp, line in zip(xps, lines):
+        interp = np.dot(line, interp_operator(xp, xs, interp_opt))
+        interps.append(interp)
+        sum_array += interp
+    return sum_array, interps
+
+
+def interp_operator(xp, xs, interp_opt):
+    """
+    Matrix W such that np.dot(curves, W) interpolates every row of curves, sampled at the points xp, onto the points xs. All the methods are linear in the curve, so a file (a grid and a bias factor) needs a single matrix for all its trials, which is cached.
+    """
+    key = (interp_opt, xp.tostring(), xs.tostring())
+    if key not in _operators:
+        if interp_opt == 'linear':
+            _operators[key] = interp_matrix(xp, xs)
+        elif interp_opt == 'fit_poly':
+            # Least-squares polynomial of degree POLY_DEGREE, shifted to be null at null flux
+            V = np.vander(xp, POLY_DEGREE + 1)
+            _operators[key] = np.dot(np.linalg.pinv(V).T, (np.vander(xs, POLY_DEGREE + 1) - np.vander([0.], POLY_DEGREE + 1)).T)
+        elif interp_opt == 'spline':
+            # NB: The spline must go through the sample points so that the interpolation does not 'miss' the point (0,0).
+            # Otherwise numerical noise near (0,0) dominates the measurement of the median of background-only trials!
+            # Its knots are sample points, so the joint curve stays quadratic between the sample points of the files.
+            knots = np.r_[(xp[0],) * (SPLINE_ORDER + 1), xp[2:-1], (xp[-1],) * (SPLINE_ORDER + 1)]
+            _operators[key] = make_interp_spline(xp, np.eye(len(xp)), k=SPLINE_ORDER, t=knots)(xs).T
+    return _operators[key]
+
+
+def interp_matrix(xp, xs):
+    """
+    Matrix W such that np.dot(curves, W) gives np.interp(xs, xp, curve) for every row of curves.
+    """
+    W = np.zeros((len(xp), len(xs)))
+    k = np.clip(np.searchsorted(xp, xs, side='right') - 1, 0, len(xp) - 2)  # segment of each point
+    t = np.clip((xs - xp[k]) / (xp[k + 1] - xp[k]), 0., 1.)  # constant outside of xp, as np.interp
+    columns = np.arange(len(xs))
+    W[k, columns] = 1. - t
+    W[k + 1, columns] += t
+    return W
+
+
+def interpolate_curves(curves, xp, xs, interp_opt):
+    """
+    Interpolate every row of curves, sampled at the points xp of one file, onto the points xs, with one matrix product.
+    """
+    return np.dot(curves, interp_operator(xp, xs, interp_opt))
+
+
+def find_peaks(points, values):
+    """
+    Maximum of each row of values, sampled at the ends (points[::2]) and middles (points[1::2]) of segments, from the parabola through the three samples of each segment.  This is the exact maximum for the linear and spline interpolations, which are at most quadratic on every segment, and an approximation of it for fit_poly, whose polynomial is not.  Returns the flux and value at the maximum of each row.
+    """
+    rows = np.arange(len(values))
+    best = np.argmax(values, axis=1)
+    maxfluxes = points[best]
+    maxllhs = values[rows, best]
+
+    # Parabola f0 + b*t + c*t^2 through the start, middle and end of each segment, t in [0, 1]
+    f0 = values[:, :-2:2]
+    fm = values[:, 1::2]
+    f1 = values[:, 2::2]
+    c = 2. * (f0 - 2. * fm + f1)
+    b = f1 - f0 - c
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = -b / (2. * c)
+        top = np.where((c < 0) & (t > 0) & (t < 1), f0 - b ** 2 / (4. * c), -np.inf)
+    segment = np.argmax(top, axis=1)
+    inside = top[rows, segment] > maxllhs  # vertex higher than every sample point
+    starts = points[:-2:2][segment]
+    ends = points[2::2][segment]
+    maxfluxes = np.where(inside, starts + t[rows, segment] * (ends - starts), maxfluxes)
+    maxllhs = np.where(inside, top[rows, segment], maxllhs)
+    return maxfluxes, maxllhs
+
+
+def find_interval(points, values, thresholds, maxfluxes):
+    """
+    Fluxes where each row of values first rises above and last falls below its threshold, linearly interpolated between the points.
+    """
+    rows = np.arange(len(values))
+    above = values > thresholds[:, None]
+    first = np.argmax(above, axis=1)
+    last = len(points) - 1 - np.argmax(above[:, ::-1], axis=1)
+
+    def crossing(below, over):
+        with np.errstate(divide='ignore', invalid='ignore'):  # unused where below == over
+            fraction = (thresholds - values[rows, below]) / (values[rows, over] - values[rows, below])
+            return points[below] + fraction * (points[over] - points[below])
+
+    lowflux = np.where(first > 0, crossing(np.maximum(first - 1, 0), first), points[0])
+    highflux = np.where(last < len(points) - 1, crossing(np.minimum(last + 1, len(points) - 1), last), points[-1])
+    found = above.any(axis=1)  # otherwise the peak is narrower than the sampling
+    return np.where(found, lowflux, maxfluxes), np.where(found, highflux, maxfluxes)
+
+
+def _merge_range(bounds):
+    """
+    Interpolate and maximize the trials in range(*bounds) of the merge stored in _shared. Returns their best-fit fluxes, max TS and whether each true flux lies within 0.5 log-likelihood of the peak.
+    """
+    start, stop = bounds
+    ds = _shared['ds']
+    points = _shared['points']
+    with profiling.stage('interpolate', stop - start):
+        sum_array = np.zeros((stop - start, len(points)))
+        for curves, xp in zip(ds, _shared['xps']):
+            sum_array += interpolate_curves(curves[start:stop], xp, points, _shared['interp_opt'])
+    return _peaks(points, sum_array, _shared['trueflux'][start:stop])
+
+
+def _peaks(points, sum_array, trueflux):
+    """
+    Best-fit fluxes and max TS of the joint curves sum_array sampled at points, and whether each true flux lies within 0.5 log-likelihood of the peak.
+    """
+    # Find max log-likelihood and the corresponding flux
+    with profiling.stage('find peaks', len(sum_array)):
+        maxfluxes, maxllhs = find_peaks(points, sum_array)
+    # Check if true flux is contained within 1.0 of the peak (corresponding to 0.5 in log-likelihood ratio).
+    with profiling.stage('find interval', len(sum_array)):
+        lowflux, highflux = find_interval(points, sum_array, maxllhs - 1.0, maxfluxes)
+    return maxfluxes, maxllhs, (lowflux < trueflux) & (trueflux < highflux)
+
+
+def plot_trial(xs, interps, sum_array, lines, maxflux, maxllh, save_name, hide):
+    """Draw the interpolated curve of each file and their combination for one trial."""
+    plt = pyplot(not hide)
+    draw_trial(plt, xs, interps, sum_array, maxflux, maxllh)
+    coarse_sum_array = np.zeros(len(lines[0]))
+    for line in lines:
+        # if not unblinded:
+        #     plt.plot(x, line, 'ko', ms=3, alpha=0.6)
+        coarse_sum_array += line
+    # if not unblinded:
+    #     plt.plot(x, coarse_sum_array, 'ko', ms=5)
+    if save_name:
+        plt.savefig('plots/FitUnblinding_'+save_name+'.pdf')
+    if not hide:
+        plt.show()
+
+
+def draw_trial(plt, xs, interps, sum_array, maxflux, maxllh, title=''):
+    """Figure of the interpolated curve of each file and their combination for one trial, with the best fit."""
+    figure = plt.figure()
+    color = ['green', 'orange', 'r']
+    experiment = ['IceCube tracks', 'ANTARES showers', 'ANTARES tracks']
+    for index, interp in enumerate(interps):
+        plt.plot(xs, interp, color=color[index % len(color)], lw=3, alpha=0.7,
+                 label=experiment[index] if index < len(experiment) else 'File {}'.format(index + 1))
+    plt.plot(xs, sum_array, 'black', lw=3, label='Combination')
+    plt.legend(loc=8)
+    if title:
+        plt.title(title)
+    plt.xlabel(r"$\Phi_{KRA\gamma}$", fontsize=20)
+    plt.ylabel("log-likelihood ratio", fontsize=19)
+    ax = plt.gca()
+    ymin, ymax = ax.get_ylim()
+    xmin, xmax = ax.get_xlim()
+    plt.plot([maxflux, maxflux], [ymin, maxllh], '--', color='silver', lw=1.5)
+    plt.plot([0.0, maxflux], [maxllh, maxllh], '--', color='silver', lw=1.5)
+    # ax.text(0.15, 0.15, '(max flux, max llh) = ({:0.2}, {:0.2})'.format(maxflux, maxllh), verticalalignment='top', horizontalalignment='left', transform=ax.transAxes, color='g', fontsize=18)
+    ax.text(0.06, 0.06, 'Fitted flux', verticalalignment='top', horizontalalignment='left', transform=ax.transAxes, color='k', fontsize=18)
+    ax.text(0.0, 0.87, r'TS$_{comb}$', verticalalignment='bottom', horizontalalignment='left', transform=ax.transAxes, color='k', fontsize=18)
+    plt.axis([xmin,xmax*2./3.,ymin/2,ymax])
+    plt.axhline(0, color='k')
+    return figure
+
+
+def _corrected(bias, i):
+    """Whether the bias of the i-th input file is corrected, bias being one flag for all the files or a list of one flag per file."""
+    return bias[i] if isinstance(bias, (list, tuple)) else bias
+
+
+def _sample_points(header, bs, bias):
+    """
+    Sample points of each file, corrected by its bias factor if bias is set, and the points where the joint curve is evaluated in interpolation mode.
+    """
+    flux_min, flux_max, nsamples = header
+    x = np.linspace(flux_min, flux_max, nsamples)
+    if bias:
+        xps = [x / a_ for a_ in bs]  # sample points of each file corrected by its bias
+    else:
+        xps = [x for a_ in bs]
+    # Between two sample points of any file (the spline knots are among them) the linear and spline joint curves are
+    # at most quadratic, so sampling them at the ends and middle of each such segment is enough to solve for their
+    # exact maximum.  The fit_poly curves are only approximated by a parabola on each segment.
+    breaks = np.union1d(np.concatenate(xps), [flux_min, flux_max])
+    breaks = breaks[(breaks >= flux_min) & (breaks <= flux_max)]
+    points = np.zeros(2 * len(breaks) - 1)
+    points[::2] = breaks
+    points[1::2] = (breaks[:-1] + breaks[1:]) / 2.
+    return xps, points
+
+
+def _maximize(ds, trueflux, header, interpolate, xps=None, points=None, interp_opt='linear', jobs=1):
+    """
+    Best-fit flux and max TS of the joint curve of every trial of the curves ds, and whether the true flux of each trial lies within 0.5 log-likelihood of the peak (only in interpolation mode, always False otherwise).
+    """
+    ntrials = len(trueflux)
+    flux_min, flux_max, nsamples = header
+    if interpolate:
+        #print('Finding max by interpolating between grid points...')
+        # Workers forked by the pool inherit these arrays instead of receiving pickled copies
+        _shared.update(ds=ds, trueflux=trueflux, xps=xps, points=points, interp_opt=interp_opt)
+        for xp in xps:  # cached before the workers are forked
+            interp_operator(xp, points, interp_opt)
+        if jobs > 1:
+            edges = np.linspace(0, ntrials, 4 * jobs + 1).astype(int)  # a few chunks per worker to balance the load
+            pool = Pool(jobs)
+            results = pool.map(_merge_range, zip(edges[:-1], edges[1:]))
+            pool.close()
+            pool.join()
+        else:
+            results = [_merge_range((0, ntrials))]
+        _shared.clear()
+        maxfluxes = np.concatenate([result[0] for result in results])
+        maxllhs = np.concatenate([result[1] for result in results])
+        return maxfluxes, maxllhs, np.concatenate([result[2] for result in results])
+    #print('Finding max by summing grid points...')
+    # All trials at once: one (ntrials x nsamples) array add per file
+    sum_array = np.zeros((ntrials, nsamples))
+    for curves in ds:
+        sum_array += curves
+    return _grid_peaks(sum_array, header)
+
+
+def _grid_peaks(sum_array, header):
+    """Best-fit fluxes and max TS of the joint curves sum_array at the grid points of header, as _maximize returns them."""
+    flux_min, flux_max, nsamples = header
+    # Find max log-likelihood
+    maxllhs = np.max(sum_array, axis=1)
+    # Translate max array index into max flux:
+    maxfluxes = np.argmax(sum_array, axis=1) * (flux_max - flux_min) / nsamples
+    return maxfluxes, maxllhs, np.zeros(len(sum_array), dtype=bool)
+
+
+def join_trials(fluxes, infiles, verbose=True):
+    """Pair the trials of the files, given by their true fluxes, and return the true flux of the paired trials, in the order of the first file, and the indices of the paired trials of each file."""
+    values = reduce(np.intersect1d, [np.unique(flux) for flux in fluxes])
+    missing = np.setdiff1d(np.unique(np.concatenate(fluxes)), values)
+    if len(missing) and verbose:
+        print 'Warning: Fluxes {} are not in all files, their trials are ignored'.format(missing)
+    counts = None
+    groups = []  # stable order by flux and start of each common flux, for each file
+    for flux in fluxes:
+        order = np.argsort(flux, kind='mergesort')
+        sorted_flux = flux[order]
+        starts = np.searchsorted(sorted_flux, values)
+        group_counts = np.searchsorted(sorted_flux, values, side='right') - starts
+        counts = group_counts if counts is None else np.minimum(counts, group_counts)
+        groups.append((order, starts))
+    trueflux = np.repeat(values, counts)
+    ranks = np.arange(len(trueflux)) - np.repeat(np.cumsum(counts) - counts, counts)  # rank of each pair within its flux
+    indices = [order[np.repeat(starts, counts) + ranks] for order, starts in groups]
+    first_order = np.argsort(indices[0], kind='mergesort')
+    indices = [index[first_order] for index in indices]
+    for infile, flux, index in zip(infiles, fluxes, indices):
+        if len(index) < len(flux) and verbose:
+            print 'Pairing trials by true flux: {} of the {} trials of {} are used'.format(len(index), len(flux), infile)
+    return trueflux[first_order], indices
+
+
+def render_trials(plotted, ds, trueflux, maxfluxes, maxllhs, xps, points, interp_opt, outfile):
+    """
+    Send the trials of indices plotted to a diagnostics worker drawing them into outfile, a block of trials interpolated at a time.
+    """
+    print 'Drawing {} diagnostic trials in {} in the background'.format(len(plotted), outfile)
+    if not len(plotted):
+        return
+    send = diagnostics.start(outfile, draw_trial)
+    for start in range(0, len(plotted), DIAGNOSTIC_BLOCK):
+        block = plotted[start:start + DIAGNOSTIC_BLOCK]
+        interps = [interpolate_curves(curves[block], xp, points, interp_opt) for curves, xp in zip(ds, xps)]
+        for row, trial in enumerate(block):
+            title = 'Trial {}: true flux {:.3g}, best fit {:.3g}, TS {:.3g}'.format(trial, trueflux[trial], maxfluxes[trial], maxllhs[trial])
+            curves = [interp[row] for interp in interps]
+            send((points, curves, np.sum(curves, axis=0), maxfluxes[trial], maxllhs[trial], title))
+
+
+def _print_summary(flux_max, overflow_count, ntrials, interpolate, count_correct):
+    print 'Best-fit flux found to be with 5% of the top of the flux range {} a total of {} times out of {}'.format(flux_max, overflow_count, ntrials)
+    if interpolate:
+        print 'True flux contained within 0.5 log-likelihood of the peak in {:0.1f} percent of the trials'.format(100. * count_correct / ntrials)
+
+
+def _read_inputs(infiles, interpolate, bias, unblinded, use_cache=False, results=None, digests=None):
+    """
+    Read the input files, or take their content from results, and pair their trials by true flux.  Returns the headers, bias factors and paired curves of the files, the true flux of the paired trials and the digests of the files for the cache (those given, if any), or None on error.
+    """
+    known_digests = digests
+    fluxes = []  # true flux of each trial, for each input file
+    ds = []  # llh curves of each input file
     hs = []  # headers
     bs = []  # bias
-    for infile in infiles: # Store filenames, headers and biases
+    digests = []  # content hashes for the cache
+    for i, infile in enumerate(infiles): # Store headers, biases and trials
         try:
-            fs.append(open(infile, 'r'))  # keep a list of the open files
-            hs.append(fs[-1].readline().split())  # append header of the last file opened...
-            if 'Bias' in hs[-1]:				 # ... if the first line is the bias, get the header from the second line.
-                bs.append(hs.pop())  # append bias of the last file opened
-                hs.append(fs[-1].readline().split())
-                if bias:
-                    print 'Correction of bias for', infile
-            else:
-                bs.append(['Bias', 'fitted', 'by:', '1', '*', 'x'])  # If no bias in the file, put no bias
+            with profiling.stage('read'):
+                if use_cache:
+                    digests.append(known_digests[i] if known_digests else cache.file_digest(infile))
+                if results is not None:
+                    header, bias_factor, unblinded_curve, flux, curves = results[i]
+                elif use_cache:
+                    header, bias_factor, unblinded_curve, flux, curves = cache.cached_results(infile, digests[-1])
+                else:
+                    header, bias_factor, unblinded_curve, flux, curves = read_results(infile)
         except IOError:
             print "Error: Input file {} cannot be opened.".format(infile)
-            return 0
-    try:
-        of = open(outfile, 'w')
-    except IOError:
-        print "Error: Unable to open output file {}.".format(outfile)
-        return 0
+            return None
+        except ValueError as error:
+            print error
+            return None
+        if bias_factor is None or not _corrected(bias, i):
+            bias_factor = 1.  # If no bias in the file, or not corrected, put no bias
+        else:
+            print 'Correction of bias for', infile
+        if unblinded:
+            if unblinded_curve is None:
+                print 'Error: No unblinded data for file', infile
+                return None
+            flux = np.concatenate([[-1.], flux])  # Replace 'unblinded' by -1
+            curves = np.vstack([unblinded_curve, curves])
+        hs.append(header)
+        bs.append(bias_factor)
+        fluxes.append(flux)
+        ds.append(curves)
+    for header in hs:  # Check that all headers match the first file
+        if header != hs[0] and not interpolate:
+            print 'Error: Trying non-interpolation combination of files with different sampling definitions.  Set the --interp flag if desired.'
+            return None
 
+    with profiling.stage('join'):
+        trueflux, indices = join_trials(fluxes, infiles)
+    ntrials = len(trueflux)
+    if not ntrials:
+        print 'Error: No true flux is common to all files.'
+        return None
+    for i, index in enumerate(indices):
+        if np.array_equal(index, np.arange(ntrials)):  # aligned file, keep a view rather than a copy
+            ds[i] = ds[i][:ntrials]
+        else:
+            ds[i] = ds[i][index]
+    return hs, bs, ds, trueflux, digests
+
+
+def merge(infiles, save_name='', interpolate=False, diagnostic=False, bias=False, hide=False, unblinded=False, jobs=1, interp_opt='linear', use_cache=False, results=None, digests=None):
+    """Merge the input files into a 2D array with one row [true flux, best-fit flux, max TS] per trial, or None on error."""
+    # Not sure if we should aim to have this be an option or decide on one method for interpolation
+    if interp_opt not in ['linear', 'fit_poly', 'spline']:
+        print 'unrecongized interp_opt: {}'.format(interp_opt)
+        return None
+    inputs = _read_inputs(infiles, interpolate, bias, unblinded, use_cache, results, digests)
+    if inputs is None:
+        return None
+    hs, bs, ds, trueflux, digests = inputs
+    ntrials = len(trueflux)
+
+    flux_min, flux_max, nsamples = hs[0]
+    xps = points = None
+    if interpolate:
+        xps, points = _sample_points(hs[0], bs, bias)
+
+    merged = None
+    if use_cache:
+        merged_key = cache.key('merged', digests, interpolate, interp_opt, bias and bs, unblinded)
+        with profiling.stage('cache'):
+            merged = cache.load(merged_key)
+    if merged is not None:
+        print 'Merged trials read from the cache'
+        maxfluxes = merged['maxfluxes']
+        maxllhs = merged['maxllhs']
+        contained = merged['contained']
+    else:
+        with profiling.stage('maximize', ntrials):
+            maxfluxes, maxllhs, contained = _maximize(ds, trueflux, hs[0], interpolate, xps, points, interp_opt, jobs)
+    if use_cache and merged is None:
+        with profiling.stage('cache'):
+            cache.save(merged_key, maxfluxes=maxfluxes, maxllhs=maxllhs, contained=contained)
+
+    if interpolate and diagnostic:
+        with profiling.stage('diagnostic'):
+            plotted = diagnostics.select_trials(diagnostic, maxfluxes, contained, hs[0])
+            render_trials(plotted, ds, trueflux, maxfluxes, maxllhs, xps, points, interp_opt, 'plots/Diagnostic_{}.pdf'.format(save_name or 'merge'))
+    elif diagnostic:
+        print 'Warning: --diagnostic needs --interp, no diagnostic plots drawn'
+    if interpolate and unblinded and wanted(hide, save_name):
+        with profiling.stage('plot'):
+            lines = [curves[0] for curves in ds]
+            sum_array, interps = interpolate_trial(lines, xps, points, interp_opt)
+            plot_trial(points, interps, sum_array, lines, maxfluxes[0], maxllhs[0], save_name, hide)
+
+    overflow_count = np.count_nonzero(maxfluxes > 0.95 * (flux_max - flux_min))
+    _print_summary(flux_max, overflow_count, ntrials, interpolate, np.count_nonzero(contained))
+    return np.column_stack([trueflux, maxfluxes, maxllhs])
+
+
+def merge_subsets(infiles, interpolate=False, bias=False, unblinded=False, interp_opt='linear', use_cache=False, results=None, digests=None):
+    """
+    Merge every non-empty subset of the input files in one pass. Each file is read and interpolated once, and the joint curve of a subset is the one of the subset without its last file plus the curves of that file. All subsets use the trials paired across all the files, so that they are compared on the same trials. Returns a list of (indices of the files in the subset, merged array as returned by merge()), or None on error.
+    """
+    if interp_opt not in ['linear', 'fit_poly', 'spline']:
+        print 'unrecongized interp_opt: {}'.format(interp_opt)
+        return None
+    inputs = _read_inputs(infiles, interpolate, bias, unblinded, use_cache, results, digests)
+    if inputs is None:
+        return None
+    hs, bs, ds, trueflux, _ = inputs
+    points = None
+    if interpolate:  # on the points of all files, which are those of the joint curve of any subset too
+        xps, points = _sample_points(hs[0], bs, bias)
+        with profiling.stage('interpolate', len(trueflux) * len(ds)):
+            ds = [interpolate_curves(curves, xp, points, interp_opt) for curves, xp in zip(ds, xps)]
+
+    sums = {}  # joint curves of the subsets, by tuple of file indices
+    merged = []
+    for size in range(1, len(ds) + 1):
+        for subset in combinations(range(len(ds)), size):
+            sums[subset] = ds[subset[0]] if size == 1 else sums[subset[:-1]] + ds[subset[-1]]
+            with profiling.stage('maximize', len(trueflux)):
+                if interpolate:
+                    maxfluxes, maxllhs, _ = _peaks(points, sums[subset], trueflux)
+                else:
+                    maxfluxes, maxllhs, _ = _grid_peaks(np.asarray(sums[subset], dtype=float), hs[0])
+            merged.append((subset, np.column_stack([trueflux, maxfluxes, maxllhs])))
+        for subset in [subset for subset in sums if len(subset) < size]:  # not needed by larger subsets anymore
+            del sums[subset]
+    return merged
+
+
+def merge_chunks(infiles, chunk_size, save_name='', interpolate=False, bias=False, hide=False, unblinded=False, interp_opt='linear'):
+    """
+    Merge the input files chunk_size trials at a time, so that the memory used does not depend on the number of trials. Returns a generator of arrays like the one returned by merge(), one per chunk, or None on error. Errors found while streaming raise ValueError. The trials are paired by true flux as in merge(), from a first pass over the flux column of the files, which requires the paired trials to come in the same order in all files.
+    """
+    if interp_opt not in ['linear', 'fit_poly', 'spline']:
+        print 'unrecongized interp_opt: {}'.format(interp_opt)
+        return None
+    readers = []  # chunks of (true flux, llh curves) of each input file
+    hs = []  # headers
+    bs = []  # bias
+    fluxes = []  # true flux of each trial, for each input file
+    for infile in infiles:
+        try:
+            with profiling.stage('read'):
+                fluxes.append(read_fluxes(infile))
+        except IOError:
+            print "Error: Input file {} cannot be opened.".format(infile)
+            return None
+        except ValueError as error:
+            print error
+            return None
+    with profiling.stage('join'):
+        trueflux, indices = join_trials(fluxes, infiles)
+    if not len(trueflux):
+        print 'Error: No true flux is common to all files.'
+        return None
+    for infile, index in zip(infiles, indices):
+        if np.any(np.diff(index) < 0):
+            print 'Error: The trials of {} are not in the same flux order as in {}. Merge them without --chunk, or group them by flux with shuffle.py first.'.format(infile, infiles[0])
+            return None
+
+    for i, (infile, index) in enumerate(zip(infiles, indices)):
+        try:
+            header, bias_factor, unblinded_curve, trials = iter_results(infile, chunk_size)
+        except IOError:
+            print "Error: Input file {} cannot be opened.".format(infile)
+            return None
+        except ValueError as error:
+            print error
+            return None
+        if bias_factor is None or not _corrected(bias, i):
+            bias_factor = 1.  # If no bias in the file, or not corrected, put no bias
+        else:
+            print 'Correction of bias for', infile
+        trials = _select(trials, index, chunk_size)
+        if unblinded:
+            if unblinded_curve is None:
+                print 'Error: No unblinded data for file', infile
+                return None
+            trials = chain([(np.array([-1.]), unblinded_curve[None, :])], trials)  # Replace 'unblinded' by -1
+        hs.append(header)
+        bs.append(bias_factor)
+        readers.append(trials)
     for header in hs:  # Check that all headers match the first file
         if header != hs[0] and not interpolate:
             print 'Error: Trying non-interpolation combination of files with different sampling definitions.  Set the --interp flag if desired.'
-            return 0
+            return None
+    xps = points = None
+    if interpolate:
+        xps, points = _sample_points(hs[0], bs, bias)
+    plot_unblinded = interpolate and unblinded and wanted(hide, save_name)
+    return _merged_chunks(readers, hs[0], interpolate, xps, points, interp_opt, plot_unblinded, save_name, hide)
 
-    flux_min = float(hs[0][0])
-    flux_max = float(hs[0][1])
-    nsamples = int(hs[0][2])
-    x = np.linspace(flux_min, flux_max, nsamples)
-    #padding = (flux_max-flux_min)/float(10)
-    padding = 0
-    grid_upscale = 10
-    xs = np.linspace(flux_min - padding, flux_max + padding, grid_upscale * nsamples)  # finer x sampling with padded range for interpolation mode
-    #print('flux_min = {}, flux_max = {}, nsamples = {}'.format(flux_min, flux_max, nsamples))
-    #print(' with sampling points: {}'.format(x))
-
-    line_count = 0
+
+def _select(trials, index, chunk_size):
+    """The trials at the increasing positions index among the chunks of trials, chunk_size at a time."""
+    position = 0
+    selected = []  # (flux, curves) selected and not yielded yet
+    nselected = 0
+    for flux, curves in trials:
+        picked = index[np.searchsorted(index, position):np.searchsorted(index, position + len(flux))] - position
+        position += len(flux)
+        selected.append((flux[picked], curves[picked]))
+        nselected += len(picked)
+        while nselected >= chunk_size or (nselected and position > index[-1]):
+            flux_chunk = np.concatenate([flux for flux, _ in selected])
+            curves_chunk = np.concatenate([curves for _, curves in selected])
+            yield flux_chunk[:chunk_size], curves_chunk[:chunk_size]
+            selected = [(flux_chunk[chunk_size:], curves_chunk[chunk_size:])]
+            nselected = len(flux_chunk) - min(chunk_size, len(flux_chunk))
+        if position > index[-1]:
+            return
+
+
+def _merged_chunks(readers, header, interpolate, xps, points, interp_opt, plot_unblinded, save_name, hide):
+    flux_min, flux_max, nsamples = header
+    ntrials = 0
     overflow_count = 0
     count_correct = 0
-    end_of_file = False
-    while True:  # Loop over lines in the files
-        line_count += 1
-        lines = []
-        for f in fs:
-            if line_count == 1:
-                line = f.readline().strip().split()
-                if line[0] == 'Unblinded':
-                    if unblinded:
-                        line[0] = -1 # Replace 'unblinded' by -1
-                        line = np.array([float(number) for number in line])
-                    else:
-                        line = np.array([float(number) for number in f.readline().strip().split()])
-                else:
-                    if unblinded:
-                        print 'Error: No unblinded data for file', f
-                        exit(0)
-                    else:
-                        line = np.array([float(number) for number in line])
-            else:
-                line = np.array([float(number) for number in f.readline().strip().split()])
-            lines.append(line)
-            if len(line) == 0:
-                end_of_file = True  # end of at least one file (trailing lines in other files ignored)
-                break
-            if line[0] != lines[0][0]:  # Check that all fluxes for this trial are equal to the first file
-                print 'Error: Fluxes not equal for this trial! Do you use files with the same number of trials ?'  # Maybe need to set an equality tolerance here?
-                print line[0], "!=", lines[0][0]
-                exit(0)
-                return 0
-        if end_of_file:
-            break  # Break out of outer loop over lines in file
+    chunks = izip(*readers)  # the readers give the paired trials in chunks of the same size
+    while True:
+        with profiling.stage('read'):
+            chunk = next(chunks, None)
+        if chunk is None:
+            break
+        size = len(chunk[0][0])
+        trueflux = chunk[0][0]
+        ds = [curves for _, curves in chunk]
+        with profiling.stage('maximize', size):
+            maxfluxes, maxllhs, contained = _maximize(ds, trueflux, header, interpolate, xps, points, interp_opt)
+        if plot_unblinded and ntrials == 0:
+            with profiling.stage('plot'):
+                lines = [curves[0] for curves in ds]
+                sum_array, interps = interpolate_trial(lines, xps, points, interp_opt)
+                plot_trial(points, interps, sum_array, lines, maxfluxes[0], maxllhs[0], save_name, hide)
+        ntrials += size
+        overflow_count += np.count_nonzero(maxfluxes > 0.95 * (flux_max - flux_min))
+        count_correct += np.count_nonzero(contained)
+        yield np.column_stack([trueflux, maxfluxes, maxllhs])
+    _print_summary(flux_max, overflow_count, ntrials, interpolate, count_correct)
+
+
+def state_file(outfile):
+    """Name of the file recording how far update() has merged the inputs of outfile."""
+    return outfile + STATE_SUFFIX
+
+
+def _load_state(outfile, options):
+    """
+    State saved by the last update of outfile, as a dict, or None if there is none.  Raises ValueError if it was saved with other inputs or options, or if outfile changed since.
+    """
+    if not os.path.exists(state_file(outfile)) or not os.path.exists(outfile):
+        return None
+    with np.load(state_file(outfile)) as npz:
+        state = dict(npz)
+    if str(state['options']) != options:
+        raise ValueError('Error: The input files, their headers and biases or the options changed since the last update of {}. Run without --update to merge them from the start.'.format(outfile))
+    size, rows = state.get('output', (-1, -1))  # not recorded by older versions
+    if os.path.getsize(outfile) != size or results_io.count_merged(outfile) != rows:
+        raise ValueError('Error: {} changed since its last update. Run without --update to merge the inputs from the start.'.format(outfile))
+    return state
+
+
+def _save_state(outfile, state):
+    """Replace the state of outfile atomically, through a temporary file."""
+    temp_file = os.path.join(os.path.dirname(os.path.abspath(outfile)), 'temporary_{}_{}'.format(os.getpid(), os.path.basename(state_file(outfile))))
+    np.savez(temp_file, **state)
+    os.rename(temp_file, state_file(outfile))
 
+
+def update(infiles, outfile, interpolate=False, bias=False, unblinded=False, jobs=1, interp_opt='linear', digits=MERGED_DIGITS):
+    """Merge the trials appended to the input files since the last update of outfile and add them at its end, returning their number, or None on error."""
+    headers = []
+    bs = []
+    unblinded_curves = []
+    for i, infile in enumerate(infiles):
+        try:
+            header, bias_factor, unblinded_curve = read_header(infile)
+        except IOError:
+            print "Error: Input file {} cannot be opened.".format(infile)
+            return None
+        except ValueError as error:
+            print error
+            return None
+        if unblinded and unblinded_curve is None:
+            print 'Error: No unblinded data for file', infile
+            return None
+        headers.append(header)
+        bs.append(1. if bias_factor is None or not _corrected(bias, i) else bias_factor)
+        unblinded_curves.append(unblinded_curve)
+    if not interpolate and any(header != headers[0] for header in headers):
+        print 'Error: Trying non-interpolation combination of files with different sampling definitions.  Set the --interp flag if desired.'
+        return None
+
+    options = json.dumps([[os.path.abspath(infile) for infile in infiles], headers, interpolate, interp_opt, bias and bs, unblinded])
+    try:
+        state = _load_state(outfile, options)
+    except ValueError as error:
+        print error
+        return None
+    first = state is None
+    if first:
+        print 'No previous update of {}, merging from the start'.format(outfile)
+        state = {'options': np.array(options), 'offsets': np.zeros(len(infiles), dtype=int),
+                 'fluxes': np.zeros(0), 'counts': np.zeros(0, dtype=int), 'totals': np.zeros(2, dtype=int),
+                 'output': np.zeros(2, dtype=int)}  # size in bytes and number of trials of outfile
+        for i, header in enumerate(headers):
+            state['pending_flux_{}'.format(i)] = np.zeros(0)
+            state['pending_curves_{}'.format(i)] = np.zeros((0, header[2]))
+
+    fluxes = []  # pending then new trials of each file
+    ds = []
+    for i, infile in enumerate(infiles):
+        try:
+            with profiling.stage('read'):
+                flux, curves, state['offsets'][i] = read_appended(infile, headers[i][2] + 1, state['offsets'][i])
+        except IOError:
+            print "Error: Input file {} cannot be opened.".format(infile)
+            return None
+        except ValueError as error:
+            print error
+            return None
+        if first and unblinded:
+            flux = np.concatenate([[-1.], flux])  # Replace 'unblinded' by -1
+            curves = np.vstack([unblinded_curves[i], curves])
+        print 'Read {} new trials from {}'.format(len(flux), infile)
+        fluxes.append(np.concatenate([state['pending_flux_{}'.format(i)], flux]))
+        ds.append(np.vstack([state['pending_curves_{}'.format(i)], curves]))
+
+    with profiling.stage('join'):
+        trueflux, indices = join_trials(fluxes, infiles, verbose=False)
+    for i, index in enumerate(indices):
+        waiting = np.ones(len(fluxes[i]), dtype=bool)
+        waiting[index] = False
+        state['pending_flux_{}'.format(i)] = fluxes[i][waiting]
+        state['pending_curves_{}'.format(i)] = ds[i][waiting]
+        ds[i] = ds[i][index]
+    ntrials = len(trueflux)
+    flux_min, flux_max, nsamples = headers[0]
+
+    merged = []
+    if ntrials:
+        xps = points = None
         if interpolate:
-            a_ = [float(word[3]) for word in bs]
-            #print('Finding max by interpolating between grid points...')
-            # Not sure if we should aim to have this be an option or decide on one method for interpolation
-            interp_opt = 'linear'
-            # interp_opt = 'fit_poly'
-            # interp_opt = 'spline'
-            sum_array = np.zeros(len(xs))
-            interps = []
-            if interp_opt == 'fit_poly':
-                for index, line in enumerate(lines):
-                    if bias:
-                        fit = np.polyfit((x) / a_[index], line[1:], deg=5)
-                    else:
-                        fit = np.polyfit(x, line[1:], deg=5)
-                    y_offset = np.polyval(fit, [0])
-                    interp = np.polyval(fit, xs) - y_offset
-                    interps.append(interp)
-                    sum_array += interp
-            elif interp_opt == 'linear':
-                for index, line in enumerate(lines):
-                    if bias:
-                        interp = np.interp(xs, (x) / a_[index], line[1:])
-                    else:
-                        interp = np.interp(xs, x, line[1:])
-                    interps.append(interp)
-                    sum_array += interp
-            elif interp_opt == 'spline':
-                # NB: This smoothing factor must be kept very small so that the spline interpolation does not 'miss' the point (0,0).
-                # Otherwise numerical noise near (0,0) dominates the measurement of the median of background-only trials!
-                #smoothing_factor = 0.15
-                smoothing = 1e-3  # Acts as a maximum chi2 for spline
-                order = 2  # degree of spline knob polynomial.  2 or 3 are both suitable.
-                for index, line in enumerate(lines):
-                    if bias:
-                        spline = UnivariateSpline((x) / a_[index], line[1:], k=order, s=smoothing)
-                    else:
-                        spline = UnivariateSpline(x, line[1:], k=order, s=smoothing)
-                    interps.append(spline)
-                    sum_array += spline(xs)
-            else:
-                print 'unrecongized interp_opt: {}'.format(interp_opt)
-                return 0
-
-            # Find max log-likelihood
-            # The max is not found to floating pt precision, just on a much finer grid set by grid_upscale.
-            maxllh = np.max(sum_array)
-
-            # Translate max array index into max flux:
-            maxflux = np.argmax(sum_array) * ((flux_max + padding) - (flux_min - padding)) / (grid_upscale * nsamples)
-            if maxflux > 0.95 * (flux_max - flux_min):
-                overflow_count += 1
-                #diagnostic = True
-            # Check if true flux is contained within 1.0 of the peak (corresponding to 0.5 in log-likelihood ratio).
-            for i, value in enumerate(sum_array):
-                if value > maxllh - 1.0:
-                    lowi = i
-                    break
-            for i, value in enumerate(reversed(sum_array)):
-                if value > maxllh - 1.0:
-                    highi = len(sum_array) - i - 1
-                    break
-            lowflux = lowi * ((flux_max + padding) - (flux_min - padding)) / (grid_upscale * nsamples)
-            highflux = highi * ((flux_max + padding) - (flux_min - padding)) / (grid_upscale * nsamples)
-            trueflux = lines[0][0]
-            #print('{:0.2e} {:0.2e} {:0.2e}'.format(lowflux, trueflux, highflux))
-            if lowflux < trueflux and trueflux < highflux:
-                count_correct = count_correct + 1
-
-            of.write("{:.2e} {:.2e} {:.2e}\n".format(trueflux, maxflux, maxllh))  # write the flux and the max TS
-            if diagnostic or (unblinded and line_count == 1):  # and maxflux != 0:
-                plt.figure()
-                color = ['green', 'orange', 'r']
-                experiment = ['IceCube tracks', 'ANTARES showers', 'ANTARES tracks']
-                index = 0
-                for interp in interps:
-                    plt.plot(xs, interp, color=color[index], lw=3, alpha=0.7, label=experiment[index])
-                    index += 1
-                plt.plot(xs, sum_array, 'black', lw=3, label='Combination')
-                plt.legend(loc=8)
-                coarse_sum_array = np.zeros(len(lines[0][1:]))
-                for line in lines:
-                    # if not unblinded or not line_count == 1:
-                    #     plt.plot(x, line[1:], 'ko', ms=3, alpha=0.6)
-                    coarse_sum_array += line[1:]
-                # if not unblinded or not line_count == 1:
-                #     plt.plot(x, coarse_sum_array, 'ko', ms=5)
-                plt.xlabel(r"$\Phi_{KRA\gamma}$", fontsize=20)
-                plt.ylabel("log-likelihood ratio", fontsize=19)
-                ax = plt.gca()
-                ymin, ymax = ax.get_ylim()
-                xmin, xmax = ax.get_xlim()
-                plt.plot([maxflux, maxflux], [ymin, maxllh], '--', color='silver', lw=1.5)
-                plt.plot([0.0, maxflux], [maxllh, maxllh], '--', color='silver', lw=1.5)
-                # ax.text(0.15, 0.15, '(max flux, max llh) = ({:0.2}, {:0.2})'.format(maxflux, maxllh), verticalalignment='top', horizontalalignment='left', transform=ax.transAxes, color='g', fontsize=18)
-                ax.text(0.06, 0.06, 'Fitted flux', verticalalignment='top', horizontalalignment='left', transform=ax.transAxes, color='k', fontsize=18)
-                ax.text(0.0, 0.87, r'TS$_{comb}$', verticalalignment='bottom', horizontalalignment='left', transform=ax.transAxes, color='k', fontsize=18)
-                plt.axis([xmin,xmax*2./3.,ymin/2,ymax])
-                plt.axhline(0, color='k')
-                if save_name:
-                    plt.savefig('plots/FitUnblinding_'+save_name+'.pdf')
-                if not hide:
-                    plt.show()
-                #diagnostic = False
-
-        else:  # don't interpolate
-            #print('Finding max by summing grid points...')
-            sum_array = np.zeros(len(lines[0][1:]))
-            for line in lines:
-                sum_array += line[1:]
-            # Find max log-likelihood
-            maxllh = np.max(sum_array)
-            # Translate max array index into max flux:
-            maxflux = np.argmax(sum_array) * (flux_max - flux_min) / nsamples
-            if maxflux > 0.95 * (flux_max - flux_min):
-                overflow_count += 1
-            of.write("{:.2e} {:.2e} {:.2e}\n".format(lines[0][0], maxflux, maxllh))  # print out flux and the max TS
-
-    print 'Best-fit flux found to be with 5% of the top of the flux range {} a total of {} times out of {}'.format(flux_max, overflow_count, line_count)
-    if interpolate:
-        print 'True flux contained within 0.5 log-likelihood of the peak in {:0.1f} percent of the trials'.format(100. * count_correct / line_count)
-    for f in fs:
-        f.close()
-    of.close()
+            xps, points = _sample_points(headers[0], bs, bias)
+        with profiling.stage('maximize', ntrials):
+            maxfluxes, maxllhs, contained = _maximize(ds, trueflux, headers[0], interpolate, xps, points, interp_opt, jobs)
+        merged = [np.column_stack([trueflux, maxfluxes, maxllhs])]
+        state['totals'] += [np.count_nonzero(maxfluxes > 0.95 * (flux_max - flux_min)), np.count_nonzero(contained)]
+    try:
+        with profiling.stage('write', ntrials):
+            results_io.write_merged(outfile, merged, digits, append=not first)
+    except (IOError, ValueError) as error:
+        print error
+        return None
+
+    # Merged trials per flux, without the unblinded row
+    new_fluxes, new_counts = np.unique(trueflux[trueflux != -1], return_counts=True)
+    all_fluxes = np.union1d(state['fluxes'], new_fluxes)
+    counts = np.zeros(len(all_fluxes), dtype=int)
+    counts[np.searchsorted(all_fluxes, state['fluxes'])] += state['counts']
+    counts[np.searchsorted(all_fluxes, new_fluxes)] += new_counts
+    state['fluxes'] = all_fluxes
+    state['counts'] = counts
+    state['output'] = [os.path.getsize(outfile), state['output'][1] + ntrials]
+    with profiling.stage('state'):
+        _save_state(outfile, state)
+
+    print '\n{:>10} {:>8} {:>8}'.format('Flux', 'Trials', 'New')
+    for value, count in zip(all_fluxes, counts):
+        print '{:>10.2e} {:>8} {:>8}'.format(value, count, new_counts[new_fluxes == value].sum())
+    for i, infile in enumerate(infiles):
+        if len(state['pending_flux_{}'.format(i)]):
+            print '{} trials of {} wait for the other files'.format(len(state['pending_flux_{}'.format(i)]), infile)
+    print 'Added {} merged trials to {}'.format(ntrials, outfile)
+    if counts.sum():
+        _print_summary(flux_max, state['totals'][0], counts.sum() + (1 if unblinded else 0), interpolate, state['totals'][1])
+    return ntrials
+
+
+def write_merged(outfile, data, digits=MERGED_DIGITS):
+    """
+    Write the merged trials, one row [true flux, best-fit flux, max TS] per trial: a full-precision array if outfile ends with .npy, text with digits significant digits otherwise. data is an array, or an iterable of arrays as returned by merge_chunks.
+    """
+    if isinstance(data, np.ndarray):
+        data = [data]
+    results_io.write_merged(outfile, data, digits)
+
+
+def main(files, save_name, interpolate=False, diagnostic=False, bias=False, hide=False, unblinded=False, jobs=1, use_cache=False, interp_opt='linear', chunk_size=0, digits=MERGED_DIGITS, incremental=False):
+    infiles = files[:-1]  # All but the last argument are input files
+    outfile = files[-1]  # Last argument is the output file
+    if incremental:
+        if diagnostic or use_cache or chunk_size:
+            print 'Warning: --diagnostic, --cache and --chunk are ignored with --update'
+        update(infiles, outfile, interpolate, bias, unblinded, jobs, interp_opt, digits)
+        return 0
+    if not writable(outfile):  # checked before the merge, the output is only written once it succeeded
+        print "Error: Unable to open output file {}.".format(outfile)
+        return 0
+    if diagnostic:
+        try:
+            diagnostics.parse_selection(diagnostic)
+        except ValueError as error:
+            print error
+            return 0
+
+    if chunk_size:
+        if diagnostic or jobs > 1 or use_cache:
+            print 'Warning: --diagnostic, --jobs and --cache are ignored with --chunk'
+        data = merge_chunks(infiles, chunk_size, save_name, interpolate, bias, hide, unblinded, interp_opt)
+    else:
+        data = merge(infiles, save_name, interpolate, diagnostic, bias, hide, unblinded, jobs, interp_opt, use_cache)
+    if data is None:
+        return 0
+    try:
+        with profiling.stage('merge and write' if chunk_size else 'write', 0 if chunk_size else len(data)):
+            write_merged(outfile, data, digits)
+    except ValueError as error:
+        print error
+        return 0
 
 
 if __name__ == "__main__":
@@ -263,9 +832,12 @@ if __name__ == "__main__":
     # Diagnostic flag
     parser.add_argument(
         '--diagnostic',
-        default=False,
-        action="store_true",
-        help='Set to run special diagnostics to visualize results. You may have to force quit the process if you don\'t want to go through all trials.')
+        nargs="?",
+        default=None,
+        const='all',
+        metavar='SELECTION',
+        type=str,
+        help='Set to draw diagnostic plots of the merged trials into plots/Diagnostic_SAVE.pdf, in the background without blocking the run. SELECTION picks the trials: all (default), overflow (best fit at the top of the flux range), outside (true flux outside the 0.5 log-likelihood interval of the peak) or random:N (N random trials). Needs --interp.')
 
     # Bias correction flag
     parser.add_argument(
@@ -296,10 +868,58 @@ if __name__ == "__main__":
         type=str,
         help='Set to save the most usefull plots with SAVE as a filename extension.')
 
+    # Parallel interpolation
+    parser.add_argument(
+        '--jobs',
+        default=1,
+        type=int,
+        help='Number of processes sharing the trials in interpolation mode.')
+
+    # Cache flag
+    parser.add_argument(
+        '--cache',
+        default=False,
+        action="store_true",
+        help='Set to reuse parsed files and merged trials from previous runs with the same inputs and options.')
+
+    # Streaming
+    parser.add_argument(
+        '--chunk',
+        default=0,
+        type=int,
+        help='Number of trials read and merged at a time, so that memory does not grow with the number of trials. Not compatible with --diagnostic, --jobs and --cache. 0 reads whole files.')
+
+    # Output precision
+    parser.add_argument(
+        '--digits',
+        default=MERGED_DIGITS,
+        type=int,
+        help='Number of significant digits of the merged trials written as text. An output file ending with .npy is written in binary with full precision instead.')
+
+    # Incremental merge
+    parser.add_argument(
+        '--update',
+        default=False,
+        action="store_true",
+        help='Set to only merge the trials appended to the input files since the last run with --update, and add them to the output file. How far each input was read is kept in OUTPUT.state.npz. Not compatible with --diagnostic, --cache and --chunk.')
+
+    # Profiling flag
+    parser.add_argument(
+        '--profile',
+        nargs="?",
+        default=None,
+        const='',
+        type=str,
+        help='Set to print the time, number of calls and peak memory of each stage, and to also write them as JSON to PROFILE if given.')
+
     args = parser.parse_args()
     if args.bias:
         args.interp = True
+    if args.profile is not None:
+        profiling.enable()
     if len(sys.argv) >= 2:
-        main(args.files, args.save, args.interp, args.diagnostic, args.bias, args.hide, args.unblinded)
+        main(args.files, args.save, args.interp, args.diagnostic, args.bias, args.hide, args.unblinded, args.jobs, args.cache, chunk_size=args.chunk, digits=args.digits, incremental=args.update)
+        diagnostics.finish()
+        profiling.report(args.profile)
     else:
         parser.print_help()
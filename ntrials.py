@@ -1,87 +1,197 @@
 #!/usr/bin/env python
 r"""
 Just open a file and report how many trials take place at each flux value.  Print the results.
+
+Only the first column of a text file is converted, and the flux.npy of a store made by convert.py is read alone.  Given several files, a table compares their headers, flux lists and numbers of trials per flux, and --trim writes merge-ready copies keeping the same number of trials at every flux in every file: the smallest one among the files.
 """
 
 r"""
-usage: ntrials.py [-h] [inputfile]
+usage: ntrials.py [-h] [--trim [SUFFIX]] [--profile [PROFILE]]
+                  [inputfile [inputfile ...]]
 
 positional arguments:
-  inputfile   Path to results input file to be shuffled.
+  inputfile        Path to one or more results input files.
 
 optional arguments:
-  -h, --help  show this help message and exit
+  -h, --help       show this help message and exit
+  --trim [SUFFIX]  Set to write a copy of each file keeping the first trials
+                   of each flux common to all files, as many as in the file
+                   with the fewest, grouped by flux. The copies are named
+                   after the files with SUFFIX (_trimmed by default) before
+                   the extension.
+  --profile [PROFILE]
+                   Set to print the time, number of calls and peak memory of
+                   each stage, and to also write them as JSON to PROFILE if
+                   given.
 """
 
+import os
 import sys
 import argparse
+import tempfile
 import numpy as np
+from results_io import (STORE_SUFFIX, is_store, read_header, read_fluxes, read_results, read_trial_lines,
+                        write_lines, write_store)
+import profiling
 
 # Flux are in units [1/GeV/cm^2/s] or scaling factors relative to a specified model
 # And TS should be log( likelihood ) [unitless]
 
-# Returns a list of tuples indicating a range over which the flux is constant
 
+def count_trials(flux):
+    """Sorted unique fluxes and the number of trials at each."""
+    return np.unique(flux, return_counts=True)
+
+
+def trimmed_name(path, suffix):
+    """Name of the trimmed copy of path: results_X.txt.gz -> results_X<suffix>.txt.gz"""
+    path = path.rstrip(os.sep)
+    extension = ''
+    for ending in ['.gz', '.bz2', '.xz']:
+        if path.endswith(ending):
+            path, extension = path[:-len(ending)], ending
+    for ending in ['.txt', STORE_SUFFIX]:
+        if path.endswith(ending):
+            path, extension = path[:-len(ending)], ending + extension
+    return path + suffix + extension
 
-def main(infile):
+
+def trimmed_order(flux, keep):
     """
-    Output the number of trials per generated flux.
+    Indices of the trials kept in a trimmed copy: the first keep[f] trials of each flux f, grouped by increasing flux.  Files trimmed with the same keep thus have the same flux on every row.
     """
-    rows_to_skip = 1
+    order = np.argsort(flux, kind='mergesort')
+    sorted_flux = flux[order]
+    kept = []
+    for value, count in sorted(keep.items()):
+        start = np.searchsorted(sorted_flux, value)
+        kept.append(order[start:start + count])
+    return np.concatenate(kept)
+
+
+def trim(infile, outfile, keep):
+    """Write the trimmed copy of infile in outfile, a store if infile is a store."""
+    if is_store(infile):
+        header, bias, unblinded, flux, curves = read_results(infile)
+        order = trimmed_order(flux, keep)
+        write_store(outfile, header, bias, unblinded, flux[order], curves[order])
+        return
+    handle, scratch = tempfile.mkstemp(prefix='trim_', suffix='.bin', dir=os.path.dirname(os.path.abspath(outfile)))
+    os.close(handle)
     try:
-        f = open(infile, 'r')
-        h = f.readline().split()  # header
-        if h[0] == 'Bias':
-            rows_to_skip += 1
-            h = f.readline().split()  # header
-        if f.readline().split()[0] == 'Unblinded':
-            rows_to_skip += 1
-        f.close()
-        data = np.loadtxt(infile, skiprows=rows_to_skip)
-        order = data[:, 0].argsort()  # get index based on first column
-        data = data[order]  # now ordered by flux
-
-    except IOError:
-        print "Error: Input file {} missing.".format(infile)
-        return 0
-
-    # Identify ranges where fluxes are constant and count trials at each
-    unique_fluxes = np.unique(data[:, 0])
-    prev_flux = data[0][0]
-    start_index = 0
-    index = 0
-    fluxes = []
-    count_at_fluxes = []
-    for row in data:
-        if row[0] != prev_flux:  # found change point
-            fluxes.append(prev_flux)
-            count_at_fluxes.append(index - start_index)
-            start_index = index
-        prev_flux = row[0]
-        index = index + 1
-    # Add the last entry:
-    fluxes.append(row[0])
-    count_at_fluxes.append(len(data[:, 0]) - start_index)
-
-    print 'Unique fluxes: {}'.format(unique_fluxes)
-
-    for n, flux in enumerate(fluxes):
-        print 'For flux = {:0.2e}, nTrials = {}'.format(flux, count_at_fluxes[n])
+        header, bias, unblinded, flux, offsets = read_trial_lines(infile, scratch)
+        write_lines(outfile, header, bias, unblinded, scratch, offsets, trimmed_order(flux, keep))
+    finally:
+        os.remove(scratch)
+
+
+def report(infiles, headers, counts):
+    """
+    Print the number of trials per flux of each file side by side, and whether the files can be merged as they are.  Returns the number of trials per flux common to all files, as a dict.
+    """
+    all_fluxes = np.unique(np.concatenate([fluxes for fluxes, _ in counts]))
+    table = np.zeros((len(all_fluxes), len(infiles)), dtype=int)
+    for column, (fluxes, numbers) in enumerate(counts):
+        table[np.searchsorted(all_fluxes, fluxes), column] = numbers
+    minimums = table.min(axis=1)
+
+    for column, infile in enumerate(infiles):
+        print '[{}] {} (header {:g} {:g} {}, {} trials)'.format(column + 1, infile, headers[column][0], headers[column][1],
+                                                              headers[column][2], table[:, column].sum())
+    print '\n{:>10} '.format('Flux') + ' '.join('{:>8}'.format('[{}]'.format(column + 1)) for column in range(len(infiles))) + ' {:>8}'.format('Common')
+    for row, value in enumerate(all_fluxes):
+        print '{:>10.2e} '.format(value) + ' '.join('{:>8}'.format(number) for number in table[row]) + ' {:>8}'.format(minimums[row])
+
+    same_headers = all(header == headers[0] for header in headers)
+    same_fluxes = (table > 0).all()
+    same_counts = (table == table[:, :1]).all()
+    print '\nHeaders match: {}'.format('yes' if same_headers else 'no, merge them with --interp')
+    print 'Flux lists match: {}'.format('yes' if same_fluxes else 'no, only the fluxes found in all files can be merged')
+    print 'Trial counts match: {}'.format('yes' if same_counts else 'no, use --trim to write merge-ready copies')
+    return dict((value, number) for value, number in zip(all_fluxes, minimums) if number)
+
+
+def main(infiles, trim_suffix=None):
+    """
+    Output the number of trials per generated flux of each file, compare the files if there are several and write their trimmed copies if trim_suffix is given.
+    """
+    if isinstance(infiles, basestring):
+        infiles = [infiles]
+    headers = []
+    counts = []
+    for infile in infiles:
+        try:
+            with profiling.stage('read'):
+                headers.append(read_header(infile)[0])
+                flux = read_fluxes(infile)
+        except IOError:
+            print "Error: Input file {} missing.".format(infile)
+            return 0
+        except ValueError as error:
+            print error
+            return 0
+        with profiling.stage('count', len(flux)):
+            counts.append(count_trials(flux))
+
+    if len(infiles) == 1:
+        unique_fluxes, count_at_fluxes = counts[0]
+        print 'Unique fluxes: {}'.format(unique_fluxes)
+        for n, flux in enumerate(unique_fluxes):
+            print 'For flux = {:0.2e}, nTrials = {}'.format(flux, count_at_fluxes[n])
+        keep = dict(zip(unique_fluxes, count_at_fluxes))
+    else:
+        keep = report(infiles, headers, counts)
+
+    if trim_suffix is not None:
+        if not keep:
+            print 'Error: No flux is common to all files, nothing to trim.'
+            return 0
+        for infile in infiles:
+            outfile = trimmed_name(infile, trim_suffix)
+            print 'Writing', outfile
+            try:
+                with profiling.stage('trim'):
+                    trim(infile, outfile, keep)
+            except (IOError, OSError):
+                print "Error: Unable to open output file {}.".format(outfile)
+                return 0
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description=__doc__,)
 
-    # Positional arguments for the two input files
+    # Positional arguments for the input files
     parser.add_argument(
         "inputfile",
-        nargs="?",
+        nargs="*",
         default='',
         type=str,
-        help="Path to results input file to be shuffled.")
+        help="Path to one or more results input files.")
+
+    # Trimmed copies
+    parser.add_argument(
+        '--trim',
+        nargs="?",
+        default=None,
+        const='_trimmed',
+        metavar='SUFFIX',
+        type=str,
+        help='Set to write a copy of each file keeping the first trials of each flux common to all files, as many as in the file with the fewest, grouped by flux. The copies are named after the files with SUFFIX (_trimmed by default) before the extension.')
+
+    # Profiling flag
+    parser.add_argument(
+        '--profile',
+        nargs="?",
+        default=None,
+        const='',
+        type=str,
+        help='Set to print the time, number of calls and peak memory of each stage, and to also write them as JSON to PROFILE if given.')
 
     args = parser.parse_args()
-    if len(sys.argv) >= 2:
-        main(args.inputfile)
+    if args.profile is not None:
+        profiling.enable()
+    if len(sys.argv) >= 2 and args.inputfile:
+        main(args.inputfile, args.trim)
+        profiling.report(args.profile)
     else:
         parser.print_help()
@@ -0,0 +1,27 @@
+r"""
+Lazy access to matplotlib for merge.py, bias.py, sensitivity.py and get_sensitivity.py.
+
+pyplot is only imported when a figure is actually drawn, so runs with --hide and without --save never load matplotlib.  Figures that are only saved use the non-interactive Agg backend, which needs no display.
+"""
+
+import sys
+
+
+def wanted(hide, save_name):
+    """True if the figures will be shown or saved."""
+    return not hide or bool(save_name)
+
+
+def pyplot(interactive=True):
+    """Import and return matplotlib.pyplot, with the Agg backend if not interactive and pyplot is not loaded yet."""
+    if not interactive and 'matplotlib.pyplot' not in sys.modules:
+        import matplotlib
+        matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    return plt
+
+
+def close_all():
+    """Close all figures, if pyplot was ever loaded."""
+    if 'matplotlib.pyplot' in sys.modules:
+        sys.modules['matplotlib.pyplot'].close('all')
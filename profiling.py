@@ -0,0 +1,73 @@
+r"""
+Per-stage profiling behind the --profile flag of the scripts.
+
+The code marks its stages with `with profiling.stage('name'):`.  Unless enable() was called this only costs a flag test per stage, and stages are coarse (reading a file, maximizing all trials, fitting, plotting), never per trial.  When enabled, the wall time, number of calls and peak resident memory of every stage are collected; stages entered inside another one are named 'outer/inner'.  report() prints them as a table and can also dump them as JSON.  Work done in pool workers is only seen as the time of the stage waiting for them.
+"""
+
+import json
+import time
+import resource
+from contextlib import contextmanager
+
+_enabled = False
+_start = 0.
+_stack = []  # names of the stages currently entered
+_stages = {}  # full name -> [calls, seconds, peak RSS in MB, items]
+_order = []  # full names by first entry
+
+
+def enable():
+    """Start collecting stage measurements."""
+    global _enabled, _start
+    _enabled = True
+    _start = time.time()
+
+
+def peak_rss():
+    """Peak resident memory in MB of this process, or of its largest finished child process if larger."""
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return peak / 1024.  # kB on Linux
+
+
+@contextmanager
+def stage(name, items=0):
+    """Measure the enclosed block as the named stage.  items is the number of trials it processes, to report a throughput."""
+    if not _enabled:
+        yield
+        return
+    _stack.append(name)
+    full_name = '/'.join(_stack)
+    if full_name not in _stages:
+        _stages[full_name] = [0, 0., 0., 0]
+        _order.append(full_name)
+    start = time.time()
+    try:
+        yield
+    finally:
+        record = _stages[full_name]
+        record[0] += 1
+        record[1] += time.time() - start
+        record[2] = max(record[2], peak_rss())
+        record[3] += items
+        _stack.pop()
+
+
+def report(json_file=''):
+    """Print the measurements of all stages, and write them to json_file if given."""
+    if not _enabled:
+        return
+    total = time.time() - _start
+    stages = [{'stage': name, 'calls': _stages[name][0], 'seconds': _stages[name][1],
+               'peak_rss_mb': _stages[name][2], 'trials': _stages[name][3]} for name in _order]
+    print '\n{:<44} {:>6} {:>10} {:>7} {:>13} {:>14}'.format('Stage', 'Calls', 'Seconds', '%', 'Trials/s', 'Peak RSS (MB)')
+    for entry in stages:
+        rate = '{:13.0f}'.format(entry['trials'] / entry['seconds']) if entry['trials'] and entry['seconds'] else ' ' * 13
+        print '{:<44} {:>6} {:>10.3f} {:>7.1f} {} {:>14.1f}'.format(entry['stage'], entry['calls'], entry['seconds'],
+                                                                  100. * entry['seconds'] / total, rate, entry['peak_rss_mb'])
+    print '{:<44} {:>6} {:>10.3f} {:>7.1f} {} {:>14.1f}'.format('total', '', total, 100., ' ' * 13, peak_rss())
+    if json_file:
+        try:
+            with open(json_file, 'w') as f:
+                json.dump({'total_seconds': total, 'peak_rss_mb': peak_rss(), 'stages': stages}, f, indent=2, separators=(',', ': '))
+        except IOError:
+            print "Error: Unable to open profile file {}.".format(json_file)
@@ -0,0 +1,430 @@
+r"""
+Reading and writing of results files, shared by merge.py, bias.py, shuffle.py and ntrials.py.
+
+Two layouts are understood:
+ - the text format described in the README: an optional 'Bias fitted by: a * x' line, the header 'min_flux max_flux n_edges', an optional 'Unblinded' row and then one 'flux llh0 llh1 ... llhN' row per trial.  Text files may be compressed (.gz, .bz2, or .xz if the lzma module is available) and are then decompressed on the fly.
+ - a binary store made by convert.py: a directory holding header.npy, flux.npy and curves.npy, plus bias.npy and unblinded.npy if the text file had them.  Stores are read through np.memmap so nothing is parsed or copied.
+
+The merged trials written by merge.py (true flux, best-fit flux and max TS of each trial) are a headerless text table with a configurable number of significant digits, or a full-precision .npy array if the file name ends with .npy.  Both are written in bulk and read back by read_merged and iter_rows, the .npy array through np.memmap.
+
+The bias factor fitted by bias.py is kept in a small JSON sidecar next to the file or store (results_X.txt -> results_X.txt.bias.json) together with the fit it comes from, so results files are never rewritten.  When a sidecar exists its factor replaces the 'Bias fitted by' line or bias.npy, and a null factor means the trials are not corrected.
+"""
+
+import os
+import json
+import mmap
+import struct
+import gzip
+import bz2
+from array import array
+from itertools import chain, islice, izip
+import numpy as np
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+STORE_SUFFIX = '.trials'
+BIAS_SUFFIX = '.bias.json'
+CHUNK_SIZE = 1 << 24  # Characters of text parsed at a time, bounds the memory used on top of the parsed array
+WRITE_ROWS = 1 << 12  # Trials formatted at a time when writing text
+MERGED_DIGITS = 3  # Significant digits of the merged trials written as text
+NPY_HEADER = 128  # Bytes of the .npy header of the merged trials, padded so that the number of rows can be set once written
+
+
+def open_results(path, mode='r'):
+    """Open a text file for reading or writing, compressed according to its extension."""
+    if path.endswith('.gz'):
+        return gzip.open(path, mode)
+    if path.endswith('.bz2'):
+        return bz2.BZ2File(path, mode)
+    if path.endswith('.xz'):
+        if lzma is None:
+            raise IOError('Error: No lzma module available to read {}.'.format(path))
+        return lzma.open(path, mode)
+    return open(path, mode)
+
+
+def writable(path):
+    """True if path can be written, checked without creating or truncating it."""
+    if os.path.exists(path):
+        return not os.path.isdir(path) and os.access(path, os.W_OK)
+    return os.access(os.path.dirname(os.path.abspath(path)), os.W_OK)
+
+
+def is_store(path):
+    """True if path is a binary store directory rather than a text file."""
+    return os.path.isdir(path)
+
+
+def bias_file(path):
+    """Name of the bias sidecar of a results file or store."""
+    return path.rstrip(os.sep) + BIAS_SUFFIX
+
+
+def read_bias(path):
+    """Content of the bias sidecar of a results file or store as a dict, or None if it has no sidecar."""
+    sidecar = bias_file(path)
+    if not os.path.exists(sidecar):
+        return None
+    with open(sidecar) as f:
+        return json.load(f)
+
+
+def sidecar_bias(path, bias):
+    """The bias factor of the sidecar of path if there is one (None if it removes the correction), bias otherwise."""
+    content = read_bias(path)
+    if content is None:
+        return bias
+    return content['bias']
+
+
+def read_header(path, sidecar=True):
+    """
+    Read only the top of a results file.  Returns the header as (min_flux, max_flux, n_edges), the bias factor (None if absent) and the unblinded curve (None if absent).  The bias of the sidecar, if any, is used unless sidecar is False.
+    """
+    header, bias, unblinded = _read_header(path)
+    if sidecar:
+        bias = sidecar_bias(path, bias)
+    return header, bias, unblinded
+
+
+def _read_header(path):
+    """read_header ignoring the sidecar."""
+    if is_store(path):
+        h = np.load(os.path.join(path, 'header.npy'))
+        bias = None
+        unblinded = None
+        if os.path.exists(os.path.join(path, 'bias.npy')):
+            bias = float(np.load(os.path.join(path, 'bias.npy'))[0])
+        if os.path.exists(os.path.join(path, 'unblinded.npy')):
+            unblinded = np.load(os.path.join(path, 'unblinded.npy'))
+        return (float(h[0]), float(h[1]), int(h[2])), bias, unblinded
+    with open_results(path) as f:
+        return _read_text_header(f)[:3]
+
+
+def _read_text_header(f):
+    """Consume the bias, header and unblinded lines of an open text file.  Also returns the first trial row if it was read."""
+    bias = None
+    unblinded = None
+    words = f.readline().split()
+    if 'Bias' in words:  # if the first line is the bias, get the header from the second line.
+        bias = float(words[3])
+        words = f.readline().split()
+    header = (float(words[0]), float(words[1]), int(words[2]))
+    first_line = f.readline().split()
+    if first_line and first_line[0] == 'Unblinded':
+        unblinded = np.array([float(number) for number in first_line[1:]])
+        first_line = []
+    return header, bias, unblinded, first_line
+
+
+def _read_numbers(f, first_line):
+    """Parse the rest of an open text file, CHUNK_SIZE characters at a time, into a flat array."""
+    chunks = [np.array(first_line, dtype=float)]
+    rest = ''
+    while True:
+        text = f.read(CHUNK_SIZE)
+        if not text:
+            break
+        text = rest + text
+        cut = text.rfind('\n') + 1  # only parse complete lines
+        chunks.append(np.array(text[:cut].split(), dtype=float))
+        rest = text[cut:]
+    chunks.append(np.array(rest.split(), dtype=float))
+    return np.concatenate(chunks)
+
+
+def read_results(path, sidecar=True):
+    """
+    Read a results file or store.  Returns the header as (min_flux, max_flux, n_edges), the bias factor and the unblinded curve (both None if absent), the true flux of each trial (1D array) and the llh curves of the trials (2D array, one row per trial).  The bias of the sidecar, if any, is used unless sidecar is False.
+    """
+    if is_store(path):
+        header, bias, unblinded = read_header(path, sidecar)
+        flux = np.load(os.path.join(path, 'flux.npy'), mmap_mode='r')
+        curves = np.load(os.path.join(path, 'curves.npy'), mmap_mode='r')
+        return header, bias, unblinded, flux, curves
+    with open_results(path) as f:
+        header, bias, unblinded, first_line = _read_text_header(f)
+        trials = _read_numbers(f, first_line)
+    ncols = header[2] + 1
+    if len(trials) % ncols:
+        raise ValueError('Error: {} does not contain rows of {} numbers.'.format(path, ncols))
+    trials = trials.reshape(-1, ncols)
+    if sidecar:
+        bias = sidecar_bias(path, bias)
+    return header, bias, unblinded, trials[:, 0], trials[:, 1:]
+
+
+def _iter_rows(f, path, chunk_rows, first_line=()):
+    """Parse the remaining lines of an open text file chunk_rows at a time into 2D arrays, one row per line."""
+    head = [' '.join(first_line)] if first_line else []
+    ncols = len(first_line) or None
+    while True:
+        lines = head + list(islice(f, chunk_rows - len(head)))
+        head = []
+        if not lines:
+            return
+        numbers = np.array(' '.join(lines).split(), dtype=float)
+        if ncols is None:
+            ncols = len(lines[0].split())
+        if len(numbers) % ncols:
+            raise ValueError('Error: {} does not contain rows of {} numbers.'.format(path, ncols))
+        yield numbers.reshape(-1, ncols)
+
+
+def iter_results(path, chunk_trials):
+    """
+    Read a results file or store chunk_trials trials at a time, so that memory does not depend on the size of the file.  Returns the header, bias factor and unblinded curve as read_results, and a generator of (flux, curves) arrays for each chunk of trials.
+    """
+    header, bias, unblinded = read_header(path)
+    return header, bias, unblinded, _iter_trials(path, chunk_trials)
+
+
+def _iter_trials(path, chunk_trials):
+    if is_store(path):
+        flux = np.load(os.path.join(path, 'flux.npy'), mmap_mode='r')
+        curves = np.load(os.path.join(path, 'curves.npy'), mmap_mode='r')
+        for start in range(0, len(flux), chunk_trials):
+            yield np.array(flux[start:start + chunk_trials]), np.array(curves[start:start + chunk_trials])
+        return
+    with open_results(path) as f:
+        first_line = _read_text_header(f)[3]
+        for trials in _iter_rows(f, path, chunk_trials, first_line):
+            yield trials[:, 0], trials[:, 1:]
+
+
+def read_trial_lines(path, scratch):
+    """
+    Copy the trial lines of a text results file unchanged into the file scratch.  Returns the header, bias factor and unblinded curve as read_header, the true flux of each trial and the offsets of the trial lines in scratch, followed by its size.
+    """
+    fluxes = array('d')
+    offsets = array('l', [0])
+    with open_results(path) as f, open(scratch, 'wb') as out:
+        header, bias, unblinded, first_line = _read_text_header(f)
+        for line in chain([' '.join(first_line) + '\n'] if first_line else [], f):
+            words = line.split(None, 1)
+            if not words:
+                continue
+            if not line.endswith('\n'):
+                line += '\n'
+            out.write(line)
+            fluxes.append(float(words[0]))
+            offsets.append(offsets[-1] + len(line))
+    return header, sidecar_bias(path, bias), unblinded, np.frombuffer(fluxes), np.frombuffer(offsets, dtype=np.int_)
+
+
+def read_appended(path, ncols, offset=0):
+    """
+    Trials of a text results file or store found after offset, the position in bytes (in trials for a store) up to which it was read before, 0 to read all trials.  Only complete lines of a text file are read, so that a line still being written is left for the next call.  Returns the true flux and the curves of the new trials and the offset to give next time.
+    """
+    if is_store(path):
+        flux = np.load(os.path.join(path, 'flux.npy'), mmap_mode='r')
+        curves = np.load(os.path.join(path, 'curves.npy'), mmap_mode='r')
+        return np.array(flux[offset:]), np.array(curves[offset:]), len(flux)
+    if offset > os.path.getsize(path) and not path.endswith(('.gz', '.bz2', '.xz')):
+        raise ValueError('Error: {} is shorter than when it was last read, it was not only appended to.'.format(path))
+    with open_results(path) as f:
+        if offset:
+            f.seek(offset)
+        else:  # skip the bias, header and unblinded lines
+            if 'Bias' in f.readline().split():
+                f.readline()
+            offset = f.tell()
+            if f.readline().split()[:1] == ['Unblinded']:
+                offset = f.tell()
+            f.seek(offset)
+        text = f.read()
+    cut = text.rfind('\n') + 1
+    numbers = np.array(text[:cut].split(), dtype=float)
+    if len(numbers) % ncols:
+        raise ValueError('Error: {} does not contain rows of {} numbers.'.format(path, ncols))
+    trials = numbers.reshape(-1, ncols)
+    return trials[:, 0], trials[:, 1:], offset + cut
+
+
+def read_fluxes(path):
+    """
+    True flux of each trial of a results file or store, without parsing the curves: the flux.npy of a store is memory-mapped, and only the first number of each line of a text file is converted.
+    """
+    if is_store(path):
+        return np.load(os.path.join(path, 'flux.npy'), mmap_mode='r')
+    fluxes = array('d')
+    with open_results(path) as f:
+        first_line = _read_text_header(f)[3]
+        for line in chain([' '.join(first_line)] if first_line else [], f):
+            words = line.split(None, 1)
+            if words:
+                fluxes.append(float(words[0]))
+    return np.frombuffer(fluxes)
+
+
+def is_binary(path):
+    """True if path is merged trials written as a full-precision .npy array rather than text."""
+    return path.endswith('.npy')
+
+
+def read_merged(path):
+    """Merged trials written by write_merged, as a 2D array with one [true flux, best-fit flux, max TS] row per trial."""
+    if is_binary(path):
+        return np.load(path)
+    return np.loadtxt(path)
+
+
+def count_merged(path):
+    """Number of trials in the merged trials written by write_merged, counted without parsing them."""
+    if is_binary(path):
+        return len(np.load(path, mmap_mode='r'))
+    rows = 0
+    with open_results(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), ''):
+            rows += block.count('\n')
+    return rows
+
+
+def iter_rows(path, chunk_rows):
+    """Read the merged trials written by write_merged, or any headerless text file of numbers, chunk_rows rows at a time."""
+    if is_binary(path):
+        rows = np.load(path, mmap_mode='r')
+        for start in range(0, len(rows), chunk_rows):
+            yield np.array(rows[start:start + chunk_rows])
+        return
+    with open_results(path) as f:
+        for rows in _iter_rows(f, path, chunk_rows):
+            yield rows
+
+
+def _npy_header(rows, ncols):
+    """Header of a .npy file holding a (rows, ncols) array of floats, padded to NPY_HEADER bytes."""
+    description = "{'descr': '<f8', 'fortran_order': False, 'shape': (%d, %d), }" % (rows, ncols)
+    description = description.ljust(NPY_HEADER - 11) + '\n'
+    return np.lib.format.magic(1, 0) + struct.pack('<H', len(description)) + description
+
+
+def write_merged(path, blocks, digits=MERGED_DIGITS, append=False):
+    """
+    Write the merged trials given as an iterable of 2D arrays, one row per trial.  A path ending with .npy gets a full-precision array, whose header is rewritten with the number of rows once all blocks are written, and any other path a text table with digits significant digits, formatted WRITE_ROWS rows at a time by a single string operation.  With append, the trials are added at the end of the merged trials already in path.
+    """
+    if is_binary(path):
+        rows, ncols = 0, 3
+        with open(path, 'r+b' if append else 'wb') as f:
+            if append:
+                np.lib.format.read_magic(f)
+                rows, ncols = np.lib.format.read_array_header_1_0(f)[0]
+                if f.tell() != NPY_HEADER:
+                    raise ValueError('Error: Cannot append to {}, it was not written by merge.py.'.format(path))
+                f.seek(0, os.SEEK_END)
+            else:
+                f.write(_npy_header(0, ncols))
+            for block in blocks:
+                rows += len(block)
+                ncols = block.shape[1]
+                f.write(np.ascontiguousarray(block, dtype='<f8').tostring())
+            f.seek(0)
+            f.write(_npy_header(rows, ncols))
+        return
+    number = '%.{}e'.format(digits - 1)
+    with open_results(path, 'a' if append else 'w') as f:
+        for block in blocks:
+            line_format = ' '.join([number] * block.shape[1]) + '\n'
+            for start in range(0, len(block), WRITE_ROWS):
+                rows = block[start:start + WRITE_ROWS]
+                f.write((line_format * len(rows)) % tuple(rows.ravel()))
+
+
+def text_header(header, bias, unblinded, fmt='%0.2e'):
+    """The bias, header and unblinded lines of a text results file, as a string."""
+    lines = []
+    if bias is not None:
+        lines.append('Bias fitted by: {0:.3f} * x'.format(bias))
+    lines.append('{:g} {:g} {}'.format(*header))
+    if unblinded is not None:
+        lines.append('Unblinded ' + ' '.join(fmt % value for value in unblinded))
+    return '\n'.join(lines) + '\n'
+
+
+def write_text(path, header, bias, unblinded, flux, curves, fmt='%0.2e'):
+    """Write the content of a results file in the text format."""
+    write_text_chunks(path, header, bias, unblinded, [(flux, curves)], fmt)
+
+
+def write_text_chunks(path, header, bias, unblinded, chunks, fmt='%0.2e'):
+    """
+    Write a results file in the text format from an iterable of (flux, curves) chunks of trials, so that the trials do not need to be in memory at once.  The lines are the ones np.savetxt writes, formatted WRITE_ROWS at a time by a single string operation.
+    """
+    line_format = ' '.join([fmt] * (header[2] + 1)) + '\n'
+    with open_results(path, 'w') as f:
+        f.write(text_header(header, bias, unblinded, fmt))
+        for flux, curves in chunks:
+            for start in range(0, len(flux), WRITE_ROWS):
+                rows = np.column_stack([flux[start:start + WRITE_ROWS], curves[start:start + WRITE_ROWS]])
+                f.write((line_format * len(rows)) % tuple(rows.ravel()))
+
+
+def write_lines(path, header, bias, unblinded, scratch, offsets, order):
+    """
+    Write a text results file whose trial lines are copied unchanged from the file scratch in the given order, offsets being the positions of the lines in scratch as returned by read_trial_lines.
+    """
+    starts = offsets[:-1][order]
+    ends = offsets[1:][order]
+    with open(scratch, 'rb') as f:
+        lines = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        with open_results(path, 'w') as out:
+            out.write(text_header(header, bias, unblinded))
+            for start in range(0, len(order), WRITE_ROWS):
+                out.write(''.join([lines[begin:end] for begin, end in izip(starts[start:start + WRITE_ROWS].tolist(),
+                                                                          ends[start:start + WRITE_ROWS].tolist())]))
+    finally:
+        lines.close()
+
+
+def write_store(path, header, bias, unblinded, flux, curves):
+    """Write the content of a results file as a binary store directory."""
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    np.save(os.path.join(path, 'header.npy'), np.array(header, dtype=float))
+    np.save(os.path.join(path, 'flux.npy'), np.ascontiguousarray(flux, dtype=float))
+    np.save(os.path.join(path, 'curves.npy'), np.ascontiguousarray(curves, dtype=float))
+    write_store_bias(path, bias)
+    unblinded_file = os.path.join(path, 'unblinded.npy')
+    if unblinded is not None:
+        np.save(unblinded_file, np.asarray(unblinded, dtype=float))
+    elif os.path.exists(unblinded_file):
+        os.remove(unblinded_file)
+
+
+def write_store_bias(path, bias):
+    """Set (or remove if bias is None) the bias factor of a binary store."""
+    bias_file = os.path.join(path, 'bias.npy')
+    if bias is not None:
+        np.save(bias_file, np.array([bias]))
+    elif os.path.exists(bias_file):
+        os.remove(bias_file)
+
+
+def write_bias(path, bias, fit=None):
+    """
+    Set the bias factor of a results file or store in its sidecar, or mark its trials as not corrected if bias is None.  The factor is kept to 3 decimals as in the text format, fit is an optional dict describing the fit stored along with it.  The results file itself is left untouched, and the sidecar is replaced atomically through a temporary file.
+    """
+    content = dict(fit or {})
+    content['bias'] = None if bias is None else round(bias, 3)
+    sidecar = bias_file(path)
+    temp_file = os.path.join(os.path.dirname(sidecar), 'temporary_{}_{}'.format(os.getpid(), os.path.basename(sidecar)))
+    with open(temp_file, 'w') as f:
+        json.dump(content, f, indent=2, sort_keys=True, separators=(',', ': '))
+    os.rename(temp_file, sidecar)
+
+
+def store_name(path):
+    """Default store name for a text results file: results_X.txt(.gz) -> results_X.trials"""
+    for extension in ['.gz', '.bz2', '.xz']:
+        if path.endswith(extension):
+            path = path[:-len(extension)]
+    if path.endswith('.txt'):
+        path = path[:-len('.txt')]
+    return path + STORE_SUFFIX
@@ -3,14 +3,22 @@
 r"""
 Read and display test statistics in sensitivity calculation. Assumes input file has 3 columns: True Flux, Best-fit Flux, and TS.
 
+The sensitivity and upper limit are the fluxes at which erf fits of the fractions of trials above the background median, and above the unblinded TS, reach 90%.  Options add the bootstrap intervals of these values, the Neyman belt at several confidence levels, the statistical errors with the trials per flux needed for a target precision, and the fit of the upper tail of the background TS distribution (see tail.py).
+
+The lower edge of the Neyman belt is the TS above which a fraction CL of the trials of every true flux lie, taken for all levels at once from the sorted TS of each flux.  At each level, the sensitivity is the true flux at which the fraction of trials above the background median reaches the level, interpolated between true fluxes, and the upper limit the one at which the fraction above the unblinded TS does; the crossings of the level by the erf fits are given next to them.
+
+The statistical error of a crossing is propagated from the binomial errors of the fractions through the linearized erf fit.  The trials needed for a target precision are spread to minimize their total: each flux gets trials in proportion to the square root of its contribution to the variance, without going below the trials already made.
 """
 
 r"""
-usage: sensitivity.py [-h] [--hide] [--unblinded] [--save [SAVE]] [FILE]
+usage: sensitivity.py [-h] [--hide] [--unblinded] [--save [SAVE]]
+                      [--bootstrap BOOTSTRAP] [--chunk CHUNK]
+                      [--belt [CL [CL ...]]] [--advise [PRECISION]] [--tail]
+                      [--profile [PROFILE]] [FILE]
 
 positional arguments:
   FILE           Path to input file containing results of (pre-merged)
-                 scrambled trials.
+                 scrambled trials, as text or as a .npy array.
 
 optional arguments:
   -h, --help     show this help message and exit
@@ -18,60 +26,288 @@ optional arguments:
   --unblinded    Set to get the p-value of the unblinded data.
   --save [SAVE]  Set to save the most usefull plots with SAVE as a filename
                  extension.
+  --bootstrap BOOTSTRAP
+                 Number of bootstrap replicas used to give intervals on the
+                 sensitivity, upper limit and p-value.
+  --chunk CHUNK  Number of trials read at a time, so that memory does not
+                 grow with the number of trials. The statistics take a few
+                 passes over the file. 0 reads the whole file.
+  --belt [CL [CL ...]]
+                 Set to also get the sensitivity and upper limit at each
+                 confidence level CL (in percent, 68 90 95 99 by default)
+                 from the Neyman belt, all computed at once.
+  --advise [PRECISION]
+                 Set to print the statistical errors of the sensitivity and
+                 upper limit, and the number of trials needed at each flux
+                 to reach the relative precision PRECISION (0.02 by
+                 default).
+  --tail         Set to fit the upper tail of the background TS
+                 distribution (zero plus chi-square, and exponential
+                 models), to extrapolate the p-value below one over the
+                 number of background trials and get the 3 and 5 sigma
+                 discovery potentials.
+  --profile [PROFILE]
+                 Set to print the time, number of calls and peak memory of
+                 each stage, and to also write them as JSON to PROFILE if
+                 given.
 """
 # Flux are in units [1/GeV/cm^2/s] or scaling factors relative to a specified model
 # And TS should be log( likelihood ) [unitless]
 
 import sys
 import argparse
-import matplotlib.pyplot as plt
 import scipy
 # from scipy.interpolate import UnivariateSpline
 from scipy.optimize import leastsq
+from scipy.special import erf, erfinv
+from scipy import stats
 import numpy as np
-
-
-def main(infile, hide, unblinded, save_name):
-    try:
-        data = np.loadtxt(infile)
-    except IOError:
-        print "Error: Input file {} missing.".format(infile)
-        return 0
-
-    # Find median of the null hypothesis
-    ts_null = data[data[:, 0] == 0.0][:, 2]  # Isolate the list of all TS values for flux==0
-    median_bg = np.median(ts_null)
-    print 'median of the background-only trials is {}'.format(median_bg)
-
+from trial_table import TrialTable, StreamingTable
+from results_io import iter_rows, read_merged
+from plotting import wanted, pyplot
+import profiling
+import tail
+
+BELT_LEVELS = [68., 90., 95., 99.]  # Confidence levels of --belt in percent, when none is given
+DISCOVERY_SIGMAS = [3., 5.]  # Significances of the discovery potentials of --tail
+
+
+def fit_erf(fluxes, fractions, p_start, iterations=50):
+    """
+    Least-squares fit of erf(p[0]*x+p[1]) to every row of fractions at once, by damped Gauss-Newton steps started from p_start. Returns one row of parameters per row of fractions (nan where the fit failed).
+    """
+    params = np.tile(np.asarray(p_start, dtype=float), (len(fractions), 1))
+    damping = 1e-3
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        for _ in range(iterations):
+            z = params[:, :1] * fluxes + params[:, 1:]
+            residuals = erf(z) - fractions
+            jb = 2. / np.sqrt(np.pi) * np.exp(-z ** 2)  # derivative with respect to p[1]
+            ja = jb * fluxes  # derivative with respect to p[0]
+            # Solve the 2x2 normal equations of every row
+            aa = np.sum(ja * ja, axis=1) * (1. + damping)
+            bb = np.sum(jb * jb, axis=1) * (1. + damping)
+            ab = np.sum(ja * jb, axis=1)
+            ra = np.sum(ja * residuals, axis=1)
+            rb = np.sum(jb * residuals, axis=1)
+            det = aa * bb - ab ** 2
+            params[:, 0] -= (bb * ra - ab * rb) / det
+            params[:, 1] -= (aa * rb - ab * ra) / det
+    return params
+
+
+def erf_crossing(params, level=0.9):
+    """Flux at which erf(p[0]*x+p[1]) reaches level, for every row of params.  nan for the fits that do not rise with the flux."""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(params[:, 0] > 0, (erfinv(level) - params[:, 1]) / params[:, 0], np.nan)
+
+
+def fit_crossing(name, fluxes, params, level=0.9):
+    """erf_crossing of the fit params, with a warning if there is none or if it lies outside the true fluxes, where it is extrapolated."""
+    crossing = erf_crossing(np.array([params]), level)[0]
+    if not np.isfinite(crossing):
+        print 'Warning: the erf fit of the {} does not rise with the flux, no {:g}% crossing'.format(name.lower(), 100. * level)
+    elif crossing > fluxes[-1]:
+        print 'Warning: {} {:0.3f} is above the largest true flux {}, extrapolated by the erf fit'.format(name, crossing, fluxes[-1])
+    elif crossing < fluxes[0]:
+        print 'Warning: {} {:0.3f} is below the smallest true flux {}, extrapolated by the erf fit'.format(name, crossing, fluxes[0])
+    return crossing
+
+
+def bootstrap(table, nboot, p_sens, ts_unblinded=None, p_ul=None):
+    """
+    Resample the trials of each true flux of a TrialTable nboot times and redo the background median, the fractions above it (and above ts_unblinded) and the erf fits for all replicas at once. Returns the sensitivity, upper limit and p-value of every replica (the last two None if ts_unblinded is None).
+    """
+    unique_fluxes = table.fluxes
+    groups = table.groups(2)
+    null = table.index(0.)
+    samples_null = groups[null][np.random.randint(len(groups[null]), size=(nboot, len(groups[null])))]
+    medians_bg = np.median(samples_null, axis=1)
+    ps = np.zeros((nboot, len(unique_fluxes)))
+    cl = np.zeros((nboot, len(unique_fluxes)))
+    for i, ts in enumerate(groups):  # one resampling per true flux, each for all replicas
+        if i == null:
+            samples = samples_null
+        else:
+            samples = ts[np.random.randint(len(ts), size=(nboot, len(ts)))]
+        ps[:, i] = np.mean(samples > medians_bg[:, None], axis=1)
+        if ts_unblinded is not None:
+            cl[:, i] = np.mean(samples > ts_unblinded, axis=1)
+    sens = erf_crossing(fit_erf(unique_fluxes, ps, p_sens))
+    if ts_unblinded is None:
+        return sens, None, None
+    uls = erf_crossing(fit_erf(unique_fluxes, cl, p_ul))
+    p_values = np.mean(samples_null > ts_unblinded, axis=1)
+    return sens, uls, p_values
+
+
+def belt_crossing(fluxes, fractions, levels):
+    """
+    Lowest true flux at which the fraction of trials above a threshold, given at every true flux, reaches each of levels (fractions), linearly interpolated between true fluxes.  nan for the levels never reached.
+    """
+    reached = fractions >= levels[:, None]
+    first = np.argmax(reached, axis=1)
+    previous = np.maximum(first - 1, 0)
+    low = fractions[previous]
+    high = fractions[first]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        weight = np.where(first > previous, (levels - low) / (high - low), 0.)
+    crossing = fluxes[previous] + weight * (fluxes[first] - fluxes[previous])
+    return np.where(reached.any(axis=1), crossing, np.nan)
+
+
+def neyman_belt(table, levels, ps, p_sens, cl=None, p_ul=None):
+    """Lower edge of the Neyman belt at the confidence levels (in percent), and one row [level, sensitivity, its erf fit value, upper limit, its erf fit value] per level, nan upper limits if cl is None."""
+    levels = np.asarray(levels, dtype=float)
+    edges = table.percentiles(100. - levels, 2)
+    rows = np.full((len(levels), 5), np.nan)
+    rows[:, 0] = levels
+    rows[:, 1] = belt_crossing(table.fluxes, ps, levels / 100.)
+    rows[:, 2] = erf_crossing(np.array([p_sens]), levels / 100.)
+    if cl is not None:
+        rows[:, 3] = belt_crossing(table.fluxes, cl, levels / 100.)
+        rows[:, 4] = erf_crossing(np.array([p_ul]), levels / 100.)
+    return edges, rows
+
+
+def print_belt(rows):
+    """Print the sensitivities and upper limits of neyman_belt, one line per confidence level."""
+    print '\n{:>6} {:>12} {:>12} {:>12} {:>12}'.format('CL (%)', 'Sensitivity', '(erf fit)', 'Upper limit', '(erf fit)')
+    for row in rows:
+        print '{:>6g} '.format(row[0]) + ' '.join('{:>12}'.format('-' if np.isnan(value) else '{:0.3f}'.format(value)) for value in row[1:])
+
+
+def crossing_influence(fluxes, params, level=0.9):
+    """
+    Derivative of the crossing of level by the erf fit params with respect to the fraction at each true flux, through the linearized least-squares fit.
+    """
+    a, b = params
+    g = 2. / np.sqrt(np.pi) * np.exp(-(a * fluxes + b) ** 2)
+    jacobian = np.column_stack([fluxes * g, g])
+    crossing = (erfinv(level) - b) / a
+    gradient = np.array([-crossing / a, -1. / a])
+    return gradient.dot(np.linalg.pinv(jacobian))  # pinv(J) = (J^T J)^-1 J^T
+
+
+def trial_budget(fluxes, fractions, counts, params, target, level=0.9):
+    """Crossing of level by the erf fit params of fractions, its statistical error (nan without a positive crossing), the trials needed at each flux for a relative error target and the share of the variance of each flux."""
+    counts = np.asarray(counts, dtype=float)
+    crossing = erf_crossing(np.array([params]), level)[0]
+    if not crossing > 0:  # also nan
+        return crossing, np.nan, counts.astype(int), np.zeros(len(counts))
+    p = (fractions * counts + 0.5) / (counts + 1.)  # keeps a variance at fractions of 0 or 1
+    weights = crossing_influence(fluxes, params, level) ** 2 * p * (1. - p)  # variance = sum(weights / counts)
+    variance = np.sum(weights / counts)
+    wanted_variance = (target * crossing) ** 2
+    needed = counts.copy()
+    fixed = np.zeros(len(counts), dtype=bool)
+    while True:  # fluxes that already have more trials than their share keep them
+        free = ~fixed & (weights > 0)
+        left = wanted_variance - np.sum(weights[fixed] / counts[fixed])
+        if not free.any() or left <= 0:
+            break
+        share = np.sqrt(weights[free]) * np.sum(np.sqrt(weights[free])) / left
+        newly_fixed = np.flatnonzero(free)[share < counts[free]]
+        needed[free] = np.maximum(share, counts[free])
+        if not len(newly_fixed):
+            break
+        fixed[newly_fixed] = True
+    return crossing, np.sqrt(variance), np.ceil(needed).astype(int), weights / counts / variance
+
+
+def print_budget(name, fluxes, counts, value, error, needed, shares, target):
+    """Print the statistical error of a result and the trials per flux needed to reach the relative error target, from trial_budget."""
+    if not value > 0:
+        print '\n{} is {:0.3f}, no trial budget without a positive crossing'.format(name, value)
+        return
+    print '\n{} is {:0.3f} +- {:0.3f} ({:0.1f}%), target {:0.1f}%'.format(name, value, error, 100. * error / value, 100. * target)
+    print '{:>10} {:>8} {:>8} {:>8} {:>9}'.format('Flux', 'Trials', 'Needed', 'More', 'Variance')
+    for flux, count, need, share in zip(fluxes, counts, needed, shares):
+        print '{:>10.2e} {:>8} {:>8} {:>8} {:>8.1f}%'.format(flux, count, need, max(need - count, 0), 100. * share)
+    more = np.sum(np.maximum(needed - counts, 0))
+    if more:
+        print '{} more trials needed, best spent at the fluxes with the largest share of the variance'.format(more)
+    else:
+        print 'Target reached, no more trials needed'
+
+
+def discovery_potential(table, threshold, threshold_error):
+    """
+    Flux at which half of the trials have a TS above threshold, from the erf fit of the fractions above it, with its statistical error from the binomial errors of the fractions and its error from threshold_error.  nan if the fractions never reach one half.
+    """
+    def crossing(ts):
+        fractions = table.fractions_above(ts, 2)
+        if fractions.max() < 0.5:
+            return np.nan, None, fractions
+        params, _ = leastsq(lambda p: erf(p[0] * table.fluxes + p[1]) - fractions, [1., 1.])
+        return erf_crossing(np.array([params]), 0.5)[0], params, fractions
+
+    flux, params, fractions = crossing(threshold)
+    if params is None:
+        return np.nan, np.nan, np.nan
+    statistical = trial_budget(table.fluxes, fractions, table.counts, params, 1., 0.5)[1]
+    low, _, _ = crossing(max(threshold - threshold_error, 0.))
+    high, _, _ = crossing(threshold + threshold_error)
+    return flux, statistical, abs(high - low) / 2.
+
+
+def tail_report(table, null, ts_unblinded=None, p_value=None):
+    """
+    Fit the tail models of tail.py to the background trials, print their goodness of fit, the extrapolated p-value of ts_unblinded if given and the discovery potentials at DISCOVERY_SIGMAS.  Returns the models.
+    """
+    background = table.group(null, 2)
+    models = tail.fit_models(background)
+    if not models:
+        print '\nToo few background trials above 0 to fit the tail'
+        return models
+    print '\nTail models of the {} background trials:'.format(len(background))
+    for model in models:
+        print '{:<12} fitted to {} trials above TS {:0.3g}, parameters {}, KS test p-value {:0.3f}'.format(
+            model.name, model.ntrials, model.start, ' '.join('{:0.4g}'.format(p) for p in model.params), model.ks_pvalue)
+    if ts_unblinded is not None:
+        print 'Counted p-value is {:0.3g} ({} of {} trials)'.format(p_value, int(round(p_value * len(background))), len(background))
+        for model in models:
+            if not model.applies(ts_unblinded):
+                print '{:<12} does not apply below TS {:0.3g}, use the counted p-value'.format(model.name, model.start)
+                continue
+            p, low, high = model.p_value(ts_unblinded)
+            print '{:<12} p-value is {:0.3g}, 68% interval [{:0.3g}, {:0.3g}], {:0.2f} sigma'.format(model.name, p, low, high, stats.norm.isf(p))
+    for sigma in DISCOVERY_SIGMAS:
+        p = stats.norm.sf(sigma)
+        for model in models:
+            threshold, threshold_error = model.isf(p)
+            if np.isnan(threshold):
+                print '{:g} sigma discovery potential ({}): threshold below TS {:0.3g}, where the model does not apply'.format(sigma, model.name, model.start)
+                continue
+            flux, statistical, systematic = discovery_potential(table, threshold, threshold_error)
+            if np.isnan(flux):
+                print '{:g} sigma discovery potential ({}): TS > {:0.2f}, not reached by half of the trials at the largest true flux'.format(sigma, model.name, threshold)
+            else:
+                print '{:g} sigma discovery potential ({}): TS > {:0.2f} +- {:0.2f}, flux {:0.3f} +- {:0.3f} (trials) +- {:0.3f} (tail fit)'.format(
+                    sigma, model.name, threshold, threshold_error, flux, statistical, systematic)
+    return models
+
+
+def print_interval(name, value, replicas):
+    """Print a value with the 68% and 90% central intervals of its bootstrap replicas."""
+    low68, high68, low90, high90 = np.nanpercentile(replicas, [16, 84, 5, 95])
+    print '{} is {:0.3f}, 68% interval [{:0.3f}, {:0.3f}], 90% interval [{:0.3f}, {:0.3f}], std {:0.3f}'.format(
+        name, value, low68, high68, low90, high90, np.nanstd(replicas))
+
+
+def plot_ts_distributions(plt, table, save_name, ts_unblinded=None, p_value=None):
+    """Background anticumulative and model flux cumulative TS distributions, with the p-value of ts_unblinded if given."""
     plt.figure()
     plt.yscale('log')
     plt.xlabel('TS')
     bin_width = 0.2
     bins = np.arange(0, 80, bin_width)
-    flux_unblinded = 0
-    ts_unblinded = 0
-    ul = 0. # upper limit
-
-    if unblinded:
-        if data[0, 0] != -1:
-            print "Error: no unblinded results in", infile
-            exit(0)
-        flux_unblinded = data[0, 1]
-        ts_unblinded = data[0, 2]
-        data = data[1:]
-
-        p_value = float(len(ts_null[ts_null > ts_unblinded])) / float(len(ts_null))
-
-    unique_fluxes = np.unique(data[:, 0])  # sorted
-    print 'Sorted list of unique fluxes: {})'.format(unique_fluxes)
-    ps = []
-    cl = [] # Confidence level: probability to have a test statistic larger than ts_unblinded
-    for flux in unique_fluxes:
-        ts = data[data[:, 0] == flux][:, 2]  # Isolate the list of all TS values for this True Flux
+    for i, flux in enumerate(table.fluxes):
+        ts = table.group(i, 2)  # All TS values for this True Flux
         if flux == 0.:
             plt.hist(ts, bins, normed=True, cumulative=-1, histtype='step', color='r', lw=2, label='Background anticumulative')
 
-            if unblinded:
+            if ts_unblinded is not None:
                 plt.plot([ts_unblinded, ts_unblinded], [0., p_value], 'g', lw=2)
                 plt.plot([0, ts_unblinded], [p_value, p_value], 'g', lw=2, label='p-value')
                 ax = plt.gca()
@@ -92,13 +328,75 @@ def main(infile, hide, unblinded, save_name):
             ax.legend(loc='lower center')
             if save_name:
                 plt.savefig('plots/TS_distrib_'+save_name+'.png')
-        p = float(len(ts[ts > median_bg])) / float(len(ts))  # count how many have TS higher than the median from background
-        if unblinded:
-            cl.append(float(len(ts[ts > ts_unblinded])) / float(len(ts)))
-        print 'number of entries with flux {} is {} with {}% over the median from background.'.format(flux, len(ts), p * 100)
-        ps.append(p)
 
-    xs = np.linspace(unique_fluxes[0], unique_fluxes[-1:], 1000)
+
+def plot_belt(plt, fluxes, levels, edges, median_bg, ts_unblinded=None):
+    """Lower edge of the Neyman belt of every confidence level vs true flux, with the background median and the unblinded TS."""
+    plt.figure()
+    plt.xlabel('Flux')
+    plt.ylabel('TS')
+    for level, edge in zip(levels, edges):
+        plt.plot(fluxes, edge, 'o-', ms=4, lw=2, label='{:g}% CL'.format(level))
+    plt.axhline(median_bg, color='k', ls='--', label='Background median')
+    if ts_unblinded is not None:
+        plt.axhline(ts_unblinded, color='g', lw=2, label='Unblinded TS')
+    plt.legend(loc='upper left')
+
+
+def plot_crossing(plt, fluxes, fractions, xs, fitted, crossing, ylabel, name):
+    """Fractions per true flux with their erf fit and the 90% crossing."""
+    plt.figure()
+    plt.xlabel('Flux')
+    plt.ylabel(ylabel)
+    plt.plot(fluxes, fractions, 'ko', xs, fitted, 'r', ms=5, lw=3) # Plot of the data and the fit
+    ax = plt.gca()
+    ymin, _ = ax.get_ylim()
+    plt.plot([crossing, crossing], [ymin, 0.9], 'g', lw=2)
+    plt.plot([0, crossing], [0.9, 0.9], 'g', lw=2)
+    ax.text(0.95, 0.15, '{}: {:0.2f}'.format(name, crossing),
+            verticalalignment='top', horizontalalignment='right',
+            transform=ax.transAxes,
+            color='g', fontsize=18)
+
+
+def sensitivity(data, hide, unblinded, save_name, nboot=0, levels=None, target=None, tail_fit=False):
+    """Compute the sensitivity (and the p-value and upper limit if unblinded) from merged trials or a StreamingTable, and return the sensitivity and upper limit, or None on error."""
+    if levels is not None:
+        levels = levels or BELT_LEVELS
+        if not all(0. < level < 100. for level in levels):
+            print "Error: confidence levels must be percentages between 0 and 100"
+            return None
+    flux_unblinded = 0
+    ts_unblinded = 0
+    ul = 0. # upper limit
+    streaming = isinstance(data, StreamingTable)
+    if unblinded:
+        unblinded_row = data.unblinded if streaming else data[0]
+        if unblinded_row is None or unblinded_row[0] != -1:
+            print "Error: no unblinded results in the merged trials"
+            return None
+        flux_unblinded = unblinded_row[1]
+        ts_unblinded = unblinded_row[2]
+        if not streaming:
+            data = data[1:]
+
+    with profiling.stage('group', np.sum(data.counts) if streaming else len(data)):
+        table = data if streaming else TrialTable(data)  # trials grouped by true flux
+        # Find median of the null hypothesis
+        null = table.index(0.)
+        median_bg = table.medians(2)[null]
+    print 'median of the background-only trials is {}'.format(median_bg)
+
+    unique_fluxes = table.fluxes  # sorted
+    print 'Sorted list of unique fluxes: {})'.format(unique_fluxes)
+    with profiling.stage('group', np.sum(table.counts)):
+        ps = table.fractions_above(median_bg, 2)  # how many have TS higher than the median from background
+        cl = table.fractions_above(ts_unblinded, 2)  # Confidence level: probability to have a test statistic larger than ts_unblinded
+    p_value = cl[null]  # fraction of the background-only trials with TS > ts_unblinded
+    for i, flux in enumerate(unique_fluxes):
+        print 'number of entries with flux {} is {} with {}% over the median from background.'.format(flux, table.counts[i], ps[i] * 100)
+
+    xs = np.linspace(unique_fluxes[0], unique_fluxes[-1], 1000)
     # Find the 90% crossing point using the spline interpolation for sensitivity
     # spl_ps = UnivariateSpline(unique_fluxes, ps, k=3, s=0.1)
     # for x in xs:
@@ -110,13 +408,11 @@ def main(infile, hide, unblinded, save_name):
     fitfunc = lambda p, x: scipy.special.erf(p[0]*x+p[1]) # 1-np.exp(p[0]*x+p[1]))*p[2] # Target function
     errfunc = lambda p, x, y: fitfunc(p, x) - y # Distance to the target function
     p0 = [1., 1.] # Initial guess for the parameters
-    p1, _ = leastsq(errfunc, p0[:], args=(unique_fluxes, ps))
-    # plt.plot(unique_fluxes, ps, 'ko', xs, fitfunc(p1, xs), "r-", ms=5, lw=3) # Plot of the data and the fit
+    with profiling.stage('erf fit'):
+        p1, _ = leastsq(errfunc, p0[:], args=(unique_fluxes, ps))
+        # plt.plot(unique_fluxes, ps, 'ko', xs, fitfunc(p1, xs), "r-", ms=5, lw=3) # Plot of the data and the fit
 
-    for x in xs:
-        if fitfunc(p1, x) > 0.9:
-            sens = x
-            break
+        sens = fit_crossing('Sensitivity', unique_fluxes, p1)  # same estimator as the bootstrap replicas
 
     print '\nSensitivity is: {:0.3f}'.format(sens)
 
@@ -129,52 +425,91 @@ def main(infile, hide, unblinded, save_name):
         #         break
 
         # Find the 90% crossing point fitting with erf
-        p2, _ = leastsq(errfunc, p0[:], args=(unique_fluxes, cl))
-
-        for x in xs:
-            if fitfunc(p2, x) > 0.9:
-                ul = x
-                break
-
-        plt.figure()
-        plt.xlabel('Flux')
-        plt.ylabel('Fraction with TS > unblinded TS')
-        # plt.plot(unique_fluxes, cl, 'ko', ms=5)
-        # plt.plot(xs, fitfunc(p2, xs), 'r', lw=3)
-        plt.plot(unique_fluxes, cl, 'ko', xs, fitfunc(p2, xs), 'r', ms=5, lw=3) # Plot of the data and the fit
-        ax = plt.gca()
-        ymin, _ = ax.get_ylim()
-        plt.plot([ul, ul], [ymin, 0.9], 'g', lw=2)
-        plt.plot([0, ul], [0.9, 0.9], 'g', lw=2)
-        ax.text(0.95, 0.15, 'Upper limit: {:0.2f}'.format(ul),
-                verticalalignment='top', horizontalalignment='right',
-                transform=ax.transAxes,
-                color='g', fontsize=18)
-        if save_name:
-            plt.savefig('plots/UpperLimit_'+save_name+'.pdf')
+        with profiling.stage('erf fit'):
+            p2, _ = leastsq(errfunc, p0[:], args=(unique_fluxes, cl))
+
+            ul = fit_crossing('Upper limit', unique_fluxes, p2)
 
         print 'Fitted flux is', flux_unblinded
         print 'p-value is', p_value * 100, '%'
         print 'Upper limit at 90% confidence level is {:0.2f}'.format(ul)
 
-    plt.figure()
-    plt.xlabel('Flux')
-    plt.ylabel('Fraction with TS > background median')
-    # plt.plot(unique_fluxes, ps, 'ko', ms=5)
-    # plt.plot(xs, spl_ps(xs), 'r', lw=3)
-    plt.plot(unique_fluxes, ps, 'ko', xs, fitfunc(p1, xs), 'r', ms=5, lw=3) # Plot of the data and the fit
-    ax = plt.gca()
-    ymin, _ = ax.get_ylim()
-    plt.plot([sens, sens], [ymin, 0.9], 'g', lw=2)
-    plt.plot([0, sens], [0.9, 0.9], 'g', lw=2)
-    ax.text(0.95, 0.15, 'Sensitivity: {:0.2f}'.format(sens),
-            verticalalignment='top', horizontalalignment='right',
-            transform=ax.transAxes,
-            color='g', fontsize=18)
-    if save_name:
-        plt.savefig('plots/Sensitivity_'+save_name+'.pdf')
-    if not hide:
-        plt.show()
+    if levels is not None:
+        with profiling.stage('belt', np.sum(table.counts)):
+            edges, belt = neyman_belt(table, levels, ps, p1, cl if unblinded else None, p2 if unblinded else None)
+        print_belt(belt)
+
+    if target:
+        with profiling.stage('trial budget'):
+            budget = trial_budget(unique_fluxes, ps, table.counts, p1, target)
+        print_budget('Sensitivity', unique_fluxes, table.counts, *budget, target=target)
+        if unblinded:
+            with profiling.stage('trial budget'):
+                budget = trial_budget(unique_fluxes, cl, table.counts, p2, target)
+            print_budget('Upper limit', unique_fluxes, table.counts, *budget, target=target)
+        print 'The errors only count the binomial fluctuations of the fractions; --bootstrap also includes those of the background median.'
+
+    models = []
+    if tail_fit and streaming:
+        print '\nThe tail fit needs the trials in memory, run without --chunk'
+    elif tail_fit:
+        with profiling.stage('tail fit'):
+            models = tail_report(table, null, ts_unblinded if unblinded else None, p_value)
+
+    if nboot and streaming:
+        print '\nBootstrap intervals need the trials in memory, run without --chunk'
+    elif nboot:
+        print '\nBootstrap with {} replicas:'.format(nboot)
+        with profiling.stage('bootstrap', nboot * np.sum(table.counts)):
+            if unblinded:
+                boot_sens, boot_ul, boot_p = bootstrap(table, nboot, p1, ts_unblinded, p2)
+            else:
+                boot_sens, boot_ul, boot_p = bootstrap(table, nboot, p1)
+        print_interval('Sensitivity', sens, boot_sens)
+        if unblinded:
+            print_interval('Upper limit', ul, boot_ul)
+            print_interval('p-value', p_value, boot_p)
+
+    if wanted(hide, save_name):
+        with profiling.stage('plot'):
+            plt = pyplot(not hide)
+            # The TS distributions need the trials in memory
+            if unblinded and not streaming:
+                plot_ts_distributions(plt, table, save_name, ts_unblinded, p_value)
+            elif not streaming:
+                plot_ts_distributions(plt, table, save_name)
+            if unblinded:
+                plot_crossing(plt, unique_fluxes, cl, xs, fitfunc(p2, xs), ul, 'Fraction with TS > unblinded TS', 'Upper limit')
+                if save_name:
+                    plt.savefig('plots/UpperLimit_'+save_name+'.pdf')
+            plot_crossing(plt, unique_fluxes, ps, xs, fitfunc(p1, xs), sens, 'Fraction with TS > background median', 'Sensitivity')
+            if save_name:
+                plt.savefig('plots/Sensitivity_'+save_name+'.pdf')
+            if models:
+                tail.plot_tail(plt, table.group(null, 2), models, ts_unblinded if unblinded else None)
+                if save_name:
+                    plt.savefig('plots/Tail_'+save_name+'.pdf')
+            if levels is not None:
+                plot_belt(plt, unique_fluxes, levels, edges, median_bg, ts_unblinded if unblinded else None)
+                if save_name:
+                    plt.savefig('plots/Belt_'+save_name+'.pdf')
+        if not hide:
+            plt.show()
+    return sens, ul
+
+
+def main(infile, hide, unblinded, save_name, nboot=0, chunk_size=0, levels=None, target=None, tail_fit=False):
+    try:
+        with profiling.stage('read'):
+            if chunk_size:
+                data = StreamingTable(lambda: iter_rows(infile, chunk_size))
+            else:
+                data = read_merged(infile)
+    except IOError:
+        print "Error: Input file {} missing.".format(infile)
+        return 0
+    if sensitivity(data, hide, unblinded, save_name, nboot, levels, target, tail_fit) is None:
+        return 0
 
 
 if __name__ == "__main__":
@@ -185,7 +520,7 @@ if __name__ == "__main__":
         nargs="?",
         default='',
         type=str,
-        help="Path to input file containing results of (pre-merged) scrambled trials.",
+        help="Path to input file containing results of (pre-merged) scrambled trials, as text or as a .npy array.",
         metavar="FILE")
 
     # Hide flag
@@ -210,8 +545,60 @@ if __name__ == "__main__":
         type=str,
         help='Set to save the most usefull plots with SAVE as a filename extension.')
 
+    # Bootstrap replicas
+    parser.add_argument(
+        '--bootstrap',
+        default=0,
+        type=int,
+        help='Number of bootstrap replicas used to give intervals on the sensitivity, upper limit and p-value.')
+
+    # Streaming
+    parser.add_argument(
+        '--chunk',
+        default=0,
+        type=int,
+        help='Number of trials read at a time, so that memory does not grow with the number of trials. The statistics take a few passes over the file. 0 reads the whole file.')
+
+    # Confidence belt
+    parser.add_argument(
+        '--belt',
+        nargs="*",
+        default=None,
+        type=float,
+        metavar='CL',
+        help='Set to also get the sensitivity and upper limit at each confidence level CL (in percent, 68 90 95 99 by default) from the Neyman belt, all computed at once.')
+
+    # Trial budget
+    parser.add_argument(
+        '--advise',
+        nargs="?",
+        default=None,
+        const=0.02,
+        type=float,
+        metavar='PRECISION',
+        help='Set to print the statistical errors of the sensitivity and upper limit, and the number of trials needed at each flux to reach the relative precision PRECISION (0.02 by default).')
+
+    # Tail fit
+    parser.add_argument(
+        '--tail',
+        default=False,
+        action="store_true",
+        help='Set to fit the upper tail of the background TS distribution (zero plus chi-square, and exponential models), to extrapolate the p-value below one over the number of background trials and get the 3 and 5 sigma discovery potentials.')
+
+    # Profiling flag
+    parser.add_argument(
+        '--profile',
+        nargs="?",
+        default=None,
+        const='',
+        type=str,
+        help='Set to print the time, number of calls and peak memory of each stage, and to also write them as JSON to PROFILE if given.')
+
     args = parser.parse_args()
-    if len(sys.argv) >= 2 and len(sys.argv) <= 6:
-        main(args.inputfile, args.hide, args.unblinded, args.save)
+    if args.profile is not None:
+        profiling.enable()
+    if len(sys.argv) >= 2:
+        main(args.inputfile, args.hide, args.unblinded, args.save, args.bootstrap, args.chunk, args.belt, args.advise, args.tail)
+        profiling.report(args.profile)
     else:
         parser.print_help()
@@ -2,10 +2,13 @@
 
 r"""
 Shuffle a scrambled-trial results file to simply re-order for later merging.  It serves as a crosscheck that the order of the trials does not matter.  Since a file is expected to have multiple trials at many flux values, the flux change indices are found.  Shuffling only occurs inside of these ranges.  Shuffle.py sorts the entries before shuffling to account for disjoint trials where trials from some flux values are scattered throughout the file.
+
+The trials are never all held in memory: the trial lines of a text file are copied unchanged into a temporary file next to the output, and only their true flux and position are kept.  The order of the trials is shuffled in memory, then the lines are copied in that order from the memory-mapped temporary file, without parsing or formatting the curves.  A store made by convert.py is memory-mapped directly and its trials are formatted a chunk at a time.  Use --seed to get the same shuffle again.
 """
 
 r"""
-usage: shuffle.py [-h] [inputfile] [outputfile]
+usage: shuffle.py [-h] [--seed SEED] [--profile [PROFILE]]
+                  [inputfile] [outputfile]
 
 positional arguments:
   inputfile   Path to results input file to be shuffled.
@@ -13,72 +16,92 @@ positional arguments:
 
 optional arguments:
   -h, --help  show this help message and exit
+  --seed SEED Seed of the random generator, to reproduce a shuffle.
+  --profile [PROFILE]
+              Set to print the time, number of calls and peak memory of each
+              stage, and to also write them as JSON to PROFILE if given.
 """
 # Flux are in units [1/GeV/cm^2/s] or scaling factors relative to a specified model
 # And TS should be log( likelihood ) [unitless]
 
+import os
 import argparse
 import sys
+import tempfile
 import numpy as np
+from results_io import is_store, read_results, read_trial_lines, write_lines, write_text_chunks
+import profiling
 
-# Returns a list of tuples indicating a range over which the flux is constant
+CHUNK_TRIALS = 1 << 16  # Trials parsed, or gathered for writing, at a time
 
 
-def find_change_indices(data):
+def find_change_indices(flux):
     """
-    Find the line where the generated flux changes.
+    Find the ranges [start, end) over which the generated flux is constant in sorted fluxes.
     """
-    prev_flux = data[0][0]
-    start_index = 0
-    index = 0
-    change_points = []
-    for row in data:
-        if row[0] != prev_flux:  # found change point
-            change_points.append([start_index, index])
-            start_index = index
-        prev_flux = row[0]
-        index = index + 1
-    change_points.append([start_index, len(data)])  # last range
-    print "Found these ranges of constant flux: {}".format(change_points)
+    bounds = np.concatenate([[0], np.flatnonzero(flux[1:] != flux[:-1]) + 1, [len(flux)]])
+    change_points = np.column_stack([bounds[:-1], bounds[1:]])
+    print "Found these ranges of constant flux: {}".format(change_points.tolist())
     return change_points
 
 
-def main(infile, outfile):
+def shuffled_order(flux, rng):
     """
-    Shuffle the trials.
+    Order of the trials sorted by flux (stable), then shuffled in place inside each range of constant flux.
     """
-    rows_to_skip = 1
-    try:
-        f = open(infile, 'r')
-        h = f.readline().split()  # header
-        if h[0] == 'Bias':
-            h = f.readline().split()  # header
-            rows_to_skip += 1
-        first_line = f.readline().split()
-        if first_line[0] == 'Unblinded':
-            unblinded = first_line
-            rows_to_skip += 1
-        f.close()
-        data = np.loadtxt(infile, skiprows=rows_to_skip)
-        order = data[:, 0].argsort()  # get index based on first column
-        data = data[order]  # now ordered by flux
-    except IOError:
-        print "Error: Input file {} missing.".format(infile)
-        return 0
+    order = np.argsort(flux, kind='mergesort')
+    for start, end in find_change_indices(flux[order]):
+        rng.shuffle(order[start:end])  # a view, shuffling it edits 'order'
+    return order
 
-    # Identify ranges where fluxes are constant
-    change_points = find_change_indices(data)
 
-    # Now shuffle inside of the individual flux ranges
-    for r in change_points:
-        subarray = data[r[0]:r[1]]  # slice it and assign to a shallow copy
-        np.random.shuffle(subarray)  # editing 'subarray' edits the original 'data'
+def _gather(flux, curves, order):
+    """Trials in the given order, CHUNK_TRIALS at a time."""
+    for start in range(0, len(order), CHUNK_TRIALS):
+        indices = order[start:start + CHUNK_TRIALS]
+        yield flux[indices], curves[indices]
 
+
+def main(infile, outfile, seed=None):
+    """
+    Shuffle the trials.
+    """
     try:
-        np.savetxt(outfile, data, fmt='%0.2e', header='{} {} {}\n{}'.format(h[0], h[1], h[2], ' '.join(unblinded)), comments='')
-    except IOError:
+        handle, scratch = tempfile.mkstemp(prefix='shuffle_', suffix='.bin', dir=os.path.dirname(os.path.abspath(outfile)))
+    except OSError:
         print "Error: Unable to open output file {}.".format(outfile)
         return 0
+    os.close(handle)
+    try:
+        try:
+            with profiling.stage('read'):
+                if is_store(infile):
+                    header, bias, unblinded, flux, curves = read_results(infile)
+                else:
+                    header, bias, unblinded, flux, offsets = read_trial_lines(infile, scratch)
+        except IOError:
+            print "Error: Input file {} missing.".format(infile)
+            return 0
+        except ValueError as error:
+            print error
+            return 0
+        if not len(flux):
+            print "Error: No trials in {}.".format(infile)
+            return 0
+        with profiling.stage('shuffle', len(flux)):
+            order = shuffled_order(flux, np.random.RandomState(seed))
+
+        try:
+            with profiling.stage('write', len(order)):
+                if is_store(infile):
+                    write_text_chunks(outfile, header, bias, unblinded, _gather(flux, curves, order))
+                else:
+                    write_lines(outfile, header, bias, unblinded, scratch, offsets, order)
+        except IOError:
+            print "Error: Unable to open output file {}.".format(outfile)
+            return 0
+    finally:
+        os.remove(scratch)
 
 
 if __name__ == "__main__":
@@ -99,8 +122,27 @@ if __name__ == "__main__":
         type=str,
         help="Path to output file used to store shuffled results.")
 
+    # Random seed
+    parser.add_argument(
+        '--seed',
+        default=None,
+        type=int,
+        help='Seed of the random generator, to reproduce a shuffle.')
+
+    # Profiling flag
+    parser.add_argument(
+        '--profile',
+        nargs="?",
+        default=None,
+        const='',
+        type=str,
+        help='Set to print the time, number of calls and peak memory of each stage, and to also write them as JSON to PROFILE if given.')
+
     args = parser.parse_args()
+    if args.profile is not None:
+        profiling.enable()
     if len(sys.argv) >= 2:
-        main(args.inputfile, args.outputfile)
+        main(args.inputfile, args.outputfile, args.seed)
+        profiling.report(args.profile)
     else:
         parser.print_help()
@@ -0,0 +1,139 @@
+r"""
+Models of the upper tail of the background-only TS distribution, used by sensitivity.py --tail to extrapolate p-values below one over the number of background trials.
+
+Two models are fitted to the TS of the background trials:
+ - chi2: a fraction of the trials at TS = 0 and a chi-square distribution of free number of degrees of freedom and scale (a gamma distribution) for the others, as Wilks' theorem gives with the flux bounded at zero.
+ - exponential: an exponential fitted to the TS above the 1 - TAIL_FRACTION quantile of the background, which only models the tail but makes no assumption on the rest of the distribution.  It does not apply below that quantile, where only the counted fraction of trials gives the p-value.
+The parameters of both are maximum-likelihood estimates, with their covariance from the Fisher information, and the error of the log p-value at any TS is propagated from it.  A Kolmogorov-Smirnov test of the fitted part tells whether the model describes the trials.  It uses the fitted parameters, so its p-value is conservative (too large).
+"""
+
+import numpy as np
+from scipy import stats
+from scipy.optimize import brentq
+
+TAIL_FRACTION = 0.1  # fraction of the background trials fitted by the exponential model
+MIN_TAIL = 20  # fewest trials a model is fitted to
+
+
+class TailModel(object):
+    """
+    A model of the background TS distribution: log_sf(ts, params) is the log of the probability to get a TS above ts, params the fitted parameters with their covariance, ntrials the number of trials fitted, ks_pvalue the p-value of the Kolmogorov-Smirnov test of the fit and start the lowest TS the model describes.
+    """
+
+    def __init__(self, name, log_sf, params, covariance, ntrials, ks_pvalue, start=0.):
+        self.name = name
+        self.start = start
+        self._log_sf = log_sf
+        self.params = np.asarray(params, dtype=float)
+        self.covariance = np.asarray(covariance, dtype=float)
+        self.ntrials = ntrials
+        self.ks_pvalue = ks_pvalue
+
+    def applies(self, ts):
+        """True if the model describes the TS ts."""
+        return ts >= self.start
+
+    def log_sf(self, ts):
+        """Log of the p-value of ts."""
+        return np.minimum(self._log_sf(ts, self.params), 0.)
+
+    def log_sf_error(self, ts):
+        """Error of log_sf(ts) from the covariance of the parameters."""
+        steps = 1e-6 * np.maximum(np.abs(self.params), 1e-3)
+        gradient = np.array([(self._log_sf(ts, self.params + step) - self._log_sf(ts, self.params - step)) / (2. * step[i])
+                             for i, step in enumerate(np.diag(steps))])
+        return np.sqrt(gradient.dot(self.covariance).dot(gradient))
+
+    def p_value(self, ts):
+        """p-value of ts and its 68% interval from the errors of the parameters, nan where the model does not apply."""
+        if not self.applies(ts):
+            return np.nan, np.nan, np.nan
+        log_p = self.log_sf(ts)
+        error = self.log_sf_error(ts)
+        return np.exp(log_p), np.exp(log_p - error), np.exp(log_p + error)
+
+    def isf(self, p_value):
+        """TS whose p-value is p_value, and its error from the errors of the parameters.  nan if it is below the TS where the model applies."""
+        target = np.log(p_value)
+        if self.log_sf(self.start) <= target:
+            return (0., 0.) if self.start == 0. else (np.nan, np.nan)
+        high = self.start + 1.
+        while self.log_sf(high) > target:
+            high = 2. * high
+        ts = brentq(lambda x: self.log_sf(x) - target, self.start, high)
+        slope = (self.log_sf(ts * (1. + 1e-6) + 1e-9) - self.log_sf(ts)) / (ts * 1e-6 + 1e-9)
+        return ts, self.log_sf_error(ts) / abs(slope)
+
+
+def _hessian(function, x):
+    """Numerical Hessian of function at x, by central differences."""
+    steps = 1e-4 * np.maximum(np.abs(x), 1e-3)
+    n = len(x)
+    hessian = np.zeros((n, n))
+    for i in range(n):
+        for j in range(n):
+            ei = np.eye(n)[i] * steps[i]
+            ej = np.eye(n)[j] * steps[j]
+            hessian[i, j] = (function(x + ei + ej) - function(x + ei - ej) - function(x - ei + ej) + function(x - ei - ej)) / (4. * steps[i] * steps[j])
+    return hessian
+
+
+def fit_chi2(ts):
+    """Fit the chi2 model to the background TS ts.  None if fewer than MIN_TAIL trials have TS > 0."""
+    positive = ts[ts > 0.]
+    if len(positive) < MIN_TAIL:
+        return None
+    zero_fraction = 1. - len(positive) / float(len(ts))
+    shape, _, scale = stats.gamma.fit(positive, floc=0.)
+    negative_llh = lambda p: -np.sum(stats.gamma.logpdf(positive, p[0], scale=p[1]))
+    covariance = np.zeros((3, 3))
+    covariance[0, 0] = zero_fraction * (1. - zero_fraction) / len(ts)
+    covariance[1:, 1:] = np.linalg.inv(_hessian(negative_llh, np.array([shape, scale])))
+
+    def log_sf(x, p):
+        return np.log(1. - p[0]) + stats.gamma.logsf(x, p[1], scale=p[2])
+
+    ks_pvalue = stats.kstest(positive, 'gamma', args=(shape, 0., scale))[1]
+    return TailModel('chi2', log_sf, [zero_fraction, shape, scale], covariance, len(positive), ks_pvalue)
+
+
+def fit_exponential(ts, fraction=TAIL_FRACTION):
+    """Fit the exponential model to the fraction of the background TS ts above its 1 - fraction quantile.  None if fewer than MIN_TAIL trials are in the tail."""
+    start = np.percentile(ts, 100. * (1. - fraction))
+    excess = ts[ts > start] - start
+    if len(excess) < MIN_TAIL:
+        return None
+    above = len(excess) / float(len(ts))
+    slope = np.mean(excess)  # maximum-likelihood scale of an exponential
+
+    def log_sf(x, p):
+        return np.log(p[0]) - (x - start) / p[1]
+
+    covariance = np.diag([above * (1. - above) / len(ts), slope ** 2 / len(excess)])
+    ks_pvalue = stats.kstest(excess, 'expon', args=(0., slope))[1]
+    return TailModel('exponential', log_sf, [above, slope], covariance, len(excess), ks_pvalue, start)
+
+
+def fit_models(ts):
+    """The tail models that could be fitted to the background TS ts."""
+    return [model for model in [fit_chi2(ts), fit_exponential(ts)] if model is not None]
+
+
+def plot_tail(plt, ts, models, ts_unblinded=None):
+    """Anticumulative distribution of the background TS ts with the fitted models, from the TS where each applies, extrapolated beyond the largest TS."""
+    plt.figure()
+    plt.yscale('log')
+    plt.xlabel('TS')
+    plt.ylabel('p-value')
+    values = np.sort(ts)
+    plt.step(values, 1. - np.arange(len(values)) / float(len(values)), 'k', where='post', lw=2, label='Background trials')
+    top = 2. * max(values[-1], ts_unblinded or 0.)
+    for model in models:
+        xs = np.linspace(model.start, top, 200)
+        low, high = np.array([model.p_value(x)[1:] for x in xs]).T
+        line, = plt.plot(xs, np.exp([model.log_sf(x) for x in xs]), lw=2, label='{} (KS p = {:0.2f})'.format(model.name, model.ks_pvalue))
+        plt.fill_between(xs, low, high, color=line.get_color(), alpha=0.3)
+    if ts_unblinded is not None:
+        plt.axvline(ts_unblinded, color='g', lw=2, label='Unblinded TS')
+    plt.ylim(ymin=1e-8, ymax=1.)
+    plt.legend(loc='upper right')
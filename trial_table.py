@@ -0,0 +1,190 @@
+r"""
+Merged trials grouped by true flux, shared by sensitivity.py and bias.py.
+
+The trials are sorted once by true flux (and by value inside each group, per column, when order statistics are needed) and the offset and size of every group are recorded, so that per-flux medians, percentiles, fractions above a threshold and ECDFs are grouped array reductions instead of one boolean mask per flux.
+"""
+
+import numpy as np
+
+
+class TrialTable(object):
+    """
+    Merged trials, one row [true flux, best-fit flux, TS] per trial, grouped by true flux.  fluxes holds the sorted unique true fluxes, starts and counts the offset and number of trials of each group.
+    """
+
+    def __init__(self, data):
+        order = np.argsort(data[:, 0], kind='mergesort')  # stable, keeps the trial order inside each group
+        self.data = data[order]
+        self.fluxes, self.starts, self.counts = np.unique(self.data[:, 0], return_index=True, return_counts=True)
+        self.group_index = np.repeat(np.arange(len(self.fluxes)), self.counts)
+        self._sorted = {}
+
+    def index(self, flux):
+        """Group number of a true flux."""
+        return np.flatnonzero(self.fluxes == flux)[0]
+
+    def sorted_column(self, column):
+        """A column of the trials with values sorted inside each group."""
+        if column not in self._sorted:
+            order = np.lexsort((self.data[:, column], self.group_index))
+            self._sorted[column] = self.data[order, column]
+        return self._sorted[column]
+
+    def group(self, i, column):
+        """Values of a column for the trials of group i."""
+        return self.data[self.starts[i]:self.starts[i] + self.counts[i], column]
+
+    def groups(self, column):
+        """Values of a column for the trials of every group, as a list of arrays."""
+        return np.split(self.data[:, column], self.starts[1:])
+
+    def percentiles(self, q, column):
+        """Percentiles q (as np.percentile, linear interpolation) of a column in every group.  Returns an array of shape (len(q), number of groups)."""
+        values = self.sorted_column(column)
+        positions = np.asarray(q, dtype=float)[:, None] / 100. * (self.counts - 1)
+        lower = np.floor(positions).astype(int)
+        upper = np.minimum(lower + 1, self.counts - 1)
+        weight = positions - lower
+        return values[self.starts + lower] * (1. - weight) + values[self.starts + upper] * weight
+
+    def medians(self, column):
+        """Median of a column in every group."""
+        return self.percentiles([50], column)[0]
+
+    def means(self, column):
+        """Mean of a column in every group."""
+        return np.add.reduceat(self.data[:, column], self.starts) / self.counts
+
+    def stds(self, column):
+        """Standard deviation of a column in every group."""
+        deviations = self.data[:, column] - np.repeat(self.means(column), self.counts)
+        return np.sqrt(np.add.reduceat(deviations ** 2, self.starts) / self.counts)
+
+    def fractions_above(self, thresholds, column):
+        """Fraction of the trials of every group whose value is strictly above the threshold (a scalar or one value per group)."""
+        thresholds = np.broadcast_to(thresholds, self.fluxes.shape)
+        above = self.data[:, column] > np.repeat(thresholds, self.counts)
+        return np.add.reduceat(above.astype(float), self.starts) / self.counts
+
+    def ecdf(self, column):
+        """Values of a column sorted inside each group, and the fraction of its group at or below each of them."""
+        values = self.sorted_column(column)
+        ranks = np.arange(1, len(values) + 1) - np.repeat(self.starts, self.counts)
+        return values, ranks / np.repeat(self.counts, self.counts).astype(float)
+
+
+class StreamingTable(object):
+    """
+    The statistics of TrialTable, computed by passes over merged trials read chunk by chunk, so that memory does not depend on the number of trials.  chunks is a function returning a new iterator over arrays of rows [true flux, best-fit flux, TS].  The unblinded row (true flux -1), if any, is kept in unblinded and left out of the groups.  Order statistics are exact: the value interval holding each wanted rank is narrowed down by a histogram at each pass, and its values are sorted once few enough are left.
+    """
+
+    BINS = 1024  # histogram bins per wanted rank and pass
+    COLLECT_LIMIT = 1 << 14  # values per wanted rank gathered at the last pass
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.unblinded = None
+        stats = {}  # true flux -> [count, sums, minimums, maximums] of each column
+        for block in chunks():
+            is_unblinded = block[:, 0] == -1
+            if is_unblinded.any():
+                self.unblinded = block[is_unblinded][0]
+                block = block[~is_unblinded]
+            for flux in np.unique(block[:, 0]):
+                rows = block[block[:, 0] == flux]
+                if flux not in stats:
+                    stats[flux] = [0, np.zeros(block.shape[1]), rows.min(axis=0), rows.max(axis=0)]
+                entry = stats[flux]
+                entry[0] += len(rows)
+                entry[1] += rows.sum(axis=0)
+                entry[2] = np.minimum(entry[2], rows.min(axis=0))
+                entry[3] = np.maximum(entry[3], rows.max(axis=0))
+        self.fluxes = np.array(sorted(stats))
+        self.counts = np.array([stats[flux][0] for flux in self.fluxes])
+        self.sums = np.array([stats[flux][1] for flux in self.fluxes])
+        self.minimums = np.array([stats[flux][2] for flux in self.fluxes])
+        self.maximums = np.array([stats[flux][3] for flux in self.fluxes])
+
+    def _blocks(self):
+        """Blocks of trials without the unblinded row, with the group number of each trial."""
+        for block in self.chunks():
+            block = block[block[:, 0] != -1]
+            yield np.searchsorted(self.fluxes, block[:, 0]), block
+
+    def index(self, flux):
+        """Group number of a true flux."""
+        return np.flatnonzero(self.fluxes == flux)[0]
+
+    def select(self, column, groups, ranks):
+        """Exact value of the given rank (from 0, in increasing order) of a column in each of the given groups."""
+        groups = np.asarray(groups)
+        ranks = np.asarray(ranks)
+        low = self.minimums[groups, column].astype(float)
+        high = self.maximums[groups, column].astype(float)
+        size = self.counts[groups].copy()  # number of values of the group within [low, high]
+        values = np.where(low == high, low, np.nan)
+        while np.isnan(values).any():
+            active = np.flatnonzero(np.isnan(values))
+            below = np.zeros(len(groups), dtype=int)
+            hist = np.zeros((len(groups), self.BINS), dtype=int)
+            bin_low = np.full((len(groups), self.BINS), np.inf)
+            bin_high = np.full((len(groups), self.BINS), -np.inf)
+            gathered = dict((t, []) for t in active if size[t] <= self.COLLECT_LIMIT)
+            for group_index, block in self._blocks():
+                by_group = dict((g, block[group_index == g, column]) for g in set(groups[active]))
+                for t in active:
+                    v = by_group[groups[t]]
+                    below[t] += np.count_nonzero(v < low[t])
+                    v = v[(v >= low[t]) & (v <= high[t])]
+                    if t in gathered:
+                        gathered[t].append(v)
+                    else:
+                        b = np.minimum(((v - low[t]) / (high[t] - low[t]) * self.BINS).astype(int), self.BINS - 1)
+                        hist[t] += np.bincount(b, minlength=self.BINS)
+                        np.minimum.at(bin_low[t], b, v)
+                        np.maximum.at(bin_high[t], b, v)
+            for t in active:
+                rank = ranks[t] - below[t]  # rank within [low, high]
+                if t in gathered:
+                    values[t] = np.sort(np.concatenate(gathered[t]))[rank]
+                else:
+                    b = np.searchsorted(np.cumsum(hist[t]), rank, side='right')  # bin holding the rank
+                    low[t], high[t], size[t] = bin_low[t, b], bin_high[t, b], hist[t, b]
+                    if low[t] == high[t]:
+                        values[t] = low[t]
+        return values
+
+    def percentiles(self, q, column):
+        """Percentiles q (as np.percentile, linear interpolation) of a column in every group.  Returns an array of shape (len(q), number of groups)."""
+        positions = np.asarray(q, dtype=float)[:, None] / 100. * (self.counts - 1)
+        lower = np.floor(positions).astype(int)
+        upper = np.minimum(lower + 1, self.counts - 1)
+        weight = positions - lower
+        groups = np.tile(np.arange(len(self.fluxes)), (len(q), 1))
+        values = self.select(column, np.concatenate([groups.ravel()] * 2), np.concatenate([lower.ravel(), upper.ravel()]))
+        lower_values, upper_values = values.reshape(2, len(q), -1)
+        return lower_values * (1. - weight) + upper_values * weight
+
+    def medians(self, column):
+        """Median of a column in every group."""
+        return self.percentiles([50], column)[0]
+
+    def means(self, column):
+        """Mean of a column in every group."""
+        return self.sums[:, column] / self.counts
+
+    def stds(self, column):
+        """Standard deviation of a column in every group."""
+        means = self.means(column)
+        squares = np.zeros(len(self.fluxes))
+        for group_index, block in self._blocks():
+            squares += np.bincount(group_index, (block[:, column] - means[group_index]) ** 2, minlength=len(self.fluxes))
+        return np.sqrt(squares / self.counts)
+
+    def fractions_above(self, thresholds, column):
+        """Fraction of the trials of every group whose value is strictly above the threshold (a scalar or one value per group)."""
+        thresholds = np.broadcast_to(thresholds, self.fluxes.shape)
+        above = np.zeros(len(self.fluxes))
+        for group_index, block in self._blocks():
+            above += np.bincount(group_index, block[:, column] > thresholds[group_index], minlength=len(self.fluxes))
+        return above / self.counts